@@ -0,0 +1,58 @@
+"""Compares decoding api responses into dicts with decoding them straight
+into Articles, for decode time and the memory the results hold.
+
+Run from the project root with:
+
+    PYTHONPATH=$(pwd) python benchmarks/bench_articles.py
+"""
+import json
+import tracemalloc
+from benchmarks.bench_formatting import best_of, fake_articles, sizes
+from src.stream import search_response_adapter
+
+
+def response_bytes(count):
+    return json.dumps({"response": {
+        "status": "ok", "total": count, "currentPage": 1, "pages": 1,
+        "results": fake_articles(count)}}).encode()
+
+
+def decode_dicts(body):
+    return json.loads(body)["response"]["results"]
+
+
+def decode_articles(body):
+    return search_response_adapter.validate_json(body).response.results
+
+
+def bytes_per_article(decode, body, count):
+    """The memory still held by the decoded results, per article."""
+    tracemalloc.start()
+    results = decode(body)
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del results
+    return retained / count
+
+
+def main():
+    decoders = {"json.loads dicts": decode_dicts,
+                "typed Articles": decode_articles}
+
+    print(f"{'decode time':<30}" + "".join(f"{size:>12,}" for size in sizes))
+    bodies = {size: response_bytes(size) for size in sizes}
+    for name, decode in decoders.items():
+        print(f"{name:<30}" + "".join(
+            f"{best_of(lambda: decode(bodies[size])):>10.2f}ms"
+            for size in sizes))
+
+    print(f"\n{'bytes per article':<30}" + "".join(
+        f"{size:>12,}" for size in sizes))
+    for name, decode in decoders.items():
+        print(f"{name:<30}" + "".join(
+            f"{bytes_per_article(decode, bodies[size], size):>12,.0f}"
+            for size in sizes))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Compares running many searches one after another, in a thread pool and
+on an asyncio event loop, against a local stand in for the Guardian api
+that answers after 50ms.
+
+Run from the project root with:
+
+    PYTHONPATH=$(pwd) python benchmarks/bench_async.py
+"""
+import asyncio
+import contextlib
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+from benchmarks.guardian_standin import (
+    GuardianServer,
+    GuardianStandIn,
+    Latency
+)
+import src.stream as stream
+
+concurrent_searches = [1, 10, 100]
+
+
+def standin_server():
+    """A stand in api answering every search with 10 articles after
+    50ms."""
+    return GuardianServer(standin=GuardianStandIn(
+        latency=Latency("fixed", 0.05), total=10)).start()
+
+
+def searches(count):
+    return [stream.GuardianApiInfo(search_term=f"term {i}",
+                                   reference=f"memory:bench_{i}")
+            for i in range(count)]
+
+
+def run_sync(infos):
+    for info in infos:
+        stream.run_search(info, "test")
+
+
+def run_threaded(infos):
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        list(executor.map(lambda info: stream.run_search(info, "test"),
+                          infos))
+
+
+def run_async(infos):
+    asyncio.run(stream.run_searches_async(infos, api_key="test"))
+
+
+def main():
+    server = standin_server()
+    stream.base_url = server.url
+    stream.rate_governor = stream.RateGovernor(100000, burst=1000)
+
+    runners = {"sync": run_sync, "threaded (32 threads)": run_threaded,
+               "asyncio": run_async}
+    if stream.aiohttp is None:
+        print("aiohttp is not installed, so asyncio fetches in threads\n")
+
+    print(f"{'searches':<30}" + "".join(
+        f"{count:>12,}" for count in concurrent_searches))
+    for name, runner in runners.items():
+        timings = []
+        for count in concurrent_searches:
+            infos = searches(count)
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                runner(infos)
+                timings.append((time.perf_counter() - start) * 1000)
+        print(f"{name:<30}" + "".join(
+            f"{timing:>10.0f}ms" for timing in timings))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
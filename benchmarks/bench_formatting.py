@@ -0,0 +1,72 @@
+"""Compares format_api_response_message with the columnar formatter.
+
+Run from the project root with:
+
+    PYTHONPATH=$(pwd) python benchmarks/bench_formatting.py
+"""
+import timeit
+from src.stream import (
+    format_api_response_message,
+    format_articles_columnar,
+    pyarrow
+)
+
+sizes = [1000, 10000, 100000]
+
+
+def fake_articles(count):
+    """Articles shaped like Guardian content api results."""
+    return [
+        {
+            "id": f"environment/2024/jan/01/article-{i}",
+            "type": "article",
+            "sectionId": "environment",
+            "sectionName": "Environment",
+            "webPublicationDate": f"2024-01-01T{i % 24:02d}:00:00Z",
+            "webTitle": f"Climate story number {i} – \"quoted\" headline",
+            "webUrl": "https://www.theguardian.com/environment/2024/jan/01/"
+                      f"article-{i}",
+            "apiUrl": "https://content.guardianapis.com/environment/2024/"
+                      f"jan/01/article-{i}",
+            "isHosted": False,
+            "pillarId": "pillar/news",
+            "pillarName": "News",
+        }
+        for i in range(count)
+    ]
+
+
+def best_of(function, repeat=5):
+    """The fastest of several runs, in milliseconds."""
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number * 1000
+
+
+def main():
+    formatters = {
+        "format_api_response_message": format_api_response_message,
+        "columnar json": format_articles_columnar,
+        "columnar ndjson": lambda articles: format_articles_columnar(
+            articles, "ndjson"),
+    }
+    if pyarrow is not None:
+        formatters["columnar ipc"] = lambda articles: (
+            format_articles_columnar(articles, "ipc"))
+        formatters["columnar parquet"] = lambda articles: (
+            format_articles_columnar(articles, "parquet"))
+
+    print(f"{'formatter':<30}" + "".join(f"{size:>12,}" for size in sizes))
+    results = {}
+    for size in sizes:
+        articles = fake_articles(size)
+        for name, formatter in formatters.items():
+            results.setdefault(name, []).append(
+                best_of(lambda: formatter(articles)))
+    for name, timings in results.items():
+        print(f"{name:<30}" + "".join(
+            f"{timing:>10.2f}ms" for timing in timings))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Compares publishing to sqs (and reading the api key) with moto's
+mock_aws against the in-process fakes in fake_aws.py, to show how much of
+a benchmark's time goes to the mock rather than to the stream.
+
+Run from the project root with:
+
+    PYTHONPATH=$(pwd) python benchmarks/bench_publish.py
+"""
+import contextlib
+import io
+import os
+import time
+import boto3
+from moto import mock_aws
+from benchmarks.bench_formatting import fake_articles
+from benchmarks.fake_aws import fake_aws
+import src.stream as stream
+
+calls = 200
+batch_messages = 500
+
+
+def messages(count):
+    articles = fake_articles(10)
+    return [stream.article_message(articles, [f"term {number}"])
+            for number in range(count)]
+
+
+def send_messages(queue_url, batch):
+    for message in batch[:calls]:
+        stream.send_sqs_message(message["body"], queue_url)
+
+
+def send_batches(queue_url, batch):
+    stream.send_sqs_message_batch(batch, queue_url)
+
+
+def read_api_keys(queue_url, batch):
+    for _ in range(calls):
+        stream.get_api_key()
+
+
+def run(benchmark, batch):
+    """Times a benchmark against a new queue and secret."""
+    secrets = stream.get_client("secretsmanager")
+    with contextlib.suppress(Exception):
+        secrets.create_secret(Name="guardian_api_key",
+                              SecretString='{"api_key": "test"}')
+    queue_url = stream.create_sqs_queue(f"bench_{benchmark.__name__}")
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        benchmark(queue_url, batch)
+        return time.perf_counter() - start
+
+
+def main():
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+    batch = messages(batch_messages)
+    benchmarks = {
+        f"send_sqs_message x {calls:,}": send_messages,
+        f"send_sqs_message_batch, {batch_messages:,} messages": send_batches,
+        f"get_api_key x {calls:,}": read_api_keys,
+    }
+
+    print(f"{'':<44}{'moto':>10}{'fakes':>10}{'speedup':>10}")
+    for name, benchmark in benchmarks.items():
+        with mock_aws():
+            boto3.setup_default_session()
+            moto = run(benchmark, batch)
+        with fake_aws():
+            fakes = run(benchmark, batch)
+        print(f"{name:<44}{moto * 1000:>8.0f}ms{fakes * 1000:>8.1f}ms"
+              f"{moto / fakes:>9.0f}x")
+
+
+if __name__ == "__main__":
+    main()
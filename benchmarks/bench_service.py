@@ -0,0 +1,71 @@
+"""Compares the throughput of search jobs run one lambda invocation at a
+time, as 8 concurrent invocations and by the long running service with 8
+workers. AWS is mocked with moto and the Guardian api is a local stand in
+that answers after 50ms. Messages go to memory publishers, so the lambda
+path skips viewing the queue.
+
+Run from the project root with:
+
+    PYTHONPATH=$(pwd) python benchmarks/bench_service.py
+"""
+import contextlib
+import io
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from moto import mock_aws
+from benchmarks.bench_async import standin_server
+import src.stream as stream
+from src.service import StreamService
+
+jobs = 200
+
+
+def job_events(run):
+    return [{"search_term": f"{run} {i}", "reference": f"memory:{run}"}
+            for i in range(jobs)]
+
+
+def run_lambda(events, concurrency):
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(stream.lambda_handler, events))
+
+
+def run_service(events, workers):
+    with tempfile.NamedTemporaryFile("w", suffix=".ndjson") as f:
+        f.writelines(f"{json.dumps(event)}\n" for event in events)
+        f.flush()
+        StreamService(workers=workers).run_file(f.name)
+
+
+def main():
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+    server = standin_server()
+    stream.base_url = server.url
+    stream.rate_governor = stream.RateGovernor(100000, burst=1000)
+
+    runners = {
+        "lambda, 1 at a time": lambda events: run_lambda(events, 1),
+        "lambda, 8 concurrent": lambda events: run_lambda(events, 8),
+        "service, 8 workers": lambda events: run_service(events, 8),
+    }
+    with mock_aws():
+        boto3.client("secretsmanager", region_name="eu-west-2").create_secret(
+            Name="guardian_api_key", SecretString='{"api_key": "test"}')
+        print(f"{'runner':<30}{'jobs/second':>12}")
+        for number, (name, runner) in enumerate(runners.items()):
+            events = job_events(f"run_{number}")
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                runner(events)
+                elapsed = time.perf_counter() - start
+            print(f"{name:<30}{jobs / elapsed:>12.1f}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
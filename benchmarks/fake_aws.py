@@ -0,0 +1,317 @@
+"""In-process fakes of the sqs and secrets manager calls the stream makes,
+for benchmarks where moto's overhead would swamp the code being measured.
+
+The fakes plug in through the stream's client registry:
+
+    with fake_aws() as (sqs, secrets):
+        secrets.create_secret(Name="guardian_api_key",
+                              SecretString='{"api_key": "test"}')
+        stream.lambda_handler(...)
+
+They keep everything in memory behind a lock, cost a few microseconds a
+call and raise the same ClientErrors as aws for the mistakes the stream
+could make (a missing queue or secret, or a batch that is too big). They
+don't check message sizes, permissions or most parameters.
+"""
+import contextlib
+import hashlib
+import threading
+import time
+import uuid
+from collections import deque
+from types import SimpleNamespace
+from botocore.exceptions import ClientError
+import src.stream as stream
+
+account = "123456789012"
+queue_url_prefix = f"https://sqs.eu-west-2.amazonaws.com/{account}/"
+sqs_batch_entries = 10
+sqs_batch_bytes = 262144
+fifo_deduplication_seconds = 300
+
+
+def client_error(error, code, message, operation):
+    return error({"Error": {"Code": code, "Message": message}}, operation)
+
+
+class QueueDoesNotExist(ClientError):
+    pass
+
+
+class ResourceNotFoundException(ClientError):
+    pass
+
+
+class FakeQueue:
+    def __init__(self, name, attributes):
+        self.name = name
+        self.url = queue_url_prefix + name
+        self.attributes = {"VisibilityTimeout": "30", **attributes}
+        self.fifo = attributes.get("FifoQueue") == "true"
+        self.tags = {}
+        # Messages waiting, oldest first, and messages received but not yet
+        # deleted, by receipt handle
+        self.messages = deque()
+        self.in_flight = {}
+        self.deduplication_ids = {}
+
+
+class FakeSqs:
+    """Just enough of an sqs client for the stream and its consumer.
+
+    Received messages are hidden for their visibility timeout and go back
+    on the queue if they aren't deleted in time. Fifo queues drop a
+    message whose deduplication id was seen in the last 5 minutes, and
+    don't hand out a message while an earlier one of its group is in
+    flight.
+    """
+
+    exceptions = SimpleNamespace(QueueDoesNotExist=QueueDoesNotExist)
+
+    def __init__(self):
+        self.queues = {}
+        self.lock = threading.Lock()
+        self.arrived = threading.Condition(self.lock)
+
+    def queue(self, queue_url, operation):
+        queue = self.queues.get(queue_url.rsplit("/", 1)[-1])
+        if queue is None:
+            raise client_error(
+                QueueDoesNotExist, "AWS.SimpleQueueService.NonExistentQueue",
+                "The specified queue does not exist.", operation)
+        return queue
+
+    def create_queue(self, QueueName, Attributes=None, tags=None):
+        with self.lock:
+            if QueueName not in self.queues:
+                self.queues[QueueName] = FakeQueue(QueueName,
+                                                   Attributes or {})
+                self.queues[QueueName].tags.update(tags or {})
+            return {"QueueUrl": self.queues[QueueName].url}
+
+    def get_queue_url(self, QueueName):
+        with self.lock:
+            return {"QueueUrl": self.queue(QueueName, "GetQueueUrl").url}
+
+    def delete_queue(self, QueueUrl):
+        with self.lock:
+            del self.queues[self.queue(QueueUrl, "DeleteQueue").name]
+        return {}
+
+    def tag_queue(self, QueueUrl, Tags):
+        with self.lock:
+            self.queue(QueueUrl, "TagQueue").tags.update(Tags)
+        return {}
+
+    def list_queue_tags(self, QueueUrl):
+        with self.lock:
+            tags = dict(self.queue(QueueUrl, "ListQueueTags").tags)
+        return {"Tags": tags} if tags else {}
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames=None):
+        with self.lock:
+            queue = self.queue(QueueUrl, "GetQueueAttributes")
+            self.restore_expired(queue)
+            attributes = {
+                **queue.attributes,
+                "ApproximateNumberOfMessages": str(len(queue.messages)),
+                "ApproximateNumberOfMessagesNotVisible":
+                    str(len(queue.in_flight)),
+                "QueueArn": f"arn:aws:sqs:eu-west-2:{account}:{queue.name}",
+            }
+        names = AttributeNames or []
+        if "All" not in names:
+            attributes = {name: value for name, value in attributes.items()
+                          if name in names}
+        return {"Attributes": attributes}
+
+    def enqueue(self, queue, entry):
+        """Adds a message to a queue, returning its id (or the id of the
+        message it duplicates)."""
+        body = entry["MessageBody"]
+        if queue.fifo:
+            now = time.monotonic()
+            dedup_id = entry.get("MessageDeduplicationId") or \
+                hashlib.sha256(body.encode()).hexdigest()
+            seen = queue.deduplication_ids.get(dedup_id)
+            if seen and now - seen[0] < fifo_deduplication_seconds:
+                return seen[1]
+            message_id = str(uuid.uuid4())
+            queue.deduplication_ids[dedup_id] = (now, message_id)
+        else:
+            message_id = str(uuid.uuid4())
+        queue.messages.append({
+            "MessageId": message_id,
+            "Body": body,
+            "MD5OfBody": hashlib.md5(body.encode()).hexdigest(),
+            "MessageAttributes": entry.get("MessageAttributes", {}),
+            "GroupId": entry.get("MessageGroupId"),
+            "VisibleAt": time.monotonic() + entry.get("DelaySeconds", 0),
+        })
+        return message_id
+
+    def send_message(self, QueueUrl, MessageBody, **entry):
+        with self.arrived:
+            queue = self.queue(QueueUrl, "SendMessage")
+            message_id = self.enqueue(
+                queue, {"MessageBody": MessageBody, **entry})
+            self.arrived.notify_all()
+        return {"MessageId": message_id,
+                "MD5OfMessageBody": hashlib.md5(
+                    MessageBody.encode()).hexdigest()}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        if len(Entries) > sqs_batch_entries:
+            raise client_error(
+                ClientError, "AWS.SimpleQueueService.TooManyEntriesInBatch"
+                "Request", "Maximum number of entries per request are 10.",
+                "SendMessageBatch")
+        if sum(len(entry["MessageBody"].encode())
+               for entry in Entries) > sqs_batch_bytes:
+            raise client_error(
+                ClientError, "AWS.SimpleQueueService.BatchRequestTooLong",
+                "Batch requests cannot be longer than 262144 bytes.",
+                "SendMessageBatch")
+        with self.arrived:
+            queue = self.queue(QueueUrl, "SendMessageBatch")
+            successful = [
+                {"Id": entry["Id"],
+                 "MessageId": self.enqueue(queue, entry),
+                 "MD5OfMessageBody": hashlib.md5(
+                     entry["MessageBody"].encode()).hexdigest()}
+                for entry in Entries
+            ]
+            self.arrived.notify_all()
+        return {"Successful": successful}
+
+    def restore_expired(self, queue):
+        """Puts messages whose visibility timeout has run out back at the
+        front of the queue."""
+        now = time.monotonic()
+        expired = [handle for handle, (message, deadline)
+                   in queue.in_flight.items() if deadline <= now]
+        for handle in reversed(expired):
+            message, _ = queue.in_flight.pop(handle)
+            queue.messages.appendleft(message)
+
+    def take_visible(self, queue, count, visibility_timeout):
+        now = time.monotonic()
+        busy_groups = {message["GroupId"]
+                       for message, _ in queue.in_flight.values()
+                       if queue.fifo}
+        taken, skipped = [], []
+        while queue.messages and len(taken) < count:
+            message = queue.messages.popleft()
+            if (message["VisibleAt"] <= now
+                    and message["GroupId"] not in busy_groups):
+                handle = uuid.uuid4().hex
+                queue.in_flight[handle] = (message, now + visibility_timeout)
+                taken.append((handle, message))
+            else:
+                if queue.fifo:
+                    busy_groups.add(message["GroupId"])
+                skipped.append(message)
+        queue.messages.extendleft(reversed(skipped))
+        return taken
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1,
+                        WaitTimeSeconds=0, VisibilityTimeout=None,
+                        MessageAttributeNames=None, AttributeNames=None):
+        deadline = time.monotonic() + WaitTimeSeconds
+        with self.arrived:
+            queue = self.queue(QueueUrl, "ReceiveMessage")
+            timeout = VisibilityTimeout
+            if timeout is None:
+                timeout = int(queue.attributes["VisibilityTimeout"])
+            while True:
+                self.restore_expired(queue)
+                taken = self.take_visible(queue, MaxNumberOfMessages,
+                                          timeout)
+                remaining = deadline - time.monotonic()
+                if taken or remaining <= 0:
+                    break
+                self.arrived.wait(min(remaining, 0.1))
+
+        names = MessageAttributeNames or []
+        messages = []
+        for handle, message in taken:
+            attributes = message["MessageAttributes"]
+            if "All" not in names:
+                attributes = {name: value
+                              for name, value in attributes.items()
+                              if name in names}
+            received = {"MessageId": message["MessageId"],
+                        "ReceiptHandle": handle,
+                        "MD5OfBody": message["MD5OfBody"],
+                        "Body": message["Body"]}
+            if attributes:
+                received["MessageAttributes"] = attributes
+            messages.append(received)
+        return {"Messages": messages} if messages else {}
+
+    def delete_message(self, QueueUrl, ReceiptHandle):
+        with self.lock:
+            self.queue(QueueUrl, "DeleteMessage").in_flight.pop(
+                ReceiptHandle, None)
+        return {}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        with self.lock:
+            queue = self.queue(QueueUrl, "DeleteMessageBatch")
+            for entry in Entries:
+                queue.in_flight.pop(entry["ReceiptHandle"], None)
+        return {"Successful": [{"Id": entry["Id"]} for entry in Entries]}
+
+    def change_message_visibility(self, QueueUrl, ReceiptHandle,
+                                  VisibilityTimeout):
+        with self.lock:
+            queue = self.queue(QueueUrl, "ChangeMessageVisibility")
+            if ReceiptHandle in queue.in_flight:
+                message, _ = queue.in_flight[ReceiptHandle]
+                queue.in_flight[ReceiptHandle] = (
+                    message, time.monotonic() + VisibilityTimeout)
+        return {}
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        for entry in Entries:
+            self.change_message_visibility(
+                QueueUrl, entry["ReceiptHandle"], entry["VisibilityTimeout"])
+        return {"Successful": [{"Id": entry["Id"]} for entry in Entries]}
+
+
+class FakeSecretsManager:
+    """Secrets kept in memory, created with create_secret."""
+
+    exceptions = SimpleNamespace(
+        ResourceNotFoundException=ResourceNotFoundException)
+
+    def __init__(self):
+        self.secrets = {}
+
+    def create_secret(self, Name, SecretString):
+        self.secrets[Name] = SecretString
+        return {"Name": Name,
+                "ARN": f"arn:aws:secretsmanager:eu-west-2:{account}:"
+                       f"secret:{Name}"}
+
+    def get_secret_value(self, SecretId):
+        if SecretId not in self.secrets:
+            raise client_error(
+                ResourceNotFoundException, "ResourceNotFoundException",
+                "Secrets Manager can't find the specified secret.",
+                "GetSecretValue")
+        return {"Name": SecretId, "SecretString": self.secrets[SecretId]}
+
+
+@contextlib.contextmanager
+def fake_aws():
+    """Registers a FakeSqs and a FakeSecretsManager as the stream's sqs and
+    secrets manager clients while the context is open."""
+    sqs, secrets = FakeSqs(), FakeSecretsManager()
+    stream.register_client("sqs", lambda **options: sqs)
+    stream.register_client("secretsmanager", lambda **options: secrets)
+    try:
+        yield sqs, secrets
+    finally:
+        stream.register_client("sqs", None)
+        stream.register_client("secretsmanager", None)
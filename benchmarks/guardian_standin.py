@@ -0,0 +1,320 @@
+"""A local stand in for the Guardian content api's /search endpoint, for
+load tests that shouldn't spend the real api's quota.
+
+Every search term has its own stable set of articles, published at a
+steady rate going back from when the stand in started. Searches honour
+q, from-date, to-date, page, page-size, order-by and show-fields, and are
+answered with paginated responses shaped like the real api's. Responses
+are delayed by a latency distribution, and the stand in can inject 429s
+and 5xx errors and rate limit each api key as the real api does.
+
+Run from the project root with, for example:
+
+    PYTHONPATH=$(pwd) python benchmarks/guardian_standin.py --port 8080 \\
+        --latency lognormal:0.05:0.5 --error-rate 0.01 --rate-limit 12
+
+and point stream.base_url at http://127.0.0.1:8080/search.
+"""
+import argparse
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+sections = [("environment", "Environment"), ("politics", "Politics"),
+            ("business", "Business"), ("world", "World news"),
+            ("science", "Science"), ("sport", "Sport")]
+
+
+class Latency:
+    """A distribution of response delays in seconds, written as
+    "fixed:<seconds>", "uniform:<low>:<high>", "lognormal:<median>:<sigma>"
+    or "exponential:<mean>"."""
+
+    kinds = {"fixed": 1, "uniform": 2, "lognormal": 2, "exponential": 1}
+
+    def __init__(self, kind="fixed", *params):
+        if len(params) != self.kinds.get(kind, -1):
+            raise ValueError(f"Unknown latency distribution {kind}{params}")
+        self.kind = kind
+        self.params = params
+
+    @classmethod
+    def parse(cls, text):
+        kind, *params = text.split(":")
+        return cls(kind, *map(float, params))
+
+    def sample(self, rng):
+        if self.kind == "uniform":
+            return rng.uniform(*self.params)
+        if self.kind == "lognormal":
+            median, sigma = self.params
+            return rng.lognormvariate(math.log(median), sigma)
+        if self.kind == "exponential":
+            return rng.expovariate(1 / self.params[0])
+        return self.params[0]
+
+
+class GuardianStandIn:
+    """The settings and state the stand in's request handlers share.
+
+    error_rate and throttle_rate are the shares of requests answered with
+    a random 5xx error or a 429. With requests_per_second set, each api
+    key gets a token bucket of that rate holding up to burst requests,
+    and with daily_limit set, at most that many requests; requests over
+    either limit get a 429. total fixes how many articles every term
+    finds, otherwise it is between 0 and 2000 depending on the term.
+    """
+
+    def __init__(self, latency=None, error_rate=0.0, throttle_rate=0.0,
+                 requests_per_second=None, burst=1, daily_limit=None,
+                 total=None, seed=None):
+        self.latency = latency or Latency("fixed", 0.0)
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.daily_limit = daily_limit
+        self.total = total
+        self.newest = int(time.time())
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.calls = Counter()
+        self.statuses = Counter()
+
+    def term(self, q):
+        """Returns how many articles a term finds and the seconds between
+        them."""
+        digest = int(hashlib.sha256((q or "").encode()).hexdigest()[:8], 16)
+        total = digest % 2001 if self.total is None else self.total
+        return total, 600 + digest % 86400
+
+    def article(self, q, index, spacing, fields):
+        published = self.newest - index * spacing
+        when = datetime.fromtimestamp(published, timezone.utc)
+        section_id, section_name = sections[index % len(sections)]
+        slug = f"{(q or 'news').replace(' ', '-')}-{index}"
+        path = f"{section_id}/{when:%Y/%b/%d}".lower() + f"/{slug}"
+        article = {
+            "id": path,
+            "type": "article",
+            "sectionId": section_id,
+            "sectionName": section_name,
+            "webPublicationDate": when.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "webTitle": f"{q or 'News'} story {index}",
+            "webUrl": f"https://www.theguardian.com/{path}",
+            "apiUrl": f"https://content.guardianapis.com/{path}",
+            "isHosted": False,
+            "pillarId": "pillar/news",
+            "pillarName": "News",
+        }
+        if "trailText" in fields:
+            article["fields"] = {
+                "trailText": f"The latest on {q or 'the news'}, part {index}"}
+        return article
+
+    def search(self, params):
+        """Answers a search, returning its status code and body."""
+        q = params.get("q")
+        try:
+            page = int(params.get("page", 1))
+            page_size = int(params.get("page-size", 10))
+        except ValueError:
+            return 400, error_body("page and page-size must be integers")
+        if not 0 <= page_size <= 200:
+            return 400, error_body(
+                "page-size must be an integer between 0 and 200")
+
+        total, spacing = self.term(q)
+        first, last = 0, total - 1
+        if params.get("to-date"):
+            end = day_start(params["to-date"]) + 86399
+            first = max(first, math.ceil((self.newest - end) / spacing))
+        if params.get("from-date"):
+            start = day_start(params["from-date"])
+            last = min(last, (self.newest - start) // spacing)
+        found = max(0, last - first + 1)
+        pages = math.ceil(found / page_size) if page_size else 0
+        if page < 1 or (page > pages and found):
+            return 400, error_body(
+                "requested page is beyond the number of available pages")
+
+        indexes = range(first, last + 1)
+        if params.get("order-by") == "oldest":
+            indexes = indexes[::-1]
+        page_indexes = indexes[(page - 1) * page_size:page * page_size]
+        fields = params.get("show-fields", "").split(",")
+        return 200, {"response": {
+            "status": "ok",
+            "userTier": "developer",
+            "total": found,
+            "startIndex": (page - 1) * page_size + 1,
+            "pageSize": page_size,
+            "currentPage": page,
+            "pages": pages,
+            "orderBy": params.get("order-by", "relevance"),
+            "results": [self.article(q, index, spacing, fields)
+                        for index in page_indexes],
+        }}
+
+    def limited(self, key):
+        """Takes a request from a key's rate and daily limits, returning
+        the seconds to wait if it is over either."""
+        with self.lock:
+            self.calls[key] += 1
+            if self.daily_limit and self.calls[key] > self.daily_limit:
+                return 86400
+            if not self.requests_per_second:
+                return 0
+            rate = self.requests_per_second
+            now = time.monotonic()
+            tokens, updated = self.buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * rate)
+            if tokens < 1:
+                self.buckets[key] = (tokens, now)
+                return (1 - tokens) / rate
+            self.buckets[key] = (tokens - 1, now)
+            return 0
+
+    def respond(self, params):
+        """Returns the status, headers and body for a search request, and
+        how long to wait before sending them."""
+        key = params.get("api-key")
+        with self.lock:
+            draw = self.rng.random()
+        if not key:
+            status, headers, body = 401, {}, {"message": "Unauthorized"}
+        elif draw < self.throttle_rate:
+            status, headers, body = 429, {"Retry-After": "1"}, {
+                "message": "API rate limit exceeded"}
+        elif draw < self.throttle_rate + self.error_rate:
+            with self.lock:
+                status = self.rng.choice([500, 502, 503, 504])
+            headers, body = {}, {"message": "Internal server error"}
+        elif wait := self.limited(key):
+            status, headers, body = 429, {
+                "Retry-After": str(math.ceil(wait))}, {
+                "message": "API rate limit exceeded"}
+        else:
+            headers = {}
+            status, body = self.search(params)
+        with self.lock:
+            self.statuses[status] += 1
+            delay = self.latency.sample(self.rng)
+        return status, headers, body, delay
+
+    def stats(self):
+        with self.lock:
+            return {"requests": sum(self.statuses.values()),
+                    "statuses": dict(self.statuses)}
+
+
+def day_start(value):
+    return int(datetime.strptime(value, "%Y-%m-%d").replace(
+        tzinfo=timezone.utc).timestamp())
+
+
+def error_body(message):
+    return {"response": {"status": "error", "message": message}}
+
+
+class GuardianHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path.rstrip("/") != "/search":
+            status, headers, body, delay = 404, {}, {
+                "message": "Not found"}, 0
+        else:
+            params = {name: values[-1]
+                      for name, values in parse_qs(url.query).items()}
+            status, headers, body, delay = self.server.standin.respond(params)
+        time.sleep(delay)
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class GuardianServer(ThreadingHTTPServer):
+    """Serves a GuardianStandIn. Port 0 picks a free port."""
+    # Room for every concurrent connection, or some wait for a retry
+    request_queue_size = 256
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 0), standin=None):
+        super().__init__(address, GuardianHandler)
+        self.standin = standin or GuardianStandIn()
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_port}/search"
+
+    def start(self):
+        """Serves from a background thread."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def standin_arguments(parser):
+    """Adds the stand in's settings to an argument parser."""
+    parser.add_argument("--latency", type=Latency.parse,
+                        default=Latency("fixed", 0.05),
+                        help="response delay, e.g. fixed:0.05, "
+                             "uniform:0.02:0.2, lognormal:0.05:0.5 or "
+                             "exponential:0.05 (default fixed:0.05)")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="share of requests answered with a 5xx")
+    parser.add_argument("--throttle-rate", type=float, default=0.0,
+                        help="share of requests answered with a 429")
+    parser.add_argument("--rate-limit", type=float,
+                        help="requests a second allowed for each api key")
+    parser.add_argument("--burst", type=int, default=1,
+                        help="requests an api key can make at once")
+    parser.add_argument("--daily-limit", type=int,
+                        help="requests allowed for each api key")
+    parser.add_argument("--total", type=int,
+                        help="articles every search term finds")
+    parser.add_argument("--seed", type=int,
+                        help="seed for the latencies and errors")
+
+
+def standin_from_arguments(args):
+    return GuardianStandIn(
+        latency=args.latency, error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        requests_per_second=args.rate_limit, burst=args.burst,
+        daily_limit=args.daily_limit, total=args.total, seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serves a local stand in for the Guardian search api.")
+    parser.add_argument("--port", type=int, default=8080)
+    standin_arguments(parser)
+    args = parser.parse_args()
+
+    server = GuardianServer(("127.0.0.1", args.port),
+                            standin_from_arguments(args))
+    print(f"Serving the Guardian api stand in at {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(json.dumps(server.standin.stats()))
+
+
+if __name__ == "__main__":
+    main()
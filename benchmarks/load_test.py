@@ -0,0 +1,161 @@
+"""Load tests lambda_handler: runs concurrent invocations against the local
+Guardian api stand in (see guardian_standin.py) and reports throughput,
+latency percentiles and error rates.
+
+Each invocation is a batch event of one search, published to one of a
+few sqs queues. With --mode search they are plain search events instead,
+which also view the queue afterwards and so take over 5 seconds each.
+Sqs and secrets manager are mocked in process with moto, or with the
+lighter fakes in fake_aws.py with --fake-aws, unless --sqs-endpoint
+points at a local sqs (e.g. moto_server or ElasticMQ).
+
+Run from the project root with, for example:
+
+    PYTHONPATH=$(pwd) python benchmarks/load_test.py --invocations 1000 \\
+        --concurrency 32 --latency lognormal:0.05:0.5 --throttle-rate 0.02
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import re
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from moto import mock_aws
+from benchmarks.fake_aws import fake_aws
+from benchmarks.guardian_standin import (
+    GuardianServer,
+    standin_arguments,
+    standin_from_arguments
+)
+import src.stream as stream
+
+
+def percentile(values, share):
+    """The nearest rank percentile of a list of values."""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[max(0, round(share * len(ordered)) - 1)]
+
+
+def error_kind(error):
+    """Groups an error by its status code where it has one, e.g.
+    "HTTP 429", otherwise by its first words."""
+    status = re.search(r"(\d{3}) (Client|Server) Error", error)
+    if status:
+        return f"HTTP {status.group(1)}"
+    return " ".join(error.strip('"').split()[:2])
+
+
+def invoke(event):
+    """Runs one invocation, returning how long it took and its error, if
+    it failed."""
+    start = time.perf_counter()
+    try:
+        result = stream.lambda_handler(event)
+        error = None
+        if isinstance(result, dict) and result.get("result") == "error":
+            error = "Validation error"
+    except SystemExit as e:
+        error = str(e)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    return time.perf_counter() - start, error
+
+
+def load_event(number, mode, terms, queues):
+    search = {"search_term": f"load term {number % terms}",
+              "reference": f"load_test_{number % queues}"}
+    if mode == "search":
+        return search
+    return {"mode": "batch", "searches": [search]}
+
+
+def run_load(invocations, concurrency, mode="batch", terms=50, queues=4):
+    """Runs invocations of lambda_handler, concurrency at a time.
+
+    Returns:
+         A report of the throughput, latency percentiles (in ms) and
+         errors by kind.
+    """
+    events = [load_event(number, mode, terms, queues)
+              for number in range(invocations)]
+    with contextlib.redirect_stdout(io.StringIO()), \
+            ThreadPoolExecutor(max_workers=concurrency) as executor:
+        start = time.perf_counter()
+        results = list(executor.map(invoke, events))
+        elapsed = time.perf_counter() - start
+
+    latencies = [seconds * 1000 for seconds, _ in results]
+    errors = Counter(error_kind(error) for _, error in results if error)
+    return {
+        "invocations": invocations,
+        "concurrency": concurrency,
+        "seconds": round(elapsed, 3),
+        "invocations_per_second": round(invocations / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50), 1),
+        "p95_ms": round(percentile(latencies, 0.95), 1),
+        "p99_ms": round(percentile(latencies, 0.99), 1),
+        "error_rate": round(sum(errors.values()) / invocations, 4),
+        "errors": dict(errors),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load tests lambda_handler against a local stand in "
+                    "for the Guardian api.")
+    parser.add_argument("--invocations", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--mode", choices=["batch", "search"],
+                        default="batch",
+                        help="the kind of event each invocation runs")
+    parser.add_argument("--client-rate", type=float, default=1000,
+                        help="requests a second the stream's rate governor "
+                             "allows")
+    parser.add_argument("--sqs-endpoint",
+                        help="url of a local sqs to publish to, instead of "
+                             "mocking sqs in process")
+    parser.add_argument("--fake-aws", action="store_true",
+                        help="use the in-process fakes of sqs and secrets "
+                             "manager instead of moto")
+    parser.add_argument("--json", action="store_true",
+                        help="print the report as json")
+    standin_arguments(parser)
+    args = parser.parse_args()
+
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+    if args.sqs_endpoint:
+        os.environ["AWS_ENDPOINT_URL_SQS"] = args.sqs_endpoint
+
+    server = GuardianServer(standin=standin_from_arguments(args)).start()
+    stream.base_url = server.url
+    stream.rate_governor = stream.RateGovernor(args.client_rate,
+                                               burst=args.concurrency)
+
+    if args.fake_aws:
+        aws = fake_aws()
+    else:
+        aws = mock_aws(config={"core": {"passthrough": {
+            "urls": [re.escape(args.sqs_endpoint or "") + ".*"]}}}
+            if args.sqs_endpoint else None)
+    with aws:
+        stream.get_client("secretsmanager").create_secret(
+            Name="guardian_api_key", SecretString='{"api_key": "load"}')
+        report = run_load(args.invocations, args.concurrency, args.mode)
+    report["standin"] = server.standin.stats()
+    server.shutdown()
+
+    if args.json:
+        print(json.dumps(report))
+        return
+    for name, value in report.items():
+        print(f"{name:<24}{value}")
+
+
+if __name__ == "__main__":
+    main()
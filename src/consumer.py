@@ -0,0 +1,529 @@
+import base64
+import bisect
+import gzip
+import json
+import logging
+import math
+import queue
+import threading
+import time
+from botocore.exceptions import ClientError
+from src import stream
+
+logger = logging.getLogger()
+
+# SQS receives, deletes and changes visibility for at most 10 messages a call
+sqs_batch_entries = 10
+
+# Upper bounds, in seconds, of the lag histogram buckets, from 100ms to a
+# day. Longer lags go in a last, open ended bucket.
+lag_buckets = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800,
+               3600, 7200, 21600, 43200, 86400)
+
+# The stages between an article's publication and its consumption
+freshness_stages = ("publication_to_fetch", "fetch_to_enqueue",
+                    "enqueue_to_consume", "publication_to_consume")
+
+
+class ConsumedMessage:
+    """A message received from a reference queue, with its body already
+    decoded. sent_at is when sqs received it, as a unix time."""
+
+    __slots__ = ("body", "message_id", "receipt_handle", "attributes",
+                 "sent_at")
+
+    def __init__(self, body, message_id, receipt_handle, attributes,
+                 sent_at=None):
+        self.body = body
+        self.message_id = message_id
+        self.receipt_handle = receipt_handle
+        self.attributes = attributes
+        self.sent_at = sent_at
+
+    def json(self):
+        return json.loads(self.body)
+
+    @property
+    def reference(self):
+        """The reference of a message from a shared queue."""
+        return self.attributes.get("reference")
+
+    @property
+    def trace_id(self):
+        return self.attributes.get("trace-id")
+
+
+class LagHistogram:
+    """Counts lags, in seconds, into the lag_buckets. A percentile is the
+    upper bound of the bucket it falls in (or the largest lag seen, if
+    that is smaller), so it is as accurate as the buckets are narrow."""
+
+    def __init__(self):
+        self.counts = [0] * (len(lag_buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        # Clocks on different hosts can put an end slightly before a start
+        seconds = max(0.0, seconds)
+        self.counts[bisect.bisect_left(lag_buckets, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, share):
+        if not self.count:
+            return 0.0
+        rank = max(1, math.ceil(share * self.count))
+        seen = 0
+        for bound, count in zip(lag_buckets + (self.max,), self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": round(self.total / self.count, 3) if self.count else 0.0,
+            "p50": self.percentile(0.50),
+            "p90": self.percentile(0.90),
+            "p99": self.percentile(0.99),
+            "max": round(self.max, 3),
+        }
+
+
+class FreshnessTracker:
+    """Lag histograms for every freshness stage of consumed messages.
+
+    A message's articles are published at its latest-publication-date
+    (its newest article), fetched at its fetched-at and enqueued at its
+    enqueued-at attribute, or sqs's SentTimestamp for messages without
+    one, and consumed when the consumer hands them out. Stages a message
+    has no times for are skipped.
+    """
+
+    def __init__(self):
+        self.histograms = {stage: LagHistogram()
+                           for stage in freshness_stages}
+        self.lock = threading.Lock()
+
+    def record(self, message, consumed_at=None):
+        attributes = message.attributes
+        published = stream.parse_timestamp(
+            attributes.get("latest-publication-date"))
+        fetched = stream.parse_timestamp(attributes.get("fetched-at"))
+        enqueued = (stream.parse_timestamp(attributes.get("enqueued-at"))
+                    or message.sent_at)
+        consumed = time.time() if consumed_at is None else consumed_at
+
+        times = [published, fetched, enqueued, consumed]
+        lags = [
+            (stage, end - start)
+            for stage, start, end in zip(freshness_stages, times, times[1:])
+            if start is not None and end is not None
+        ]
+        if published is not None:
+            lags.append(("publication_to_consume", consumed - published))
+        with self.lock:
+            for stage, lag in lags:
+                self.histograms[stage].add(lag)
+
+    def summary(self):
+        """The count, mean, p50, p90, p99 and max lag of every stage, in
+        seconds."""
+        with self.lock:
+            return {stage: histogram.summary()
+                    for stage, histogram in self.histograms.items()}
+
+
+def message_attribute(message, name):
+    attribute = message.get("MessageAttributes", {}).get(name)
+    return attribute["StringValue"] if attribute else None
+
+
+def decode_body(message, s3_client=None):
+    """Returns the body of an sqs message as a string.
+
+    A message with a "claim-check" attribute holds a json
+    {"bucket": ..., "key": ...} pointer in its body and the real body is
+    fetched from S3. A "content-encoding" attribute of "gzip" means the
+    body is base64 encoded gzip. Anything else is returned as it is.
+    """
+    body = message["Body"]
+    if message_attribute(message, "claim-check"):
+        pointer = json.loads(body)
+        s3_client = s3_client or stream.get_client("s3")
+        body = s3_client.get_object(
+            Bucket=pointer["bucket"], Key=pointer["key"])["Body"].read()
+        if message_attribute(message, "content-encoding") != "gzip":
+            body = body.decode()
+    elif message_attribute(message, "content-encoding") == "gzip":
+        body = base64.b64decode(body)
+    if message_attribute(message, "content-encoding") == "gzip":
+        body = gzip.decompress(body).decode()
+    return body
+
+
+class QueueConsumer:
+    """Drains a reference queue with several long polling workers.
+
+    Pollers receive up to 10 messages a call into a buffer of at most
+    prefetch messages. Messages can be handled with run(handler), which
+    calls the handler from a pool of threads, or by iterating over the
+    consumer. Handled messages are deleted with DeleteMessageBatch, and
+    the visibility timeout of every message still buffered or being
+    handled is extended by a heartbeat, so slow handlers don't see their
+    messages redelivered. The freshness of every message handed out is
+    recorded in freshness, a FreshnessTracker.
+
+    With stop_when_empty the consumer finishes once every poller has had
+    an empty receive, otherwise it runs until stop() is called. Once
+    stopped no more messages are handed out, and messages still buffered
+    are released back to the queue when the consumer is closed.
+    """
+
+    def __init__(self, queue_url, workers=4, prefetch=100,
+                 visibility_timeout=30, wait_time=20, retry_delay=5,
+                 stop_when_empty=False, sqs_client=None, s3_client=None):
+        self.queue_url = queue_url
+        self.workers = workers
+        self.visibility_timeout = visibility_timeout
+        self.wait_time = wait_time
+        self.retry_delay = retry_delay
+        self.stop_when_empty = stop_when_empty
+        self.sqs_client = sqs_client or stream.get_client("sqs")
+        self.s3_client = s3_client
+
+        self.buffer = queue.Queue(maxsize=prefetch)
+        self.acks = queue.Queue()
+        self.in_flight = {}
+        self.in_flight_lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.pollers = []
+        self.background = []
+        self.received = 0
+        self.deleted = 0
+        self.freshness = FreshnessTracker()
+
+    def start(self):
+        self.pollers = [
+            threading.Thread(target=self.poll, daemon=True)
+            for _ in range(self.workers)
+        ]
+        self.background = [
+            threading.Thread(target=self.delete_acked, daemon=True),
+            threading.Thread(target=self.heartbeat, daemon=True),
+        ]
+        for thread in self.pollers + self.background:
+            thread.start()
+
+    def stop(self):
+        self.stopping.set()
+
+    def finished(self):
+        return not any(poller.is_alive() for poller in self.pollers)
+
+    def poll(self):
+        while not self.stopping.is_set():
+            try:
+                response = self.sqs_client.receive_message(
+                    QueueUrl=self.queue_url,
+                    MaxNumberOfMessages=sqs_batch_entries,
+                    WaitTimeSeconds=self.wait_time,
+                    VisibilityTimeout=self.visibility_timeout,
+                    MessageAttributeNames=["All"],
+                    AttributeNames=["All"],
+                )
+            except ClientError as e:
+                logger.error(f"Messages could not be received: {e}")
+                time.sleep(1)
+                continue
+
+            messages = response.get("Messages", [])
+            if not messages and self.stop_when_empty:
+                return
+            deadline = time.monotonic() + self.visibility_timeout
+            for number, message in enumerate(messages):
+                with self.in_flight_lock:
+                    self.in_flight[message["ReceiptHandle"]] = deadline
+                    self.received += 1
+                if not self.buffer_message(message):
+                    self.release([message["ReceiptHandle"]
+                                  for message in messages[number:]])
+                    return
+
+    def buffer_message(self, message):
+        """Waits for room in the buffer for a message, giving up if the
+        consumer is stopped meanwhile.
+
+        Returns:
+             Whether the message was buffered.
+        """
+        while not self.stopping.is_set():
+            try:
+                self.buffer.put(message, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def heartbeat(self):
+        """Extends the visibility timeout of messages that are close to
+        reappearing on the queue while still buffered or being handled."""
+        while not self.stopping.wait(self.visibility_timeout / 3):
+            now = time.monotonic()
+            with self.in_flight_lock:
+                due = [
+                    handle for handle, deadline in self.in_flight.items()
+                    if deadline - now < self.visibility_timeout / 2
+                ]
+            self.extend_visibility(due)
+
+    def extend_visibility(self, receipt_handles):
+        for start in range(0, len(receipt_handles), sqs_batch_entries):
+            batch = receipt_handles[start:start + sqs_batch_entries]
+            try:
+                self.sqs_client.change_message_visibility_batch(
+                    QueueUrl=self.queue_url,
+                    Entries=[
+                        {"Id": str(number), "ReceiptHandle": handle,
+                         "VisibilityTimeout": self.visibility_timeout}
+                        for number, handle in enumerate(batch)
+                    ],
+                )
+            except ClientError as e:
+                logger.error(f"Visibility could not be extended: {e}")
+                continue
+            deadline = time.monotonic() + self.visibility_timeout
+            with self.in_flight_lock:
+                for handle in batch:
+                    if handle in self.in_flight:
+                        self.in_flight[handle] = deadline
+
+    def release(self, receipt_handles):
+        """Makes messages that won't be handled visible on the queue again
+        straight away."""
+        with self.in_flight_lock:
+            for handle in receipt_handles:
+                self.in_flight.pop(handle, None)
+        for start in range(0, len(receipt_handles), sqs_batch_entries):
+            batch = receipt_handles[start:start + sqs_batch_entries]
+            try:
+                self.sqs_client.change_message_visibility_batch(
+                    QueueUrl=self.queue_url,
+                    Entries=[
+                        {"Id": str(number), "ReceiptHandle": handle,
+                         "VisibilityTimeout": 0}
+                        for number, handle in enumerate(batch)
+                    ],
+                )
+            except ClientError as e:
+                logger.error(f"Messages could not be released: {e}")
+
+    def release_buffered(self):
+        """Releases every message still waiting in the buffer."""
+        handles = []
+        while True:
+            try:
+                handles.append(self.buffer.get_nowait()["ReceiptHandle"])
+            except queue.Empty:
+                break
+        self.release(handles)
+
+    def ack(self, message):
+        """Marks a message as handled so that it is deleted."""
+        self.acks.put(message.receipt_handle)
+
+    def nack(self, message):
+        """Makes a message visible on the queue again after retry_delay
+        seconds."""
+        self.nack_handle(message.receipt_handle)
+
+    def nack_handle(self, receipt_handle):
+        with self.in_flight_lock:
+            self.in_flight.pop(receipt_handle, None)
+        try:
+            self.sqs_client.change_message_visibility(
+                QueueUrl=self.queue_url,
+                ReceiptHandle=receipt_handle,
+                VisibilityTimeout=self.retry_delay,
+            )
+        except ClientError as e:
+            logger.error(f"Message could not be released: {e}")
+
+    def delete_acked(self):
+        """Deletes acked messages in batches of up to 10, sending a partial
+        batch once no more acks arrive for a short while."""
+        batch = []
+        while True:
+            try:
+                batch.append(self.acks.get(timeout=0.5))
+            except queue.Empty:
+                if batch:
+                    self.delete_batch(batch)
+                    batch = []
+                elif self.stopping.is_set():
+                    return
+                continue
+            if len(batch) == sqs_batch_entries:
+                self.delete_batch(batch)
+                batch = []
+
+    def delete_batch(self, receipt_handles):
+        try:
+            response = self.sqs_client.delete_message_batch(
+                QueueUrl=self.queue_url,
+                Entries=[
+                    {"Id": str(number), "ReceiptHandle": handle}
+                    for number, handle in enumerate(receipt_handles)
+                ],
+            )
+        except ClientError as e:
+            logger.error(f"Messages could not be deleted: {e}")
+            return
+        for failure in response.get("Failed", []):
+            logger.error(f"Message could not be deleted: {failure}")
+        with self.in_flight_lock:
+            for handle in receipt_handles:
+                self.in_flight.pop(handle, None)
+            self.deleted += len(response.get("Successful", []))
+
+    def next_message(self, timeout=0.5):
+        """Returns the next buffered message, or None once the consumer has
+        been stopped, or has finished and the buffer is empty.
+
+        A message whose body can't be decoded is logged and released for
+        a retry after retry_delay seconds, leaving it to the queue's
+        redrive policy to dead letter it if it never decodes.
+        """
+        while not self.stopping.is_set():
+            try:
+                message = self.buffer.get(timeout=timeout)
+            except queue.Empty:
+                if self.finished():
+                    return None
+                continue
+            try:
+                body = decode_body(message, self.s3_client)
+            except Exception as e:
+                logger.error(
+                    f"Message {message['MessageId']} could not be decoded: "
+                    f"{e}")
+                self.nack_handle(message["ReceiptHandle"])
+                continue
+            sent_at = message.get("Attributes", {}).get("SentTimestamp")
+            consumed = ConsumedMessage(
+                body,
+                message["MessageId"],
+                message["ReceiptHandle"],
+                {
+                    name: value.get("StringValue")
+                    for name, value in message.get(
+                        "MessageAttributes", {}).items()
+                },
+                int(sent_at) / 1000 if sent_at else None,
+            )
+            self.freshness.record(consumed)
+            return consumed
+        return None
+
+    def close(self):
+        """Stops polling, releases the messages still buffered back to the
+        queue and waits for acked messages to be deleted."""
+        self.stop()
+        for thread in self.pollers:
+            thread.join()
+        self.release_buffered()
+        for thread in self.background:
+            thread.join()
+
+    def __iter__(self):
+        """Yields messages until the consumer finishes. Each message is
+        acked when the next one is asked for, so a message is only deleted
+        once the loop body has handled it."""
+        self.start()
+        try:
+            while True:
+                message = self.next_message()
+                if message is None:
+                    return
+                yield message
+                self.ack(message)
+        finally:
+            self.close()
+
+    def run(self, handler, handler_threads=None):
+        """Calls handler(message) for every message from a pool of
+        threads. Messages are acked when the handler returns and released
+        back to the queue (after retry_delay seconds) when it raises.
+
+        Returns:
+             The number of messages handled successfully.
+        """
+        handled = 0
+        handled_lock = threading.Lock()
+
+        def handle():
+            nonlocal handled
+            while True:
+                message = self.next_message()
+                if message is None:
+                    return
+                try:
+                    handler(message)
+                except Exception as e:
+                    logger.error(f"Message {message.message_id} failed: {e}")
+                    self.nack(message)
+                    continue
+                self.ack(message)
+                with handled_lock:
+                    handled += 1
+
+        self.start()
+        threads = [
+            threading.Thread(target=handle, daemon=True)
+            for _ in range(handler_threads or self.workers)
+        ]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            self.close()
+        return handled
+
+    def run_by_reference(self, handlers, default=None, handler_threads=None):
+        """Runs a shared queue, passing each message to the handler for its
+        reference attribute, or to default. Messages for a reference with
+        no handler and no default are released back to the queue for
+        another consumer.
+
+        Returns:
+             The number of messages handled successfully.
+        """
+        def demultiplex(message):
+            handler = handlers.get(message.reference, default)
+            if handler is None:
+                raise LookupError(
+                    f"No handler for reference {message.reference}")
+            handler(message)
+
+        return self.run(demultiplex, handler_threads)
+
+
+def shared_queue_consumers(sqs_client=None, count=None, prefix=None,
+                           **options):
+    """Returns a QueueConsumer for every shared queue, so that a fixed
+    consumer fleet can serve any number of references."""
+    sqs_client = sqs_client or stream.get_client("sqs")
+    count = count or stream.shared_queue_count
+    prefix = prefix or stream.shared_queue_prefix
+    return [
+        QueueConsumer(
+            sqs_client.get_queue_url(
+                QueueName=f"{prefix}-{shard}")["QueueUrl"],
+            sqs_client=sqs_client, **options)
+        for shard in range(count)
+    ]
@@ -0,0 +1,250 @@
+import argparse
+import csv
+import json
+import logging
+import multiprocessing
+import multiprocessing.util
+import sys
+import time
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    wait,
+    FIRST_COMPLETED
+)
+from src import stream
+from src.service import StreamService
+
+logger = logging.getLogger()
+
+
+class SharedRateGovernor(stream.RateGovernor):
+    """A RateGovernor whose bucket is kept in shared memory, so that every
+    process of a pool draws from the same rate. It has to be handed to the
+    pool's processes as they start (see init_worker)."""
+
+    def __init__(self, rate, burst=1, context=None):
+        context = context or multiprocessing.get_context()
+        self.rate = rate
+        self.burst = burst
+        # tokens and the monotonic time they were last topped up
+        self.bucket = context.Array("d", [burst, time.monotonic()])
+
+    def wait_time(self):
+        with self.bucket.get_lock():
+            tokens, updated = self.bucket
+            now = time.monotonic()
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / self.rate
+            if not wait:
+                tokens -= 1
+            self.bucket[:] = [tokens, now]
+            return wait
+
+
+def read_specs(source, spec_format=None, defaults=None):
+    """Yields (line, event) for every search spec in a CSV or NDJSON file,
+    or in stdin when source is "-". The format is taken from the file's
+    extension unless it is given; stdin defaults to NDJSON. CSV columns
+    are event fields, and empty cells are left out. Fields missing from a
+    spec are taken from defaults.
+
+    A line that can't be parsed is yielded with an event of None.
+    """
+    if spec_format is None:
+        spec_format = "csv" if source.endswith(".csv") else "ndjson"
+    f = sys.stdin if source == "-" else open(source, newline="")
+    try:
+        if spec_format == "csv":
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield reader.line_num, {
+                    **(defaults or {}),
+                    **{field: value for field, value in row.items() if value},
+                }
+            return
+        for line, text in enumerate(f, start=1):
+            if not text.strip():
+                continue
+            try:
+                yield line, {**(defaults or {}), **json.loads(text)}
+            except ValueError:
+                yield line, None
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+worker_service = None
+worker_handler = None
+
+
+def init_worker(governor, api_key, handler=None):
+    """Sets up a pool process: every api call goes through the shared
+    governor, and specs run on a StreamService with the run's api key, so
+    publishers, aws clients and the archive stay open for the life of the
+    process. The archive is closed as the process exits, once the pool
+    has been drained."""
+    global worker_service, worker_handler
+    stream.rate_governor = governor
+    stream.cache_clients()
+    stream.open_shared_archive()
+    multiprocessing.util.Finalize(None, stream.close_shared_archive,
+                                  exitpriority=10)
+    worker_service = StreamService(workers=1, api_key=api_key)
+    worker_handler = handler
+
+
+def run_spec(event):
+    """Runs one spec in a pool process.
+
+    Returns:
+         None if it ran, otherwise why it failed.
+    """
+    try:
+        if worker_handler is not None:
+            worker_handler(event)
+        else:
+            worker_service.run_job(event)
+    except (Exception, SystemExit) as e:
+        return str(e) or type(e).__name__
+
+
+class BulkRunner:
+    """Runs search specs (the events lambda_handler takes) across a pool of
+    processes, for bulk loads too big for lambda's concurrency.
+
+    Every process shares one Guardian api rate (see SharedRateGovernor) and
+    the api key is fetched once for the run. At most processes * 2 specs
+    are queued at a time, so specs can be streamed from a file of any
+    size. Progress is written to progress every progress_interval seconds.
+    """
+
+    def __init__(self, processes=None, requests_per_second=None,
+                 api_key=None, progress=None, progress_interval=1.0,
+                 handler=None):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.requests_per_second = (requests_per_second
+                                    or stream.requests_per_second)
+        self.api_key = api_key
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self.handler = handler
+        self.completed = 0
+        self.failures = []
+        self.started = None
+        self.reported = None
+
+    def run(self, specs):
+        """Runs (line, event) specs, as read_specs yields them.
+
+        Returns:
+             A summary of the run, with the line and error of every spec
+             that failed.
+        """
+        self.started = self.reported = time.monotonic()
+        if self.handler is None:
+            self.api_key = self.api_key or stream.get_api_key()
+        context = multiprocessing.get_context()
+        governor = SharedRateGovernor(self.requests_per_second,
+                                      context=context)
+        running = {}
+        with ProcessPoolExecutor(
+            self.processes, mp_context=context, initializer=init_worker,
+            initargs=(governor, self.api_key, self.handler)
+        ) as executor:
+            for line, event in specs:
+                if event is None:
+                    self.failures.append(
+                        {"line": line, "error": "Spec could not be parsed"})
+                    continue
+                if len(running) >= self.processes * 2:
+                    self.finish(running)
+                running[executor.submit(run_spec, event)] = line
+            while running:
+                self.finish(running)
+        self.report(force=True)
+        return self.summary()
+
+    def finish(self, running):
+        """Waits for at least one running spec to finish and counts it."""
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            line = running.pop(future)
+            error = future.result()
+            if error is None:
+                self.completed += 1
+            else:
+                logger.error(f"Spec on line {line} failed: {error}")
+                self.failures.append({"line": line, "error": error})
+        self.report()
+
+    def report(self, force=False):
+        now = time.monotonic()
+        if self.progress is None or (
+                not force and now - self.reported < self.progress_interval):
+            return
+        self.reported = now
+        elapsed = now - self.started
+        rate = (self.completed + len(self.failures)) / elapsed if elapsed \
+            else 0.0
+        self.progress.write(
+            f"\r{self.completed} specs run, {len(self.failures)} failed, "
+            f"{rate:.1f} specs/s" + ("\n" if force else ""))
+        self.progress.flush()
+
+    def summary(self):
+        elapsed = time.monotonic() - self.started
+        summary = {
+            "completed": self.completed,
+            "failed": len(self.failures),
+            "processes": self.processes,
+            "seconds": round(elapsed, 3),
+            "specs_per_second": round(
+                (self.completed + len(self.failures)) / elapsed, 2)
+            if elapsed else 0.0,
+            "failures": self.failures,
+        }
+        stream.emit_metric("RunnerSpecs",
+                           self.completed + len(self.failures), "Count",
+                           mode="runner")
+        return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Runs search specs from a CSV or NDJSON file (or stdin) "
+                    "across a process pool.")
+    parser.add_argument("source", nargs="?", default="-",
+                        help="path of the specs, or - for stdin")
+    parser.add_argument("--format", choices=["csv", "ndjson"],
+                        help="format of the specs, by default taken from "
+                             "the file's extension")
+    parser.add_argument("--reference",
+                        help="reference for specs that don't give one")
+    parser.add_argument("--processes", type=int,
+                        help="how many processes run specs")
+    parser.add_argument("--requests-per-second", type=float,
+                        help="Guardian api rate shared by every process")
+    parser.add_argument("--api-key",
+                        help="Guardian api key, instead of reading it from "
+                             "secrets manager")
+    parser.add_argument("--summary",
+                        help="path to write the run summary to, instead "
+                             "of stdout")
+    args = parser.parse_args(argv)
+
+    defaults = {"reference": args.reference} if args.reference else None
+    runner = BulkRunner(processes=args.processes,
+                        requests_per_second=args.requests_per_second,
+                        api_key=args.api_key, progress=sys.stderr)
+    summary = runner.run(read_specs(args.source, args.format, defaults))
+    if args.summary:
+        with open(args.summary, "w") as f:
+            json.dump(summary, f, indent=2)
+    else:
+        print(json.dumps(summary))
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,218 @@
+import argparse
+import contextlib
+import json
+import logging
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from src.consumer import QueueConsumer
+from src.stream import (
+    GuardianApiInfo,
+    dispatch_event,
+    emit_metric,
+    get_api_key,
+    get_api_response_articles,
+    get_publisher,
+    handle_request,
+    keep_archive_open,
+    publish_search,
+    warm_clients,
+)
+
+logger = logging.getLogger()
+
+
+class JobFailed(Exception):
+    """A job stopped with SystemExit, which the stream functions raise for
+    api and aws errors. It is turned into an exception so that the
+    scheduler carries on with other jobs."""
+
+
+class StreamService:
+    """A long running alternative to the lambda function for container
+    deployments.
+
+    Jobs are the same events lambda_handler takes. They are read from an
+    sqs input queue (see run_queue) or an NDJSON file (see run_file) and
+    run concurrently by a pool of workers. The api key is fetched once, and
+    publishers (and so their queues), aws clients, seen filters and the
+    idempotency store stay warm between jobs, and every job archives to
+    one sink (see keep_archive_open), closed when the service stops.
+    Searches publish without viewing the queue afterwards.
+
+    stop() (called on SIGTERM or SIGINT) stops new jobs being taken and
+    lets the jobs already started finish. Queued jobs that were prefetched
+    but not started are released back to the queue.
+    """
+
+    def __init__(self, workers=8, api_key=None):
+        self.workers = workers
+        self.api_key = api_key
+        self.publishers = {}
+        self.publishers_lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.consumer = None
+        self.completed = 0
+        self.failed = 0
+        self.counts_lock = threading.Lock()
+        self.started = None
+
+    def get_api_key(self):
+        if self.api_key is None:
+            self.api_key = get_api_key()
+        return self.api_key
+
+    def publisher(self, info):
+        key = (info.reference, info.fifo, info.partitions,
+               info.partition_key)
+        with self.publishers_lock:
+            if key not in self.publishers:
+                self.publishers[key] = get_publisher(*key)
+            return self.publishers[key]
+
+    def handle(self, request, context=None):
+        """Runs a validated job, reusing the warm api key and publishers."""
+        if isinstance(request, GuardianApiInfo) and request.mode == "search":
+            payload = {"api-key": self.get_api_key(),
+                       "q": request.search_term,
+                       "from-date": request.date_from,
+                       "to-date": request.date_to}
+            articles = get_api_response_articles(payload).results
+            publish_search(request, self.publisher(request), articles,
+                           time.time())
+            return {"result": "complete", "reference": request.reference}
+        return handle_request(request, context, self.get_api_key())
+
+    def run_job(self, event, idempotency_key=None):
+        """Runs one job event, raising JobFailed if it fails.
+
+        Returns:
+             The job's result, as lambda_handler would return it.
+        """
+        if idempotency_key and isinstance(event, dict):
+            event = {"idempotency_key": idempotency_key, **event}
+        try:
+            result = dispatch_event(event, None, self.handle)
+        except SystemExit as e:
+            self.count(failed=1)
+            raise JobFailed(str(e)) from e
+        if isinstance(result, dict) and result.get("result") == "error":
+            self.count(failed=1)
+            raise JobFailed(json.dumps(result, default=str))
+        self.count(completed=1)
+        return result
+
+    def count(self, completed=0, failed=0):
+        with self.counts_lock:
+            self.completed += completed
+            self.failed += failed
+
+    def stop(self, *args):
+        """Stops taking new jobs; jobs already started are finished and
+        prefetched jobs are released back to the queue."""
+        logger.info("STREAM SERVICE DRAINING")
+        self.stopping.set()
+        if self.consumer is not None:
+            self.consumer.stop()
+
+    @contextlib.contextmanager
+    def signal_handlers(self):
+        """Drains on SIGTERM and SIGINT while running, when running in the
+        main thread (the only one signal handlers can be set from)."""
+        if threading.current_thread() is not threading.main_thread():
+            yield
+            return
+        previous = {number: signal.signal(number, self.stop)
+                    for number in (signal.SIGTERM, signal.SIGINT)}
+        try:
+            yield
+        finally:
+            for number, handler in previous.items():
+                signal.signal(number, handler)
+
+    def run_queue(self, queue_url, **options):
+        """Runs the job events sent to an sqs queue until stopped. A job
+        is deleted from the queue once it has run, and released for a
+        retry if it fails. A job's sqs message id is its idempotency key,
+        so a redelivered job isn't run twice.
+
+        Returns:
+             A summary of the jobs run.
+        """
+        self.started = time.monotonic()
+        options.setdefault("workers", 2)
+        with warm_clients(), keep_archive_open(), self.signal_handlers():
+            self.consumer = QueueConsumer(queue_url, **options)
+            if self.stopping.is_set():
+                self.consumer.stop()
+            self.consumer.run(
+                lambda message: self.run_job(message.json(),
+                                             message.message_id),
+                handler_threads=self.workers)
+        return self.summary()
+
+    def run_file(self, path):
+        """Runs the job events in an NDJSON file, one event a line, with at
+        most workers at a time, until the file is done or the service is
+        stopped.
+
+        Returns:
+             A summary of the jobs run.
+        """
+        self.started = time.monotonic()
+        running = set()
+        with warm_clients(), keep_archive_open(), self.signal_handlers(), \
+                open(path) as f, ThreadPoolExecutor(self.workers) as executor:
+            for line in f:
+                if self.stopping.is_set():
+                    break
+                if not line.strip():
+                    continue
+                if len(running) >= self.workers * 2:
+                    _, running = wait(running, return_when=FIRST_COMPLETED)
+                running.add(executor.submit(self.run_file_job, line))
+        return self.summary()
+
+    def run_file_job(self, line):
+        try:
+            self.run_job(json.loads(line))
+        except (JobFailed, ValueError) as e:
+            logger.error(f"Job failed: {e}")
+
+    def summary(self):
+        elapsed = time.monotonic() - self.started
+        summary = {
+            "completed": self.completed,
+            "failed": self.failed,
+            "seconds": round(elapsed, 3),
+            "jobs_per_second": round(
+                (self.completed + self.failed) / elapsed, 2)
+            if elapsed else 0.0,
+        }
+        emit_metric("ServiceJobs", self.completed + self.failed, "Count",
+                    mode="service")
+        logger.info(f"STREAM SERVICE RAN {summary}")
+        return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Runs stream jobs from an sqs queue or an NDJSON file.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--queue", help="url of the sqs queue of jobs")
+    source.add_argument("--file", help="path of an NDJSON file of jobs")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="how many jobs run at once")
+    args = parser.parse_args(argv)
+
+    service = StreamService(workers=args.workers)
+    if args.queue:
+        summary = service.run_queue(args.queue)
+    else:
+        summary = service.run_file(args.file)
+    print(json.dumps(summary))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,67 @@
 import re._compiler
+import asyncio
+import contextlib
 import requests
 import requests.exceptions
 import json
 import re
+import os
+import hashlib
+import heapq
+import threading
+import uuid
+import math
+import random
+import struct
+import sys
+import cProfile
+import fcntl
+import tracemalloc
+from collections import deque
 import boto3
 from botocore.exceptions import ClientError
 import logging
 import time
-from pydantic import BaseModel, ValidationError, field_validator
-from typing import Optional
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed
+)
+from datetime import date, datetime, timedelta, timezone
+from pydantic import (
+    BaseModel,
+    TypeAdapter,
+    ValidationError,
+    field_validator,
+    model_validator
+)
+from pydantic.dataclasses import dataclass as pydantic_dataclass
+from typing import Literal, Optional
+
+try:
+    from kafka import KafkaProducer
+    from kafka.errors import KafkaError
+except ImportError:
+    KafkaProducer = None
+    KafkaError = Exception
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 logger = logging.getLogger()
 
@@ -16,6 +69,147 @@ logging.getLogger().setLevel(logging.INFO)
 
 base_url = "https://content.guardianapis.com/search"
 
+# Guardian developer keys are limited to one call per second, so every
+# request made by this module goes through a shared rate governor.
+requests_per_second = float(os.environ.get("GUARDIAN_REQUESTS_PER_SECOND", 1))
+
+# The result fields kept when a page of results is read (every field the
+# stream, the percolator and the archive use) and the pagination counters
+# read alongside them. Other fields are never built.
+result_fields = os.environ.get(
+    "RESULT_FIELDS",
+    "id,type,sectionId,sectionName,webPublicationDate,webTitle,webUrl,"
+    "apiUrl,pillarName,fields").split(",")
+page_counters = ["total", "currentPage", "pages"]
+
+# Backfill tuning: the largest page the Guardian API will serve, the most
+# articles a single date window may hold before it is split, how many
+# windows are fetched at once and where per-window checkpoints are kept.
+# Backfill checkpoints go to the checkpoints/ prefix of CHECKPOINT_BUCKET
+# when one is given, so they outlive the container.
+backfill_page_size = 200
+backfill_window_max = int(os.environ.get("BACKFILL_WINDOW_MAX", 2000))
+backfill_workers = int(os.environ.get("BACKFILL_WORKERS", 4))
+checkpoint_dir = os.environ.get("CHECKPOINT_DIR", "/tmp")
+checkpoint_bucket = os.environ.get("CHECKPOINT_BUCKET")
+
+# Stop starting new work when the invocation has less time than this left
+timeout_margin_ms = 15000
+
+# The seen-article filter stops articles being published to a reference
+# more than once. Snapshots are kept in checkpoint_dir and, when a bucket is
+# given, in S3 (or any S3 compatible store at the endpoint url).
+seen_filter_enabled = os.environ.get("SEEN_FILTER_ENABLED", "false") == "true"
+seen_filter_error_rate = float(os.environ.get("SEEN_FILTER_ERROR_RATE", 0.001))
+seen_filter_capacity = int(os.environ.get("SEEN_FILTER_CAPACITY", 10000))
+seen_filter_bucket = os.environ.get("SEEN_FILTER_BUCKET")
+seen_filter_endpoint_url = os.environ.get("SEEN_FILTER_ENDPOINT_URL")
+
+# SendMessageBatch takes at most 10 messages and 256 KiB in total, and a
+# FIFO queue serves at most 300 messages a second for each message group
+sqs_batch_entries = 10
+sqs_batch_bytes = 262144
+fifo_group_messages_per_second = 300
+
+# Backpressure: once a queue holds this many messages, publishing to it is
+# slowed to backpressure_slow_rate messages a second, articles are
+# coalesced into fewer, larger messages, or messages are spilled to a spill
+# store (SPILL_BUCKET, or checkpoint_dir) until the queue drains. 0 turns a
+# stage off. Queue depths are sampled at most every queue_depth_ttl seconds.
+backpressure_slow_depth = int(os.environ.get("BACKPRESSURE_SLOW_DEPTH", 0))
+backpressure_coalesce_depth = int(
+    os.environ.get("BACKPRESSURE_COALESCE_DEPTH", 0))
+backpressure_spill_depth = int(os.environ.get("BACKPRESSURE_SPILL_DEPTH", 0))
+backpressure_slow_rate = float(os.environ.get("BACKPRESSURE_SLOW_RATE", 10))
+queue_depth_ttl = 30
+spill_bucket = os.environ.get("SPILL_BUCKET")
+
+# In shared queue mode plain sqs references publish to a fixed set of
+# shared_queue_count queues named <prefix>-<shard>, chosen by a hash of the
+# reference, instead of a queue each. 0 turns shared queues off.
+shared_queue_count = int(os.environ.get("SHARED_QUEUE_COUNT", 0))
+shared_queue_prefix = os.environ.get("SHARED_QUEUE_PREFIX", "stream_shared")
+
+# The version of the message body layout, sent as a message attribute
+schema_version = 1
+
+# SNS PublishBatch and EventBridge PutEvents take at most 10 entries and
+# 256 KiB in total
+sns_batch_entries = 10
+sns_batch_bytes = 262144
+event_bus_source = "guardian.stream"
+
+# Kinesis PutRecords takes at most 500 records and 5 MiB in total
+kinesis_batch_records = 500
+kinesis_batch_bytes = 5242880
+kafka_bootstrap_servers = os.environ.get("KAFKA_BOOTSTRAP_SERVERS",
+                                         "localhost:9092")
+kafka_send_timeout = 30
+
+# The memory and file backends write inside the running process, and a file
+# reference picks any path to write to, so events may only select them when
+# local backends are enabled. They are off by default inside Lambda.
+local_backends = {"memory", "file"}
+local_backends_enabled = os.environ.get(
+    "LOCAL_BACKENDS_ENABLED",
+    "false" if "AWS_LAMBDA_FUNCTION_NAME" in os.environ else "true"
+) == "true"
+
+# Idempotency records stop a retried event publishing twice. The store is
+# "memory", "file", "dynamodb" or "none"; records of an event in progress
+# expire after the lock time in case the invocation dies.
+idempotency_store_type = os.environ.get("IDEMPOTENCY_STORE", "memory")
+idempotency_table = os.environ.get("IDEMPOTENCY_TABLE", "stream_idempotency")
+idempotency_endpoint_url = os.environ.get("IDEMPOTENCY_ENDPOINT_URL")
+idempotency_ttl = int(os.environ.get("IDEMPOTENCY_TTL", 3600))
+idempotency_lock_seconds = 150
+
+# Saved searches polled by "schedule" events are kept in a registry, a
+# json file in checkpoint_dir ("file") or a DynamoDB table ("dynamodb").
+# Each tick spends a share of the Guardian api's daily quota, and every
+# search is polled between the min and max interval (in seconds), aiming
+# for about schedule_target_articles new articles a poll.
+registry_store_type = os.environ.get("REGISTRY_STORE", "file")
+registry_table = os.environ.get("REGISTRY_TABLE", "stream_registry")
+registry_endpoint_url = os.environ.get("REGISTRY_ENDPOINT_URL")
+guardian_daily_quota = int(os.environ.get("GUARDIAN_DAILY_QUOTA", 500))
+schedule_min_interval = int(os.environ.get("SCHEDULE_MIN_INTERVAL", 60))
+schedule_max_interval = int(os.environ.get("SCHEDULE_MAX_INTERVAL", 86400))
+schedule_target_articles = 5
+schedule_rate_smoothing = 0.3
+# The most pages of results one poll reads to catch up with its watermark
+schedule_max_pages = 5
+
+# Fetched articles are also archived as Parquet files when
+# ARCHIVE_DESTINATION is set, to an "s3://bucket/prefix" or a local
+# directory. Files are rolled once they reach archive_file_bytes and are
+# uploaded to S3 in parts of archive_part_bytes (at least 5 MiB).
+archive_destination = os.environ.get("ARCHIVE_DESTINATION")
+archive_file_bytes = int(os.environ.get("ARCHIVE_FILE_BYTES", 134217728))
+archive_part_bytes = 8388608
+archive_batch_rows = 10000
+
+# Metrics are written as CloudWatch embedded metric format log lines
+metric_namespace = os.environ.get("METRIC_NAMESPACE", "stream_metric")
+
+# Every message carries a trace id and the times its articles were fetched
+# and enqueued. Unless FRESHNESS_METRICS_ENABLED is "false", publishing a
+# search also emits how stale its articles were, per search term.
+freshness_metrics_enabled = os.environ.get(
+    "FRESHNESS_METRICS_ENABLED", "true") == "true"
+
+# An invocation is profiled when its event has a "profile" field, or for a
+# PROFILE_SAMPLE_RATE share of invocations. PROFILE_MODE is "cprofile"
+# (a pstats file) or "sampling" (a speedscope file of every thread's
+# stacks, sampled every profile_interval seconds). Profiles and memory
+# reports are written to PROFILE_DIR and uploaded to PROFILE_BUCKET.
+profile_sample_rate = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+profile_mode = os.environ.get("PROFILE_MODE", "cprofile")
+profile_dir = os.environ.get("PROFILE_DIR", "/tmp/profiles")
+profile_bucket = os.environ.get("PROFILE_BUCKET")
+profile_interval = 0.005
+profile_memory_sites = 20
+
 
 class GuardianApiInfo(BaseModel):
     """This is the Pydantic base model for the event being passed to the lambda
@@ -28,9 +222,14 @@ class GuardianApiInfo(BaseModel):
     """
     search_term: str
     date_from: Optional[str] = None
+    date_to: Optional[str] = None
     reference: str
+    mode: Literal["search", "backfill"] = "search"
+    fifo: bool = False
+    partitions: int = 0
+    partition_key: Literal["id", "section"] = "id"
 
-    @field_validator("date_from")
+    @field_validator("date_from", "date_to")
     @classmethod
     def date_is_correct(cls, v):
         if v:
@@ -42,8 +241,97 @@ class GuardianApiInfo(BaseModel):
     @classmethod
     def format_reference(cls, v):
         formatted_reference = v.replace(" ", "_")
+        backend, _, destination = formatted_reference.partition(":")
+        if (destination and backend in local_backends
+                and not local_backends_enabled):
+            raise ValueError(f"The {backend} backend is not enabled")
         return formatted_reference
 
+    @model_validator(mode="after")
+    def backfill_has_date_from(self):
+        if self.mode == "backfill" and not self.date_from:
+            raise ValueError("A backfill requires a date_from")
+        return self
+
+
+class CoordinatorPlan(BaseModel):
+    """The event for a coordinator invocation: a list of searches, each of
+    which is split into date shards and fanned out to worker invocations.
+    """
+    searches: list[GuardianApiInfo]
+    shards_per_search: int = 4
+    tasks_per_worker: int = 1
+    wait_seconds: int = 90
+
+
+class PercolatePlan(BaseModel):
+    """The event for a percolator invocation: every saved search to match
+    against the latest content, and how many pages of it to read."""
+    queries: list[GuardianApiInfo]
+    max_pages: int = 5
+
+
+class BatchPlan(BaseModel):
+    """The event for a batch invocation: several searches run together and
+    deduplicated before publishing."""
+    searches: list[GuardianApiInfo]
+
+
+class SavedSearch(GuardianApiInfo):
+    """A search kept in the registry and polled by the scheduler. Searches
+    with a higher priority are polled more often, and run first when the
+    quota runs short. The remaining fields are the search's schedule,
+    updated after every poll."""
+    priority: int = 1
+    interval: float = 0
+    next_run: float = 0
+    last_run: Optional[float] = None
+    rate: float = 0
+    watermark: str = ""
+
+    @field_validator("priority")
+    @classmethod
+    def priority_is_positive(cls, v):
+        if v < 1:
+            raise ValueError("Priority must be at least 1")
+        return v
+
+    @property
+    def search_id(self):
+        return f"{self.reference}:{self.search_term}"
+
+
+# The fields of a saved search that belong to the scheduler
+schedule_fields = ["interval", "next_run", "last_run", "rate", "watermark"]
+
+
+class SchedulePlan(BaseModel):
+    """The event for a scheduler tick. Searches in add are added to the
+    registry, or update the search with the same reference and term, and
+    searches whose ids ("<reference>:<search_term>") are in remove are
+    removed, before the due searches are run."""
+    add: list[SavedSearch] = []
+    remove: list[str] = []
+
+
+class WorkerPlan(BaseModel):
+    """The event for a worker invocation, as built by the coordinator."""
+    run_id: str
+    worker: int
+    tasks: list[GuardianApiInfo]
+    requests_per_second: float = requests_per_second
+    completion_queue: Optional[str] = None
+
+
+# The event model for each mode; anything else is a GuardianApiInfo
+event_models = {
+    "coordinator": CoordinatorPlan,
+    "worker": WorkerPlan,
+    "percolate": PercolatePlan,
+    "batch": BatchPlan,
+    "schedule": SchedulePlan,
+}
+
 
 def is_valid_date(date):
     """Checks if an inputted date is a valid year, month and year
@@ -59,6 +347,80 @@ def is_valid_date(date):
     return bool(date_regex.match(date))
 
 
+# Factories for aws clients registered with register_client, by service
+client_factories = {}
+
+
+def register_client(service, factory):
+    """Makes get_client build clients for an aws service with
+    factory(**options) instead of boto3, e.g. to use an in-process fake in
+    benchmarks. A factory of None goes back to boto3."""
+    if factory is None:
+        client_factories.pop(service, None)
+    else:
+        client_factories[service] = factory
+
+
+def get_client(service, **options):
+    """Returns a client for an aws service: one from the factory
+    registered for the service, otherwise a boto3 client in eu-west-2
+    (with any other options given, such as an endpoint_url)."""
+    factory = client_factories.get(service)
+    if factory is not None:
+        return factory(**options)
+    return boto3.client(service, region_name="eu-west-2", **options)
+
+
+# The aws services the stream and its consumers use
+aws_services = ("sqs", "sns", "s3", "secretsmanager", "dynamodb", "events",
+                "kinesis", "lambda")
+
+
+class ClientCache:
+    """A client factory that builds one boto3 client for each set of
+    options and hands it out again, so its connection pool stays warm.
+    boto3 clients are safe to share between threads."""
+
+    def __init__(self, service):
+        self.service = service
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, **options):
+        key = tuple(sorted(options.items()))
+        with self.lock:
+            if key not in self.clients:
+                self.clients[key] = boto3.client(
+                    self.service, region_name="eu-west-2", **options)
+            return self.clients[key]
+
+
+def cache_clients(services=aws_services):
+    """Registers a ClientCache for each service that has no other factory
+    registered.
+
+    Returns:
+         The services it registered a cache for.
+    """
+    cached = [service for service in services
+              if service not in client_factories]
+    for service in cached:
+        register_client(service, ClientCache(service))
+    return cached
+
+
+@contextlib.contextmanager
+def warm_clients(services=aws_services):
+    """Reuses aws clients (see cache_clients) while the context is open,
+    for long running processes."""
+    cached = cache_clients(services)
+    try:
+        yield
+    finally:
+        for service in cached:
+            register_client(service, None)
+
+
 def get_api_key():
     """This function searches the aws secrets manager for the guardian api key
 
@@ -67,7 +429,7 @@ def get_api_key():
     """
 
     secret_name = "guardian_api_key"
-    secrets_client = boto3.client("secretsmanager", region_name="eu-west-2")
+    secrets_client = get_client("secretsmanager")
 
     try:
         get_secret_value = secrets_client.get_secret_value(
@@ -81,11 +443,11 @@ def get_api_key():
             logger.error(f"The [{secret_name}] could not be found")
 
 
-def get_api_response_json(payload):
-    """This fuctions makes an api call using requests.get and a given url.
+def send_api_request(payload):
+    """This function makes an api call using requests.get and a given url.
 
     Returns:
-         The results of the api call in json format.
+         The response of the api call.
     """
     try:
         response = requests.get(base_url, params=payload, timeout=5)
@@ -100,9 +462,222 @@ def get_api_response_json(payload):
     except requests.exceptions.RequestException as err:
         raise SystemExit(f'"Sorry there seems to be an issue:",{err}')
 
-    else:
-        if response.status_code == 200:
-            return response.json()["response"]["results"]
+    return response
+
+
+def get_api_response_json(payload):
+    """This fuctions makes an api call using requests.get and a given url.
+
+    Returns:
+         The results of the api call in json format.
+    """
+    response = send_api_request(payload)
+    if response.status_code == 200:
+        return response.json()["response"]["results"]
+
+
+def get_api_response_body(payload, governor=None):
+    """Makes an api call governed by governor, by default the module's
+    shared rate_governor.
+
+    Returns:
+         The raw bytes of the response body.
+    """
+    (governor or rate_governor).acquire()
+    return send_api_request(payload).content
+
+
+class RateGovernor:
+    """A thread safe token bucket shared by every Guardian api call.
+
+    Callers block in acquire() until a token is available, so any number
+    of worker threads together never exceed the given rate.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while wait := self.wait_time():
+            time.sleep(wait)
+
+    def wait_time(self):
+        """Takes a token if one is available and returns 0, otherwise
+        returns how long to wait before trying again."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    async def acquire_async(self):
+        """acquire() for coroutines, sleeping without blocking the event
+        loop."""
+        while wait := self.wait_time():
+            await asyncio.sleep(wait)
+
+
+rate_governor = RateGovernor(requests_per_second)
+
+
+def get_api_response_page(payload, governor=None):
+    """This function makes a rate governed api call for a single page of
+    results, read with extract_search_page and validated into Articles.
+
+    Returns:
+         The SearchPage for the response.
+    """
+    return validate_search_page(
+        extract_search_page(get_api_response_body(payload, governor)))
+
+
+# simdjson parsers can't be shared between threads
+simdjson_parsers = threading.local()
+
+
+def extract_search_page(body, fields=None):
+    """Reads a page of search results from an api response body, keeping
+    only the given result fields (result_fields by default) and the
+    pagination counters.
+
+    With pysimdjson installed the body is parsed on demand: the envelope
+    and the dropped fields are skipped over and only the kept values are
+    built as python objects. Without it the body is loaded with json and
+    then projected.
+
+    Returns:
+         A dict of the "results" and the total, currentPage and pages
+         counters.
+    """
+    fields = fields or result_fields
+    if simdjson is None:
+        response = json.loads(body)["response"]
+        page = {counter: response[counter] for counter in page_counters
+                if counter in response}
+        page["results"] = [
+            {field: result[field] for field in fields if field in result}
+            for result in response["results"]]
+        return page
+
+    if not hasattr(simdjson_parsers, "parser"):
+        simdjson_parsers.parser = simdjson.Parser()
+    response = simdjson_parsers.parser.parse(body)["response"]
+    page = {counter: response[counter] for counter in page_counters
+            if counter in response}
+    page["results"] = results = []
+    for result in response["results"]:
+        article = {}
+        for field in fields:
+            value = result.get(field)
+            if isinstance(value, simdjson.Object):
+                value = value.as_dict()
+            elif isinstance(value, simdjson.Array):
+                value = value.as_list()
+            if value is not None or field in result:
+                article[field] = value
+        results.append(article)
+    return page
+
+
+@pydantic_dataclass(slots=True)
+class Article:
+    """A Guardian search result, keeping only the fields the stream uses.
+
+    Articles are decoded straight from the api response bytes by
+    get_api_response_articles, or from the fields extract_search_page
+    kept by get_api_response_page, and every field is validated as they
+    are built, so a change to the api's results fails loudly rather than
+    as a KeyError later on. Fields can also be read like a dict, so
+    articles can go anywhere a result dict does.
+    """
+    id: str
+    webPublicationDate: str
+    webTitle: str
+    webUrl: str
+    type: Optional[str] = None
+    sectionId: Optional[str] = None
+    sectionName: Optional[str] = None
+    apiUrl: Optional[str] = None
+    pillarName: Optional[str] = None
+    fields: Optional[dict] = None
+
+    @field_validator("webPublicationDate")
+    @classmethod
+    def is_timestamp(cls, v):
+        if not re.fullmatch(r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}Z", v):
+            raise ValueError("webPublicationDate must be a UTC timestamp")
+        return v
+
+    def get(self, field, default=None):
+        value = getattr(self, field, None)
+        return default if value is None else value
+
+    def __getitem__(self, field):
+        value = self.get(field)
+        if value is None:
+            raise KeyError(field)
+        return value
+
+    def __contains__(self, field):
+        return self.get(field) is not None
+
+
+@pydantic_dataclass(slots=True)
+class SearchPage:
+    """The "response" of a search, with its results as Articles."""
+    results: list[Article]
+    total: int = 0
+    currentPage: int = 1
+    pages: int = 1
+
+
+@pydantic_dataclass(slots=True)
+class SearchResponse:
+    response: SearchPage
+
+
+search_response_adapter = TypeAdapter(SearchResponse)
+search_page_adapter = TypeAdapter(SearchPage)
+
+
+def get_api_response_articles(payload, governor=None):
+    """Makes a rate governed api call and decodes and validates the
+    response body in a single pass, straight into Articles.
+
+    Returns:
+         The SearchPage for the response.
+    """
+    return decode_search_response(get_api_response_body(payload, governor))
+
+
+def decode_search_response(body):
+    """Decodes and validates an api response body into a SearchPage."""
+    try:
+        return search_response_adapter.validate_json(body).response
+    except ValidationError as e:
+        raise unexpected_response(e)
+
+
+def validate_search_page(page):
+    """Validates a page read by extract_search_page into a SearchPage."""
+    try:
+        return search_page_adapter.validate_python(page)
+    except ValidationError as e:
+        raise unexpected_response(e)
+
+
+def unexpected_response(error):
+    return SystemExit(
+        f'"The api response was not as expected:", '
+        f'{error.errors(include_url=False)}')
 
 
 def format_api_response_message(api_result):
@@ -124,19 +699,156 @@ def format_api_response_message(api_result):
     return json.dumps(result_dict)
 
 
-def create_sqs_queue(reference):
+def format_article(article):
+    """Formats a single api result in the same way as
+    format_api_response_message.
+
+    Returns:
+       A dict of the relevant key value pairs from the result.
+    """
+    dict_keys = ["webPublicationDate", "webTitle", "webUrl"]
+    return {key: article[key] for key in dict_keys if key in article}
+
+
+# The fields kept by the formatters, and the prefix of every article's
+# webUrl, which the columnar formatter can strip
+formatted_fields = ["webPublicationDate", "webTitle", "webUrl"]
+guardian_web_url = "https://www.theguardian.com/"
+
+# One formatted article, given its fields already json encoded without
+# their surrounding quotes
+formatted_template = (
+    '{{"webPublicationDate": "{}", "webTitle": "{}", "webUrl": "{}"}}')
+
+
+def encoded_strings(column):
+    """json encodes a column of strings with a single json.dumps call,
+    returning each value without its quotes. An encoded value never holds
+    an unescaped quote, so '", "' only appears between values."""
+    if not column:
+        return []
+    return json.dumps(column)[2:-2].split('", "')
+
+
+def format_articles_columnar(articles, output="json", strip_url_prefix=False):
+    """Formats many api results column by column rather than article by
+    article, which is several times faster for large result sets.
+
+    Each of the formatted fields is pulled out into a column and
+    normalised in bulk. "json" output is the same as
+    format_api_response_message, "ndjson" is one article per line, and
+    "ipc" and "parquet" are an Arrow IPC stream and a Parquet file (these
+    need pyarrow) with webPublicationDate parsed into a timestamp. With
+    strip_url_prefix, webUrl is given as a path on the Guardian website.
+
+    Returns:
+       The formatted articles, as a string for "json" and "ndjson" or
+       bytes otherwise.
+    """
+    columns = {field: [article.get(field) for article in articles]
+               for field in formatted_fields}
+    if strip_url_prefix:
+        columns["webUrl"] = [
+            url.removeprefix(guardian_web_url) if url else url
+            for url in columns["webUrl"]]
+
+    if output in ("json", "ndjson"):
+        if not all(set(map(type, column)) <= {str}
+                   for column in columns.values()):
+            # Articles with a missing field fall back to the row formatter
+            rows = [
+                {field: columns[field][number] for field in formatted_fields
+                 if columns[field][number] is not None}
+                for number in range(len(articles))]
+            if output == "json":
+                return json.dumps(rows)
+            return "".join(f"{json.dumps(row)}\n" for row in rows)
+        rows = map(formatted_template.format,
+                   *(encoded_strings(columns[field])
+                     for field in formatted_fields))
+        if output == "json":
+            return f"[{', '.join(rows)}]"
+        return "".join(f"{row}\n" for row in rows)
+
+    if output not in ("ipc", "parquet"):
+        raise ValueError(f"Unknown output format: {output}")
+    if pyarrow is None:
+        raise SystemExit("pyarrow must be installed for Arrow output")
+
+    published = pyarrow.compute.strptime(
+        pyarrow.array(columns["webPublicationDate"], pyarrow.string()),
+        format="%Y-%m-%dT%H:%M:%SZ", unit="s", error_is_null=True)
+    table = pyarrow.table({
+        "webPublicationDate": published.cast(
+            pyarrow.timestamp("s", tz="UTC")),
+        "webTitle": pyarrow.array(columns["webTitle"], pyarrow.string()),
+        "webUrl": pyarrow.array(columns["webUrl"], pyarrow.string()),
+    })
+    sink = pyarrow.BufferOutputStream()
+    if output == "ipc":
+        with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+    else:
+        pyarrow.parquet.write_table(table, sink, compression="zstd")
+    return sink.getvalue().to_pybytes()
+
+
+def utc_timestamp(seconds=None):
+    """Formats a unix time (by default now) as an ISO 8601 UTC timestamp
+    to the millisecond. It is always 24 characters long."""
+    when = datetime.fromtimestamp(
+        time.time() if seconds is None else seconds, timezone.utc)
+    return when.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+def parse_timestamp(value):
+    """Parses an ISO 8601 timestamp, such as a webPublicationDate or one
+    made by utc_timestamp, into a unix time. Returns None for a missing
+    or malformed value."""
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def emit_metric(name, value, unit="None", **dimensions):
+    """Writes a metric to the logs in CloudWatch embedded metric format,
+    which CloudWatch turns into a metric without any api call."""
+    print(json.dumps({
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": metric_namespace,
+                "Dimensions": [list(dimensions)],
+                "Metrics": [{"Name": name, "Unit": unit}],
+            }],
+        },
+        name: value,
+        **dimensions,
+    }))
+
+
+def create_sqs_queue(reference, fifo=False):
     """Creates an sqs queue for the AWS user using the inputted reference.
       Messages within this queue are only allowed to persist for a
-      maximum of 3 days
+      maximum of 3 days.
+      A fifo queue is named <reference>.fifo and uses content based
+      deduplication.
 
     Returns:
          The url of the created queue.
     """
+    attributes = {"MessageRetentionPeriod": "259200"}
+    if fifo:
+        if not reference.endswith(".fifo"):
+            reference = f"{reference}.fifo"
+        attributes["FifoQueue"] = "true"
+        attributes["ContentBasedDeduplication"] = "true"
+
     try:
-        sqs_client = boto3.client("sqs", region_name="eu-west-2")
+        sqs_client = get_client("sqs")
         sqs_queue = sqs_client.create_queue(
-            QueueName=reference, Attributes={
-                "MessageRetentionPeriod": "259200"}
+            QueueName=reference, Attributes=attributes
         )
 
         return sqs_queue["QueueUrl"]
@@ -147,20 +859,30 @@ def create_sqs_queue(reference):
         )
 
 
-def send_sqs_message(formatted_message, queue_url):
+def send_sqs_message(formatted_message, queue_url, group_id=None,
+                     deduplication_id=None):
     """This function sends the formatted get requests response and sends it to
      the queue created by the user.
+     Messages to a fifo queue need a group id and may have a deduplication
+     id.
 
     Returns:
          An AWS SQS response consisting of metadata
          such as the message Id and encoded message contents
     """
+    fifo_parameters = {}
+    if group_id:
+        fifo_parameters["MessageGroupId"] = group_id
+    if deduplication_id:
+        fifo_parameters["MessageDeduplicationId"] = deduplication_id
+
     try:
-        sqs_client = boto3.client("sqs", region_name="eu-west-2")
+        sqs_client = get_client("sqs")
 
         sqs_response = sqs_client.send_message(
             QueueUrl=queue_url,
             MessageBody=formatted_message,
+            **fifo_parameters,
         )
 
         return sqs_response
@@ -170,71 +892,3205 @@ def send_sqs_message(formatted_message, queue_url):
             f'"This message could not be sent. Please contact AWS:", {e}')
 
 
-def view_sqs_message(queue_url):
-    """This function retrives the message sent to sqs by the user"""
+def message_group_id(search_term):
+    """Makes a fifo message group id from a search term. Group ids allow
+    only letters, numbers and punctuation, up to 128 characters."""
+    return re.sub(r"[^A-Za-z0-9!-/:-@\[-`{-~]", "_", search_term)[:128]
 
-    sqs_client = boto3.client("sqs", region_name="eu-west-2")
-    sqs_message = sqs_client.receive_message(
-        QueueUrl=queue_url, WaitTimeSeconds=20)
 
-    time.sleep(5)
-    messages = sqs_message.get("Messages", [])
+def deduplication_id(keys):
+    """Makes a fifo deduplication id that is the same every time a message
+    holds the same articles."""
+    return hashlib.sha256("\n".join(sorted(keys)).encode()).hexdigest()
+
+
+def message_size(message):
+    """The size of a message's body and attributes, as sqs and sns count
+    it towards their size limits."""
+    return len(message["body"].encode()) + sum(
+        len(name) + len(value["DataType"]) + len(value["StringValue"].encode())
+        for name, value in message.get("attributes", {}).items()
+    )
+
+
+def batch_messages(messages, max_entries, max_bytes):
+    """Splits messages into batches of at most max_entries messages and
+    max_bytes in total, keeping their order."""
+    batches = []
+    batch, batch_bytes = [], 0
     for message in messages:
+        size = message_size(message)
+        if batch and (len(batch) == max_entries
+                      or batch_bytes + size > max_bytes):
+            batches.append(batch)
+            batch, batch_bytes = [], 0
+        batch.append(message)
+        batch_bytes += size
+    if batch:
+        batches.append(batch)
+    return batches
 
-        return f"{'Received message':1}: {message['Body']}"
 
+def article_message(articles, search_terms, body=None, fetched_at=None,
+                    sources=None):
+    """Builds a message for a list of articles, ready to publish.
 
-def lambda_handler(event: dict, context=None):
+    The message carries typed attributes describing its articles, so that
+    consumers and sns subscription filter policies can pick out messages
+    without parsing the body. It also carries a new trace id and the time
+    the articles were fetched (fetched_at, by default now), so their
+    freshness can be followed to the consumer. When the articles have
+    already been formatted, sources are the api results they came from,
+    in the same order, whose ids and sections key the message.
+
+    Returns:
+         A message dict with a "body" (the formatted articles unless a body
+         is given), "attributes", a "group_id" when there is a single
+         search term, a "deduplication_id" and the "partition_keys" of the
+         articles in the body, by id and by section.
     """
-    The lambda function checks for an api-key environment variable.
+    dates = sorted(article["webPublicationDate"] for article in articles
+                   if "webPublicationDate" in article)
+    attributes = {
+        "search-terms": {"DataType": "String.Array",
+                         "StringValue": json.dumps(search_terms)},
+        "article-count": {"DataType": "Number",
+                          "StringValue": str(len(articles))},
+        "content-type": {"DataType": "String",
+                         "StringValue": "application/json"},
+        "schema-version": {"DataType": "Number",
+                           "StringValue": str(schema_version)},
+        "trace-id": {"DataType": "String", "StringValue": uuid.uuid4().hex},
+        "fetched-at": {"DataType": "String",
+                       "StringValue": utc_timestamp(fetched_at)},
+    }
+    if dates:
+        attributes["earliest-publication-date"] = {
+            "DataType": "String", "StringValue": dates[0]}
+        attributes["latest-publication-date"] = {
+            "DataType": "String", "StringValue": dates[-1]}
 
-    If one is present then:
+    return {
+        "body": (body if body is not None
+                 else format_articles_columnar(articles)),
+        "attributes": attributes,
+        "group_id": (message_group_id(search_terms[0])
+                     if len(search_terms) == 1 else None),
+        "deduplication_id": deduplication_id(
+            article.get("id") or article.get("webUrl", "")
+            for article in sources or articles),
+        "partition_keys": {
+            "id": [article.get("id") or article.get("webUrl", "")
+                   for article in sources or articles],
+            "section": [article.get("sectionId", "")
+                        for article in sources or articles],
+        },
+    }
 
-        1. Url parameters are created with user input
 
-        2. If the parameters object is the correct length then the api
-           is called using requests.get and a response returned
+def stamp_enqueued(messages):
+    """Returns copies of messages with an enqueued-at attribute of now.
+    The timestamp is fixed width, so a sender can restamp a message just
+    before sending it without changing its size."""
+    enqueued_at = {"DataType": "String", "StringValue": utc_timestamp()}
+    return [
+        {**message, "attributes": {**(message.get("attributes") or {}),
+                                   "enqueued-at": enqueued_at}}
+        for message in messages
+    ]
 
-        3. This response is then formatted to a json object
 
-        4. An AWS SQS Queue is then created using a user inputted
-           reference value and returns a url pointing to the queue.
+# One rate governor per fifo message group, shared by the batched sender
+fifo_group_governors = {}
 
-        5. The formatted json object and queue url are then used to
-           send the message to the queue.
-           This functions returns some metadata which can be used
-           to verify of the message was sent successfully.
 
-        6. The user then has the option to view the message on the screen.
+def send_sqs_message_batch(messages, queue_url):
+    """Sends many messages to a queue with SendMessageBatch, packing up to
+    10 messages and 256 KiB into each call.
+
+    Each message is a dict with a "body", optional "attributes" and, for
+    fifo queues, a "group_id" and optional "deduplication_id". Messages
+    in the same
+    fifo group are paced to stay within the per group throughput limit.
+    Order within a group is kept, as entries are sent in the order given.
+
+    When backpressure is switched on the depth of the queue decides whether
+    the messages are sent as they are, paced, coalesced or spilled; see
+    send_with_backpressure.
+
+    Returns:
+         The number of messages sent.
     """
+    if (backpressure_slow_depth or backpressure_coalesce_depth
+            or backpressure_spill_depth):
+        return send_with_backpressure(messages, queue_url)
+    return send_sqs_batches(messages, queue_url)
+
+
+def send_sqs_batches(messages, queue_url, governor=None):
+    """Sends messages in batches as send_sqs_message_batch does, acquiring
+    governor (if given) for every message."""
+    sqs_client = get_client("sqs")
+
+    batches = batch_messages(stamp_enqueued(messages), sqs_batch_entries,
+                             sqs_batch_bytes)
+    for batch in batches:
+        entries = []
+        for number, message in enumerate(batch):
+            if governor:
+                governor.acquire()
+            entry = {"Id": str(number), "MessageBody": message["body"],
+                     "MessageAttributes": message["attributes"]}
+            if message.get("group_id"):
+                group_governor = fifo_group_governors.setdefault(
+                    message["group_id"],
+                    RateGovernor(fifo_group_messages_per_second,
+                                 burst=sqs_batch_entries))
+                group_governor.acquire()
+                entry["MessageGroupId"] = message["group_id"]
+            if message.get("deduplication_id"):
+                entry["MessageDeduplicationId"] = message["deduplication_id"]
+            entries.append(entry)
+        # Paced batches are stamped when they are actually sent
+        enqueued_at = {"DataType": "String", "StringValue": utc_timestamp()}
+        for entry in entries:
+            entry["MessageAttributes"] = {**entry["MessageAttributes"],
+                                          "enqueued-at": enqueued_at}
 
+        try:
+            response = sqs_client.send_message_batch(
+                QueueUrl=queue_url, Entries=entries)
+        except ClientError as e:
+            raise SystemExit(
+                f'"These messages could not be sent. Please contact AWS:", {e}'
+            )
+        if response.get("Failed"):
+            raise SystemExit(
+                f'"These messages could not be sent:", {response["Failed"]}')
+
+    return sum(len(batch) for batch in batches)
+
+
+# Sampled queue depths, by queue url, as (monotonic time, depth)
+queue_depths = {}
+
+
+def get_queue_depth(queue_url):
+    """Returns the approximate number of messages waiting on a queue,
+    asking sqs at most once every queue_depth_ttl seconds."""
+    sampled = queue_depths.get(queue_url)
+    if sampled and time.monotonic() - sampled[0] < queue_depth_ttl:
+        return sampled[1]
+    sqs_client = get_client("sqs")
     try:
-        info = GuardianApiInfo.model_validate(event)
-    except ValidationError as e:
-        return {"result": "error", "message": e.errors(include_url=False)}
+        depth = int(sqs_client.get_queue_attributes(
+            QueueUrl=queue_url,
+            AttributeNames=["ApproximateNumberOfMessages"],
+        )["Attributes"]["ApproximateNumberOfMessages"])
+    except ClientError as e:
+        logger.error(f"The queue depth could not be read: {e}")
+        return sampled[1] if sampled else 0
+    queue_depths[queue_url] = (time.monotonic(), depth)
+    return depth
 
-    api_key = get_api_key()
 
-    payload = {"api-key": api_key, "q": info.search_term,
-               "from-date": info.date_from}
+# The attributes article_message works out from the articles in a message
+article_attributes = {"search-terms", "article-count",
+                      "earliest-publication-date", "latest-publication-date"}
 
-    api_response = get_api_response_json(payload=payload)
+# The attributes that follow a message's articles when they are coalesced
+# or partitioned into other messages
+trace_attributes = {"trace-id", "fetched-at"}
 
-    if not api_response:
-        logger.error("THE API RESPONSE COULD NOT BE PROCESSED")
-    formatted_response = format_api_response_message(api_response)
 
-    queue_reference = info.reference
+def coalesce_messages(messages, max_bytes=sqs_batch_bytes):
+    """Merges runs of messages for the same group, with the same extra
+    attributes, into as few messages of at most max_bytes as possible. A
+    merged message keeps the trace id and fetch time of the first message
+    of its run.
+
+    Returns:
+         The coalesced messages, in the original order.
+    """
+    def merge(run):
+        if len(run) == 1:
+            return run[0]
+        articles = [article for message in run
+                    for article in json.loads(message["body"])]
+        search_terms = sorted({
+            term for message in run for term in json.loads(
+                message["attributes"]["search-terms"]["StringValue"])})
+        merged = article_message(articles, search_terms,
+                                 body=json.dumps(articles))
+        merged["attributes"].update(extra_attributes(run[0]))
+        merged["group_id"] = run[0].get("group_id")
+        merged["deduplication_id"] = deduplication_id(
+            message.get("deduplication_id") or "" for message in run)
+        merged["partition_keys"] = {
+            key: [value for message in run
+                  for value in message["partition_keys"][key]]
+            for key in ["id", "section"]
+        } if all("partition_keys" in message for message in run) else {}
+        return merged
+
+    def extra_attributes(message, ignore=article_attributes):
+        return {name: value
+                for name, value in (message.get("attributes") or {}).items()
+                if name not in ignore}
 
-    sqs_queue_url = create_sqs_queue(queue_reference)
+    def same_run(message, other):
+        ignore = article_attributes | trace_attributes
+        return (message.get("group_id") == other.get("group_id")
+                and extra_attributes(message, ignore)
+                == extra_attributes(other, ignore)
+                and "search-terms" in (message.get("attributes") or {}))
 
-    send_sqs = send_sqs_message(formatted_response, sqs_queue_url)
+    coalesced, run, run_bytes = [], [], 0
+    for message in messages:
+        size = message_size(message)
+        if run and (not same_run(run[0], message)
+                    or run_bytes + size > max_bytes):
+            coalesced.append(merge(run))
+            run, run_bytes = [], 0
+        run.append(message)
+        run_bytes += size
+    if run:
+        coalesced.append(merge(run))
+    return coalesced
 
-    if not send_sqs["MD5OfMessageBody"]:
-        logger.error("MESSAGE HAS NOT BEEN RECIEVED BY SQS")
-    print("MESSAGE HAS BEEN RECIEVED BY SQS")
-    logger.info("MESSAGE HAS BEEN RECIEVED BY SQS")
 
-    view_response = view_sqs_message(sqs_queue_url)
+def spill_key(queue_url, name=""):
+    return f"spill/{queue_url.rsplit('/', 1)[1]}/{name}"
 
-    return view_response
+
+def spill_messages(messages, queue_url):
+    """Keeps messages for a queue in the spill store, to be sent once the
+    queue has drained."""
+    key = spill_key(queue_url, f"{time.time_ns():020d}-{uuid.uuid4()}.json")
+    data = json.dumps(messages)
+    if spill_bucket:
+        s3_client = get_client("s3")
+        try:
+            s3_client.put_object(Bucket=spill_bucket, Key=key, Body=data)
+        except ClientError as e:
+            raise SystemExit(
+                f'"These messages could not be spilled. Please contact '
+                f'AWS:", {e}')
+        return
+    path = os.path.join(checkpoint_dir, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.tmp", "w") as f:
+        f.write(data)
+    os.replace(f"{path}.tmp", path)
+
+
+def load_spilled(queue_url):
+    """Returns the spilled messages for a queue, oldest first, as a list
+    of (key, messages)."""
+    prefix = spill_key(queue_url)
+    if spill_bucket:
+        s3_client = get_client("s3")
+        keys = sorted(
+            item["Key"]
+            for page in s3_client.get_paginator("list_objects_v2").paginate(
+                Bucket=spill_bucket, Prefix=prefix)
+            for item in page.get("Contents", []))
+        return [(key, json.loads(s3_client.get_object(
+            Bucket=spill_bucket, Key=key)["Body"].read())) for key in keys]
+    directory = os.path.join(checkpoint_dir, prefix)
+    if not os.path.isdir(directory):
+        return []
+    spilled = []
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(".json"):
+            with open(os.path.join(directory, name)) as f:
+                spilled.append((prefix + name, json.load(f)))
+    return spilled
+
+
+def delete_spilled(keys):
+    if spill_bucket:
+        s3_client = get_client("s3")
+        for key in keys:
+            s3_client.delete_object(Bucket=spill_bucket, Key=key)
+        return
+    for key in keys:
+        os.remove(os.path.join(checkpoint_dir, key))
+
+
+# One rate governor per queue, used while the queue is slowed down
+backpressure_governors = {}
+
+
+def send_with_backpressure(messages, queue_url):
+    """Sends messages to a queue according to how far behind its consumers
+    are. The sampled depth is logged as a ConsumerLag metric, then:
+
+    - at backpressure_spill_depth the messages are spilled and none are
+      sent;
+    - otherwise any spilled messages are sent first, to keep their order;
+    - at backpressure_coalesce_depth articles are coalesced into fewer
+      messages;
+    - at backpressure_slow_depth sending is paced at
+      backpressure_slow_rate messages a second.
+
+    Returns:
+         The number of messages sent.
+    """
+    depth = get_queue_depth(queue_url)
+    queue_name = queue_url.rsplit("/", 1)[1]
+    emit_metric("ConsumerLag", depth, "Count", Queue=queue_name)
+
+    if backpressure_spill_depth and depth >= backpressure_spill_depth:
+        spill_messages(messages, queue_url)
+        logger.warning(f"{queue_name} HAS {depth} MESSAGES WAITING, "
+                       f"SPILLED {len(messages)} MESSAGES")
+        return 0
+
+    spilled = load_spilled(queue_url)
+    messages = [message for _, batch in spilled
+                for message in batch] + messages
+
+    if backpressure_coalesce_depth and depth >= backpressure_coalesce_depth:
+        messages = coalesce_messages(messages)
+
+    governor = None
+    if backpressure_slow_depth and depth >= backpressure_slow_depth:
+        governor = backpressure_governors.setdefault(
+            queue_url, RateGovernor(backpressure_slow_rate,
+                                    burst=sqs_batch_entries))
+
+    sent = send_sqs_batches(messages, queue_url, governor)
+    delete_spilled([key for key, _ in spilled])
+    emit_freshness([message for _, batch in spilled for message in batch])
+    return sent
+
+
+def view_sqs_message(queue_url):
+    """This function retrives the message sent to sqs by the user"""
+
+    sqs_client = get_client("sqs")
+    sqs_message = sqs_client.receive_message(
+        QueueUrl=queue_url, WaitTimeSeconds=20)
+
+    time.sleep(5)
+    messages = sqs_message.get("Messages", [])
+    for message in messages:
+
+        return f"{'Received message':1}: {message['Body']}"
+
+
+class Publisher:
+    """Sends messages to a message broker destination.
+
+    publish() takes a list of message dicts, as built by article_message,
+    with a "body" and optionally "attributes", a "group_id" (the search
+    term, used for ordering) and a "deduplication_id", and returns the
+    number of messages sent. Each backend batches in its own native way.
+    Backends that keep messages in order within a group set ordered to
+    True.
+    """
+    ordered = False
+
+    def publish(self, messages):
+        raise NotImplementedError
+
+
+class SqsPublisher(Publisher):
+    """Publishes to the sqs queue named by the reference."""
+
+    def __init__(self, reference, fifo=False):
+        self.fifo = fifo
+        self.ordered = fifo
+        self.queue_url = create_sqs_queue(reference, fifo)
+
+    def publish(self, messages):
+        if not self.fifo:
+            messages = [
+                {"body": message["body"],
+                 "attributes": message.get("attributes")}
+                for message in messages
+            ]
+        return send_sqs_message_batch(messages, self.queue_url)
+
+
+def shared_queue_name(reference, count=None, prefix=None):
+    """Returns the shared queue a reference is multiplexed onto. The shard
+    comes from a stable hash of the reference, so producers and consumers
+    always agree on it."""
+    count = count or shared_queue_count
+    prefix = prefix or shared_queue_prefix
+    digest = hashlib.sha1(reference.encode()).digest()
+    return f"{prefix}-{int.from_bytes(digest[:8], 'big') % count}"
+
+
+# Urls of the shared queues already created by this container, so that
+# CreateQueue is called once per shard rather than once per invocation
+shared_queue_urls = {}
+
+
+class SharedSqsPublisher(Publisher):
+    """Publishes to the shared sqs queue for the reference, adding the
+    reference as a message attribute so that consumers can demultiplex.
+    Fifo message groups are per reference and search term."""
+
+    def __init__(self, reference, fifo=False):
+        self.reference = reference
+        self.fifo = fifo
+        self.ordered = fifo
+        name = shared_queue_name(reference)
+        if (name, fifo) not in shared_queue_urls:
+            shared_queue_urls[(name, fifo)] = create_sqs_queue(name, fifo)
+        self.queue_url = shared_queue_urls[(name, fifo)]
+
+    def publish(self, messages):
+        shared = []
+        for message in messages:
+            attributes = {
+                **(message.get("attributes") or {}),
+                "reference": {"DataType": "String",
+                              "StringValue": self.reference},
+            }
+            shared_message = {"body": message["body"],
+                              "attributes": attributes}
+            if self.fifo:
+                shared_message["group_id"] = message_group_id(
+                    f"{self.reference}:{message.get('group_id') or ''}")
+                # Other references may be sent the same articles
+                shared_message["deduplication_id"] = deduplication_id([
+                    self.reference, message.get("deduplication_id") or ""])
+            shared.append(shared_message)
+        return send_sqs_message_batch(shared, self.queue_url)
+
+
+class SnsPublisher(Publisher):
+    """Publishes to an sns topic with PublishBatch, creating the topic if
+    needed. Subscriptions can use filter policies on the message
+    attributes to route a subset of messages to each subscriber."""
+
+    def __init__(self, topic_name):
+        self.sns_client = get_client("sns")
+        try:
+            self.topic_arn = self.sns_client.create_topic(
+                Name=topic_name)["TopicArn"]
+        except ClientError as e:
+            raise SystemExit(
+                f'"This SNS topic could not be created. Please contact AWS:",'
+                f' {e}')
+
+    def publish(self, messages):
+        for batch in batch_messages(stamp_enqueued(messages),
+                                    sns_batch_entries, sns_batch_bytes):
+            try:
+                response = self.sns_client.publish_batch(
+                    TopicArn=self.topic_arn,
+                    PublishBatchRequestEntries=[
+                        {"Id": str(number), "Message": message["body"],
+                         "MessageAttributes": message.get("attributes", {})}
+                        for number, message in enumerate(batch)
+                    ],
+                )
+            except ClientError as e:
+                raise SystemExit(
+                    f'"These messages could not be published. Please contact'
+                    f' AWS:", {e}')
+            if response.get("Failed"):
+                raise SystemExit(
+                    f'"These messages could not be published:",'
+                    f' {response["Failed"]}')
+        return len(messages)
+
+
+class EventBridgePublisher(Publisher):
+    """Publishes to an EventBridge event bus. Each event's detail holds the
+    message attributes and the articles, so rules can route on either."""
+
+    def __init__(self, event_bus_name):
+        self.event_bus_name = event_bus_name
+        self.events_client = get_client("events")
+
+    def publish(self, messages):
+        for batch in batch_messages(stamp_enqueued(messages),
+                                    sns_batch_entries, sns_batch_bytes):
+            entries = []
+            for message in batch:
+                attributes = {
+                    name: (json.loads(value["StringValue"])
+                           if value["DataType"] != "String"
+                           else value["StringValue"])
+                    for name, value in message.get("attributes", {}).items()
+                }
+                entries.append({
+                    "Source": event_bus_source,
+                    "DetailType": "articles",
+                    "Detail": json.dumps({
+                        "attributes": attributes,
+                        "articles": json.loads(message["body"]),
+                    }),
+                    "EventBusName": self.event_bus_name,
+                })
+            try:
+                response = self.events_client.put_events(Entries=entries)
+            except ClientError as e:
+                raise SystemExit(
+                    f'"These events could not be sent. Please contact AWS:",'
+                    f' {e}')
+            if response.get("FailedEntryCount"):
+                raise SystemExit(
+                    f'"{response["FailedEntryCount"]} events could not be'
+                    f' sent to EventBridge"')
+        return len(messages)
+
+
+class KinesisPublisher(Publisher):
+    """Publishes to a Kinesis data stream with PutRecords, using the
+    message group as the partition key so a term's records stay in order
+    on one shard."""
+    ordered = True
+
+    def __init__(self, stream_name):
+        self.stream_name = stream_name
+        self.kinesis_client = get_client("kinesis")
+
+    def publish(self, messages):
+        records = [
+            {"Data": message["body"].encode(),
+             "PartitionKey": (message.get("group_id")
+                              or message.get("deduplication_id")
+                              or hashlib.md5(message["body"].encode())
+                              .hexdigest())[:256]}
+            for message in messages
+        ]
+        batch, batch_bytes = [], 0
+        for record in records:
+            size = len(record["Data"]) + len(record["PartitionKey"])
+            if batch and (len(batch) == kinesis_batch_records
+                          or batch_bytes + size > kinesis_batch_bytes):
+                self.put_records(batch)
+                batch, batch_bytes = [], 0
+            batch.append(record)
+            batch_bytes += size
+        if batch:
+            self.put_records(batch)
+        return len(records)
+
+    def put_records(self, records, attempts=3):
+        for attempt in range(attempts):
+            try:
+                response = self.kinesis_client.put_records(
+                    StreamName=self.stream_name, Records=records)
+            except ClientError as e:
+                raise SystemExit(
+                    f'"These records could not be sent. Please contact AWS:",'
+                    f' {e}')
+            if not response["FailedRecordCount"]:
+                return
+            # Retry only the throttled records, keeping their order
+            records = [
+                record for record, result in zip(records, response["Records"])
+                if "ErrorCode" in result
+            ]
+            time.sleep(0.1 * 2 ** attempt)
+        raise SystemExit(
+            f'"{len(records)} records could not be sent to Kinesis"')
+
+
+# Kafka producers are slow to start, so one is kept per container
+kafka_producers = {}
+
+
+class KafkaPublisher(Publisher):
+    """Publishes to a Kafka compatible topic, keyed by message group so a
+    term's messages stay in order on one partition. Needs kafka-python."""
+    ordered = True
+
+    def __init__(self, topic):
+        if KafkaProducer is None:
+            raise SystemExit("kafka-python must be installed to use kafka")
+        self.topic = topic
+        if kafka_bootstrap_servers not in kafka_producers:
+            kafka_producers[kafka_bootstrap_servers] = KafkaProducer(
+                bootstrap_servers=kafka_bootstrap_servers.split(","),
+                linger_ms=20, acks="all")
+        self.producer = kafka_producers[kafka_bootstrap_servers]
+
+    def publish(self, messages):
+        futures = []
+        for message in stamp_enqueued(messages):
+            key = message.get("group_id")
+            headers = [
+                (name, value["StringValue"].encode())
+                for name, value in message.get("attributes", {}).items()
+            ]
+            futures.append(self.producer.send(
+                self.topic, value=message["body"].encode(),
+                key=key.encode() if key else None, headers=headers))
+        self.producer.flush()
+        # flush() only waits for the sends, so each one is checked for an
+        # error
+        failed = []
+        for future in futures:
+            try:
+                future.get(timeout=kafka_send_timeout)
+            except KafkaError as e:
+                failed.append(e)
+        if failed:
+            raise SystemExit(
+                f'"{len(failed)} messages could not be sent to kafka:", '
+                f'{failed[0]}')
+        return len(messages)
+
+
+# Messages published to "memory:" references, by name
+memory_topics = {}
+memory_topics_lock = threading.Lock()
+
+
+class MemoryPublisher(Publisher):
+    """Keeps messages in memory_topics, for tests and benchmarks."""
+    ordered = True
+
+    def __init__(self, name):
+        self.name = name
+
+    def publish(self, messages):
+        with memory_topics_lock:
+            memory_topics.setdefault(self.name, []).extend(
+                stamp_enqueued(messages))
+        return len(messages)
+
+
+class FilePublisher(Publisher):
+    """Appends each message body as a line to a local file."""
+    ordered = True
+
+    def __init__(self, path):
+        self.path = path
+
+    def publish(self, messages):
+        with open(self.path, "a") as f:
+            f.writelines(f"{message['body']}\n" for message in messages)
+        return len(messages)
+
+
+def partition_queue_name(reference, partition, fifo=False):
+    name = f"{reference}-{partition}"
+    return f"{name}.fifo" if fifo else name
+
+
+def create_partition_queues(reference, partitions, fifo=False):
+    """Creates the partition queues <reference>-0 to
+    <reference>-<partitions - 1>.
+
+    Returns:
+         The urls of the partition queues, in partition order.
+    """
+    return [create_sqs_queue(partition_queue_name(reference, partition, fifo),
+                             fifo)
+            for partition in range(partitions)]
+
+
+def jump_hash(key, buckets):
+    """Jump consistent hash of a string key into one of buckets. When the
+    number of buckets grows from n to m, only keys moving to the new
+    buckets n..m-1 change bucket; when it shrinks, only keys in the removed
+    buckets do."""
+    key = int.from_bytes(hashlib.sha1(key.encode()).digest()[:8], "big")
+    bucket, jump = -1, 0
+    while jump < buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) % 2 ** 64
+        jump = int((bucket + 1) * (2 ** 31 / ((key >> 33) + 1)))
+    return bucket
+
+
+class PartitionedSqsPublisher(Publisher):
+    """Spreads the articles for a reference over the partition queues
+    <reference>-0..N-1 by a stable hash of each article's id or section,
+    so that each partition can have its own consumers.
+
+    The partition count in use is kept as a "partitions" tag on the first
+    partition queue. When a publisher asks for a different count it only
+    switches once every partition that would lose keys is empty, so the
+    messages for a key are never split across two queues at once and
+    their order is kept. Until then it keeps publishing with the old count,
+    so a resize only happens once the producers for the reference pause
+    long enough for the consumers to drain those partitions.
+    """
+
+    def __init__(self, reference, partitions, key="id", fifo=False):
+        self.reference = reference
+        self.key = key
+        self.fifo = fifo
+        self.ordered = fifo
+        self.sqs_client = get_client("sqs")
+        active = self.active_partitions()
+        self.queue_urls = create_partition_queues(
+            reference, max(partitions, active or 0), fifo)
+        self.partitions = self.resize(active, partitions)
+
+    def active_partitions(self):
+        try:
+            queue_url = self.sqs_client.get_queue_url(
+                QueueName=partition_queue_name(self.reference, 0, self.fifo)
+            )["QueueUrl"]
+            tags = self.sqs_client.list_queue_tags(
+                QueueUrl=queue_url).get("Tags", {})
+        except ClientError:
+            return None
+        return int(tags["partitions"]) if "partitions" in tags else None
+
+    def resize(self, active, partitions):
+        """Switches from the active partition count to partitions if the
+        partitions losing keys are drained, and returns the partition count
+        to publish with."""
+        if active == partitions:
+            return active
+        if active is not None:
+            losing = range(active) if partitions > active else range(
+                partitions, active)
+            if not all(self.drained(self.queue_urls[partition])
+                       for partition in losing):
+                logger.warning(
+                    f"{self.reference} stays at {active} partitions until "
+                    f"its partitions are drained")
+                return active
+        try:
+            self.sqs_client.tag_queue(QueueUrl=self.queue_urls[0],
+                                      Tags={"partitions": str(partitions)})
+        except ClientError as e:
+            raise SystemExit(
+                f'"The partitions could not be resized. Please contact AWS:",'
+                f' {e}')
+        return partitions
+
+    def drained(self, queue_url):
+        attributes = self.sqs_client.get_queue_attributes(
+            QueueUrl=queue_url,
+            AttributeNames=["ApproximateNumberOfMessages",
+                            "ApproximateNumberOfMessagesNotVisible"],
+        )["Attributes"]
+        return not any(int(count) for count in attributes.values())
+
+    def partition_messages(self, message):
+        """Splits a message into one message per partition its articles
+        hash to."""
+        articles = json.loads(message["body"])
+        keys = message.get("partition_keys", {}).get(self.key)
+        if not keys or len(keys) != len(articles):
+            keys = [message.get("deduplication_id") or ""] * len(articles)
+        by_partition = {}
+        for key, article in zip(keys, articles):
+            by_partition.setdefault(
+                jump_hash(key, self.partitions), []).append(article)
+
+        search_terms = json.loads(
+            message["attributes"]["search-terms"]["StringValue"])
+        for partition, partition_articles in by_partition.items():
+            partitioned = article_message(
+                partition_articles, search_terms,
+                body=json.dumps(partition_articles))
+            partitioned["attributes"].update({
+                name: value for name, value in message["attributes"].items()
+                if name in trace_attributes})
+            partitioned["group_id"] = message.get("group_id")
+            yield partition, partitioned
+
+    def publish(self, messages):
+        by_partition = {}
+        for message in messages:
+            for partition, partitioned in self.partition_messages(message):
+                if not self.fifo:
+                    partitioned = {"body": partitioned["body"],
+                                   "attributes": partitioned["attributes"]}
+                by_partition.setdefault(partition, []).append(partitioned)
+        return sum(
+            send_sqs_message_batch(partition_messages,
+                                   self.queue_urls[partition])
+            for partition, partition_messages in sorted(by_partition.items())
+        )
+
+
+publisher_backends = {
+    "sqs": SqsPublisher,
+    "sns": SnsPublisher,
+    "events": EventBridgePublisher,
+    "kinesis": KinesisPublisher,
+    "kafka": KafkaPublisher,
+    "memory": MemoryPublisher,
+    "file": FilePublisher,
+}
+
+
+def get_publisher(reference, fifo=False, partitions=0, partition_key="id"):
+    """Returns the publisher for a reference. A reference of the form
+    "<backend>:<destination>" picks the backend, e.g. "kinesis:articles"
+    or "file:/tmp/articles.ndjson"; a plain reference is an sqs queue, a
+    set of partition queues when partitions is given, or a shared sqs
+    queue when shared queues are switched on."""
+    backend, _, destination = reference.partition(":")
+    if not destination:
+        if partitions:
+            return PartitionedSqsPublisher(
+                reference, partitions, partition_key, fifo)
+        if shared_queue_count:
+            return SharedSqsPublisher(reference, fifo)
+        return SqsPublisher(reference, fifo)
+    if backend not in publisher_backends:
+        raise SystemExit(f"Unknown message broker backend: {backend}")
+    if backend == "sqs":
+        return SqsPublisher(destination, fifo)
+    return publisher_backends[backend](destination)
+
+
+class S3MultipartUpload:
+    """A write only file that uploads to an S3 object in parts of
+    part_bytes. An object smaller than one part is sent with a single
+    PutObject instead."""
+
+    def __init__(self, bucket, key, part_bytes=None, s3_client=None):
+        self.bucket = bucket
+        self.key = key
+        self.part_bytes = part_bytes or archive_part_bytes
+        self.s3_client = s3_client or get_client("s3")
+        self.buffer = bytearray()
+        self.position = 0
+        self.upload_id = None
+        self.parts = []
+        self.closed = False
+
+    def write(self, data):
+        self.buffer.extend(data)
+        self.position += len(data)
+        while len(self.buffer) >= self.part_bytes:
+            self.upload_part(bytes(self.buffer[:self.part_bytes]))
+            del self.buffer[:self.part_bytes]
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def upload_part(self, data):
+        try:
+            if self.upload_id is None:
+                self.upload_id = self.s3_client.create_multipart_upload(
+                    Bucket=self.bucket, Key=self.key)["UploadId"]
+            response = self.s3_client.upload_part(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                PartNumber=len(self.parts) + 1, Body=data)
+        except ClientError as e:
+            self.abort()
+            raise SystemExit(
+                f'"The archive could not be uploaded. Please contact AWS:", '
+                f'{e}')
+        self.parts.append({"PartNumber": len(self.parts) + 1,
+                           "ETag": response["ETag"]})
+
+    def abort(self):
+        if self.upload_id is not None:
+            self.s3_client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            self.upload_id = None
+        self.closed = True
+
+    def close(self):
+        if self.closed:
+            return
+        if self.upload_id is None:
+            self.s3_client.put_object(Bucket=self.bucket, Key=self.key,
+                                      Body=bytes(self.buffer))
+        else:
+            if self.buffer:
+                self.upload_part(bytes(self.buffer))
+            self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                MultipartUpload={"Parts": self.parts})
+        self.buffer = bytearray()
+        self.closed = True
+
+
+# The article fields kept in the archive, followed by where and when each
+# article was fetched
+archive_article_fields = ["id", "type", "sectionId", "sectionName",
+                          "webTitle", "webUrl", "apiUrl", "pillarName"]
+
+
+def archive_schema():
+    return pyarrow.schema(
+        [(field, pyarrow.string()) for field in archive_article_fields] + [
+            ("webPublicationDate", pyarrow.timestamp("s", tz="UTC")),
+            ("search_term", pyarrow.string()),
+            ("reference", pyarrow.string()),
+            ("fetched_at", pyarrow.timestamp("s", tz="UTC")),
+        ])
+
+
+class ArchiveSink:
+    """Archives fetched articles as zstd compressed Parquet files, written
+    under <destination>/date=<publication date>/term=<search term>/.
+
+    Articles are buffered per partition and written as Arrow record
+    batches of up to archive_batch_rows rows. A partition's file is rolled
+    once it reaches archive_file_bytes. Files are only complete once the
+    sink is closed. A sink can be shared by threads (see
+    keep_archive_open).
+    """
+
+    def __init__(self, destination, file_bytes=None, s3_client=None):
+        if pyarrow is None:
+            raise SystemExit("pyarrow must be installed to archive articles")
+        self.destination = destination.rstrip("/")
+        self.file_bytes = file_bytes or archive_file_bytes
+        self.s3_client = s3_client
+        self.schema = archive_schema()
+        self.rows = {}
+        self.writers = {}
+        self.files = []
+        self.lock = threading.Lock()
+
+    def add(self, articles, search_term, reference, fetched_at=None):
+        """Buffers articles found by search_term for reference, fetched at
+        fetched_at (a unix timestamp, by default now)."""
+        fetched_at = datetime.fromtimestamp(
+            fetched_at or time.time(), timezone.utc)
+        with self.lock:
+            self.add_rows(articles, search_term, reference, fetched_at)
+
+    def add_rows(self, articles, search_term, reference, fetched_at):
+        for article in articles:
+            published = article.get("webPublicationDate")
+            partition = (published[:10] if published else "unknown",
+                         re.sub(r"[^A-Za-z0-9_-]", "_", search_term))
+            rows = self.rows.setdefault(partition, [])
+            rows.append({
+                **{field: article.get(field)
+                   for field in archive_article_fields},
+                "webPublicationDate": (
+                    datetime.fromisoformat(published) if published else None),
+                "search_term": search_term,
+                "reference": reference,
+                "fetched_at": fetched_at,
+            })
+            if len(rows) >= archive_batch_rows:
+                self.write(partition)
+
+    def open_file(self, partition):
+        day, term = partition
+        path = (f"{self.destination}/date={day}/term={term}/"
+                f"part-{uuid.uuid4()}.parquet")
+        if path.startswith("s3://"):
+            bucket, _, key = path[len("s3://"):].partition("/")
+            sink = S3MultipartUpload(bucket, key, s3_client=self.s3_client)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            sink = open(path, "wb")
+        self.files.append(path)
+        writer = pyarrow.parquet.ParquetWriter(
+            pyarrow.PythonFile(sink, mode="w"), self.schema,
+            compression="zstd")
+        return writer, sink
+
+    def write(self, partition):
+        rows = self.rows.pop(partition, [])
+        if not rows:
+            return
+        if partition not in self.writers:
+            self.writers[partition] = self.open_file(partition)
+        writer, sink = self.writers[partition]
+        writer.write_batch(
+            pyarrow.RecordBatch.from_pylist(rows, schema=self.schema))
+        if sink.tell() >= self.file_bytes:
+            self.close_file(partition)
+
+    def close_file(self, partition):
+        writer, sink = self.writers.pop(partition)
+        writer.close()
+        sink.close()
+
+    def close(self):
+        """Writes every buffered article and closes the files.
+
+        Returns:
+             The paths of the files written.
+        """
+        with self.lock:
+            for partition in list(self.rows):
+                self.write(partition)
+            for partition in list(self.writers):
+                self.close_file(partition)
+            return self.files
+
+
+shared_archive = None
+
+
+def open_archive():
+    """Returns an ArchiveSink for archive_destination, or None when
+    archiving is switched off."""
+    return ArchiveSink(archive_destination) if archive_destination else None
+
+
+def open_shared_archive():
+    """Opens an ArchiveSink that every run archives to until
+    close_shared_archive, instead of each opening its own, so that a long
+    running process writes fewer, larger files."""
+    global shared_archive
+    shared_archive = open_archive()
+    return shared_archive
+
+
+def close_shared_archive():
+    """Closes the shared archive, completing its files.
+
+    Returns:
+         The paths of the files written.
+    """
+    global shared_archive
+    archive, shared_archive = shared_archive, None
+    return archive.close() if archive else []
+
+
+@contextlib.contextmanager
+def keep_archive_open():
+    """Shares one ArchiveSink (see open_shared_archive) between runs while
+    the context is open."""
+    open_shared_archive()
+    try:
+        yield
+    finally:
+        close_shared_archive()
+
+
+@contextlib.contextmanager
+def archiving():
+    """Yields the archive a run adds its articles to: the shared archive
+    when one is open, otherwise its own, closed when the run is done, or
+    None when archiving is switched off."""
+    if shared_archive:
+        yield shared_archive
+        return
+    archive = open_archive()
+    try:
+        yield archive
+    finally:
+        if archive:
+            archive.close()
+
+
+def parse_date(value):
+    """Parses a date already checked by is_valid_date, which allows
+    unpadded months and days."""
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def remaining_time_ms(context):
+    """Returns the milliseconds left in the lambda invocation, or None when
+    running outside of lambda without a context object."""
+    if context is None or not hasattr(context, "get_remaining_time_in_millis"):
+        return None
+    return context.get_remaining_time_in_millis()
+
+
+def out_of_time(context):
+    remaining = remaining_time_ms(context)
+    return remaining is not None and remaining < timeout_margin_ms
+
+
+def window_payload(api_key, search_term, start, end, page=1,
+                   page_size=backfill_page_size):
+    return {
+        "api-key": api_key,
+        "q": search_term,
+        "from-date": start.isoformat(),
+        "to-date": end.isoformat(),
+        "order-by": "oldest",
+        "page": page,
+        "page-size": page_size,
+    }
+
+
+def plan_backfill_windows(api_key, search_term, start, end):
+    """Splits [start, end] into date windows that each hold no more than
+    backfill_window_max articles.
+
+    Returns:
+         A list of [from-date, to-date, total] lists in date order, with
+         empty windows left out.
+    """
+    plan = {"windows": [], "pending": [[start.isoformat(), end.isoformat()]]}
+    return probe_backfill_windows(api_key, search_term, plan)
+
+
+def probe_backfill_windows(api_key, search_term, plan, context=None,
+                           save=None, governor=None):
+    """Carries on planning the windows of a backfill plan, a dict of the
+    "windows" found so far and the "pending" [from-date, to-date] windows
+    still to probe.
+
+    Each window is probed with a single result page to read its total,
+    backfill_workers windows at a time. Busy windows are halved until they
+    fit or cover a single day, so quiet periods stay as one large window
+    and busy periods get small ones. After each round of probes the plan
+    is passed to save, and no new round starts once the invocation is out
+    of time, so planning can carry on from the saved plan. Probes are
+    governed by governor, by default the shared rate_governor.
+
+    Returns:
+         The plan's windows, in date order.
+    """
+    def probe(window):
+        return get_api_response_page(window_payload(
+            api_key, search_term, date.fromisoformat(window[0]),
+            date.fromisoformat(window[1]), page_size=1),
+            governor=governor).total
+
+    pending = plan["pending"]
+    with ThreadPoolExecutor(max_workers=backfill_workers) as executor:
+        while pending and not out_of_time(context):
+            probed = pending[-backfill_workers:]
+            totals = list(executor.map(probe, probed))
+            del pending[-len(probed):]
+            for window, total in zip(probed, totals):
+                window_start = date.fromisoformat(window[0])
+                window_end = date.fromisoformat(window[1])
+                if total > backfill_window_max and window_end > window_start:
+                    middle = window_start + timedelta(
+                        days=(window_end - window_start).days // 2)
+                    pending.append([(middle + timedelta(days=1)).isoformat(),
+                                    window[1]])
+                    pending.append([window[0], middle.isoformat()])
+                elif total:
+                    plan["windows"].append([window[0], window[1], total])
+            plan["windows"].sort()
+            if save:
+                save(plan)
+    return plan["windows"]
+
+
+def fetch_backfill_window(api_key, search_term, window, governor=None):
+    """Fetches every page of results in a single backfill window, governed
+    by governor (by default the shared rate_governor).
+
+    Returns:
+         A list of result pages, each a list of Articles.
+    """
+    start = date.fromisoformat(window[0])
+    end = date.fromisoformat(window[1])
+    pages = []
+    page, last_page = 1, 1
+    while page <= last_page:
+        response = get_api_response_page(
+            window_payload(api_key, search_term, start, end, page=page),
+            governor=governor)
+        last_page = response.pages
+        if response.results:
+            pages.append(response.results)
+        page += 1
+    return pages
+
+
+def checkpoint_path(info):
+    key = (f"{info.search_term}|{info.date_from}|{info.date_to}|"
+           f"{info.reference}")
+    digest = hashlib.sha1(key.encode()).hexdigest()
+    return os.path.join(checkpoint_dir, f"backfill_{digest}.json")
+
+
+def checkpoint_key(info):
+    return stored_checkpoint_key(checkpoint_path(info))
+
+
+def stored_checkpoint_key(path):
+    return f"checkpoints/{os.path.basename(path)}"
+
+
+def load_stored_checkpoint(path):
+    """Returns the checkpoint named by path from CHECKPOINT_BUCKET, or
+    from path itself when no bucket is set, or None if there isn't one."""
+    if not checkpoint_bucket:
+        return load_checkpoint(path)
+    s3_client = get_client("s3")
+    try:
+        return json.loads(s3_client.get_object(
+            Bucket=checkpoint_bucket, Key=stored_checkpoint_key(path)
+        )["Body"].read())
+    except s3_client.exceptions.NoSuchKey:
+        return None
+
+
+def save_stored_checkpoint(path, checkpoint):
+    if not checkpoint_bucket:
+        save_checkpoint(path, checkpoint)
+        return
+    try:
+        get_client("s3").put_object(Bucket=checkpoint_bucket,
+                                    Key=stored_checkpoint_key(path),
+                                    Body=json.dumps(checkpoint))
+    except ClientError as e:
+        raise SystemExit(
+            f'"The checkpoint could not be saved. Please contact '
+            f'AWS:", {e}')
+
+
+def load_backfill_checkpoint(info):
+    """Returns a backfill's checkpoint from CHECKPOINT_BUCKET, or
+    checkpoint_dir when no bucket is set, or None if there isn't one."""
+    return load_stored_checkpoint(checkpoint_path(info))
+
+
+def save_backfill_checkpoint(info, checkpoint):
+    save_stored_checkpoint(checkpoint_path(info), checkpoint)
+
+
+def delete_backfill_checkpoint(info):
+    if checkpoint_bucket:
+        get_client("s3").delete_object(Bucket=checkpoint_bucket,
+                                       Key=checkpoint_key(info))
+    else:
+        os.remove(checkpoint_path(info))
+
+
+def load_checkpoint(path):
+    """Returns the saved backfill checkpoint or None if there isn't one."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def save_checkpoint(path, checkpoint):
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(temp_path, path)
+
+
+class ScalableBloomFilter:
+    """A scalable Bloom filter of Guardian article ids.
+
+    Each time the newest slice fills up a new slice is added with double
+    the capacity and half the error rate, so the overall false positive
+    rate stays at about the configured one however many ids are added. A
+    false positive means an unseen article is wrongly skipped.
+    """
+
+    def __init__(self, error_rate=0.001, capacity=10000):
+        self.error_rate = error_rate
+        self.capacity = capacity
+        self.slices = []
+        self.add_slice()
+
+    def add_slice(self):
+        number = len(self.slices)
+        capacity = self.capacity * 2 ** number
+        # The first slice gets half the error budget, then a quarter, ...
+        error_rate = self.error_rate * 0.5 ** (number + 1)
+        bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        hashes = max(1, round(bits / capacity * math.log(2)))
+        self.slices.append({
+            "capacity": capacity, "count": 0, "hashes": hashes,
+            "bits": bits, "array": bytearray((bits + 7) // 8),
+        })
+
+    @staticmethod
+    def positions(key, bloom_slice):
+        # Enhanced double hashing: k positions from one 128 bit digest
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        step = int.from_bytes(digest[8:], "little")
+        bits = bloom_slice["bits"]
+        positions = []
+        for i in range(bloom_slice["hashes"]):
+            positions.append(first % bits)
+            first += step
+            step += i
+        return positions
+
+    def __contains__(self, key):
+        for bloom_slice in self.slices:
+            array = bloom_slice["array"]
+            if all(array[p >> 3] & (1 << (p & 7))
+                   for p in self.positions(key, bloom_slice)):
+                return True
+        return False
+
+    def add(self, key):
+        if key in self:
+            return
+        bloom_slice = self.slices[-1]
+        if bloom_slice["count"] >= bloom_slice["capacity"]:
+            self.add_slice()
+            bloom_slice = self.slices[-1]
+        for p in self.positions(key, bloom_slice):
+            bloom_slice["array"][p >> 3] |= 1 << (p & 7)
+        bloom_slice["count"] += 1
+
+    def __len__(self):
+        return sum(bloom_slice["count"] for bloom_slice in self.slices)
+
+    def update(self, other):
+        """Adds every id in another filter with the same error rate and
+        capacity by OR-ing their slices together. A merged slice's count is
+        estimated from its set bits, as ids in both filters are only set
+        once."""
+        if (other.error_rate, other.capacity) != (
+                self.error_rate, self.capacity):
+            raise ValueError("Only filters with the same error rate and "
+                             "capacity can be merged")
+        for number, other_slice in enumerate(other.slices):
+            if number == len(self.slices):
+                self.slices.append(
+                    {**other_slice, "array": bytearray(other_slice["array"])})
+                continue
+            bloom_slice = self.slices[number]
+            merged = (int.from_bytes(bloom_slice["array"], "little")
+                      | int.from_bytes(other_slice["array"], "little"))
+            bloom_slice["array"][:] = merged.to_bytes(
+                len(bloom_slice["array"]), "little")
+            bits = bloom_slice["bits"]
+            set_bits = min(merged.bit_count(), bits - 1)
+            estimate = round(-bits / bloom_slice["hashes"]
+                             * math.log(1 - set_bits / bits))
+            bloom_slice["count"] = max(
+                bloom_slice["count"], other_slice["count"], estimate)
+
+    def to_bytes(self):
+        header = json.dumps({
+            "error_rate": self.error_rate,
+            "capacity": self.capacity,
+            "slices": [
+                {k: v for k, v in bloom_slice.items() if k != "array"}
+                for bloom_slice in self.slices
+            ],
+        }).encode()
+        return b"".join(
+            [struct.pack("<I", len(header)), header]
+            + [bytes(bloom_slice["array"]) for bloom_slice in self.slices]
+        )
+
+    @classmethod
+    def from_bytes(cls, data):
+        (length,) = struct.unpack_from("<I", data)
+        header = json.loads(data[4:4 + length])
+        bloom_filter = cls(header["error_rate"], header["capacity"])
+        bloom_filter.slices = []
+        offset = 4 + length
+        for bloom_slice in header["slices"]:
+            size = (bloom_slice["bits"] + 7) // 8
+            bloom_slice["array"] = bytearray(data[offset:offset + size])
+            offset += size
+            bloom_filter.slices.append(bloom_slice)
+        return bloom_filter
+
+
+# Seen filters already loaded by this container, by reference. The
+# threads of a scheduler tick or of the service can publish to the same
+# reference at once, so each reference's filter is loaded, added to and
+# saved under its own lock.
+seen_filters = {}
+seen_filter_locks = {}
+seen_filter_locks_lock = threading.Lock()
+
+
+def seen_filter_lock(reference):
+    with seen_filter_locks_lock:
+        return seen_filter_locks.setdefault(reference, threading.RLock())
+
+
+def reference_key(reference):
+    """Returns a name for a reference that is safe to use in a file name or
+    S3 key. References such as "file:/tmp/articles.ndjson" have their
+    unsafe characters replaced and a digest added, so that references that
+    differ only in those characters keep separate names."""
+    if re.fullmatch(r"[\w.-]+", reference):
+        return reference
+    digest = hashlib.sha1(reference.encode()).hexdigest()[:12]
+    safe_reference = re.sub(r"[^\w.-]", "_", reference)
+    return f"{safe_reference}_{digest}"
+
+
+def seen_filter_path(reference):
+    return os.path.join(checkpoint_dir, f"seen_{reference_key(reference)}.bin")
+
+
+def seen_filter_key(reference):
+    return f"seen/{reference_key(reference)}.bin"
+
+
+def get_seen_filter(reference):
+    """Returns the seen-article filter for a reference, loading it from
+    memory, then the local snapshot, then S3, or starting a new one."""
+    with seen_filter_lock(reference):
+        if reference not in seen_filters:
+            seen_filters[reference] = load_seen_filter(reference)
+        return seen_filters[reference]
+
+
+def load_seen_filter(reference):
+    data = read_local_snapshot(reference) or read_s3_snapshot(reference)
+    if data:
+        return ScalableBloomFilter.from_bytes(data)
+    return ScalableBloomFilter(seen_filter_error_rate, seen_filter_capacity)
+
+
+def read_local_snapshot(reference):
+    try:
+        with open(seen_filter_path(reference), "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def read_s3_snapshot(reference):
+    if not seen_filter_bucket:
+        return None
+    s3_client = get_client("s3", endpoint_url=seen_filter_endpoint_url)
+    try:
+        return s3_client.get_object(
+            Bucket=seen_filter_bucket, Key=seen_filter_key(reference)
+        )["Body"].read()
+    except s3_client.exceptions.NoSuchKey:
+        return None
+
+
+def save_seen_filter(reference):
+    """Snapshots a reference's seen-article filter locally and to S3.
+
+    Other processes and containers save the same snapshots, so the stored
+    snapshots are merged into the filter first and no one's ids are lost.
+    Two containers saving at the same moment can still overwrite each
+    other's snapshot, but each keeps its ids in memory and merges them
+    back in on its next save."""
+    with seen_filter_lock(reference):
+        seen = get_seen_filter(reference)
+        try:
+            for data in [read_local_snapshot(reference),
+                         read_s3_snapshot(reference)]:
+                if data:
+                    seen.update(ScalableBloomFilter.from_bytes(data))
+        except ClientError as e:
+            logger.error(f"The seen filter could not be read from S3: {e}")
+        except ValueError as e:
+            logger.warning(f"The stored seen filter was replaced: {e}")
+
+        data = seen.to_bytes()
+        path = seen_filter_path(reference)
+        # Other processes may be saving the same reference
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        if seen_filter_bucket:
+            s3_client = get_client(
+                "s3", endpoint_url=seen_filter_endpoint_url)
+            try:
+                s3_client.put_object(Bucket=seen_filter_bucket,
+                                     Key=seen_filter_key(reference),
+                                     Body=data)
+            except ClientError as e:
+                logger.error(
+                    f"The seen filter could not be saved to S3: {e}")
+
+
+def drop_seen(reference, articles):
+    """Returns the articles that have not already been published to the
+    reference, or all of them if the seen filter is switched off."""
+    if not seen_filter_enabled:
+        return articles
+    with seen_filter_lock(reference):
+        seen_filter = get_seen_filter(reference)
+        return [article for article in articles
+                if article["id"] not in seen_filter]
+
+
+def mark_seen(reference, articles):
+    """Records published articles in the reference's seen filter."""
+    if not seen_filter_enabled:
+        return
+    with seen_filter_lock(reference):
+        seen_filter = get_seen_filter(reference)
+        for article in articles:
+            seen_filter.add(article["id"])
+
+
+def run_backfill(info, api_key, context=None, governor=None):
+    """Fetches every article matching the search term from date_from up to
+    date_to (or today) and publishes it to the reference.
+
+    The date range is planned into adaptive windows which are fetched in
+    parallel under governor, by default the shared rate_governor. The
+    plan is checkpointed as it is
+    probed, and as each window finishes its pages are published and the
+    window is recorded in the checkpoint (in CHECKPOINT_BUCKET or
+    checkpoint_dir), so an invocation that runs out of time can be invoked
+    again with the same event and will carry on from where it stopped.
+
+    Returns:
+         A summary of the run. The result is "incomplete" if the invocation
+         ran out of time before every window was planned and published.
+    """
+    checkpoint = load_backfill_checkpoint(info)
+    if checkpoint is None:
+        start = parse_date(info.date_from)
+        end = parse_date(info.date_to) if info.date_to else date.today()
+        checkpoint = {"windows": [], "completed": [],
+                      "pending": [[start.isoformat(), end.isoformat()]]}
+    if checkpoint.get("pending"):
+        probe_backfill_windows(
+            api_key, info.search_term, checkpoint, context,
+            save=lambda plan: save_backfill_checkpoint(info, plan),
+            governor=governor)
+    if checkpoint.get("pending"):
+        logger.info(f"BACKFILL PLANNING STOPPED WITH "
+                    f"{len(checkpoint['pending'])} WINDOWS LEFT TO PROBE")
+        return {
+            "result": "incomplete",
+            "windows": len(checkpoint["windows"]),
+            "windows_completed": 0,
+            "articles": 0,
+            "messages": 0,
+        }
+
+    completed = {tuple(window) for window in checkpoint["completed"]}
+    remaining = [
+        window for window in checkpoint["windows"]
+        if (window[0], window[1]) not in completed
+    ]
+
+    publisher = get_publisher(info.reference, info.fifo, info.partitions,
+                              info.partition_key)
+    articles = messages = 0
+
+    with archiving() as archive, \
+            ThreadPoolExecutor(max_workers=backfill_workers) as executor:
+        futures = {}
+        for window in remaining:
+            if out_of_time(context):
+                break
+            futures[executor.submit(
+                fetch_backfill_window, api_key, info.search_term, window,
+                governor
+            )] = window
+
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+            window = futures[future]
+            pages = [page for page in (
+                drop_seen(info.reference, page) for page in future.result()
+            ) if page]
+            messages += publisher.publish([
+                article_message(page, [info.search_term]) for page in pages
+            ])
+            for page in pages:
+                mark_seen(info.reference, page)
+                articles += len(page)
+                if archive:
+                    archive.add(page, info.search_term, info.reference)
+            checkpoint["completed"].append([window[0], window[1]])
+            save_backfill_checkpoint(info, checkpoint)
+            if out_of_time(context):
+                for pending in futures:
+                    pending.cancel()
+
+    if seen_filter_enabled:
+        save_seen_filter(info.reference)
+    done = len(checkpoint["completed"]) == len(checkpoint["windows"])
+    if done:
+        delete_backfill_checkpoint(info)
+    logger.info(f"BACKFILL PUBLISHED {articles} ARTICLES IN {messages} "
+                f"MESSAGES TO {info.reference}")
+
+    return {
+        "result": "complete" if done else "incomplete",
+        "windows": len(checkpoint["windows"]),
+        "windows_completed": len(checkpoint["completed"]),
+        "articles": articles,
+        "messages": messages,
+    }
+
+
+def run_search(info, api_key, governor=None):
+    """Fetches the first page of results for a search, formats them and
+    sends them to the reference, governed by governor (by default the
+    shared rate_governor).
+
+    Returns:
+         The publisher for the reference.
+    """
+    payload = {"api-key": api_key, "q": info.search_term,
+               "from-date": info.date_from, "to-date": info.date_to}
+
+    api_response = get_api_response_articles(
+        payload=payload, governor=governor).results
+    fetched_at = time.time()
+
+    publisher = get_publisher(info.reference, info.fifo, info.partitions,
+                              info.partition_key)
+
+    publish_search(info, publisher, api_response, fetched_at)
+
+    return publisher
+
+
+def emit_freshness(messages):
+    """Emits, for every search term of messages just enqueued, how stale
+    the newest article of each message was when it was fetched
+    (PublicationLag) and how long it then took to be enqueued
+    (EnqueueLag), in seconds. Messages that were spilled are left out
+    until they are sent from the spill store."""
+    if not freshness_metrics_enabled:
+        return
+    enqueued_at = time.time()
+    lags = {}
+    for message in messages:
+        attributes = message.get("attributes") or {}
+        if "fetched-at" not in attributes:
+            continue
+        fetched_at = parse_timestamp(
+            attributes["fetched-at"]["StringValue"])
+        published_at = parse_timestamp(
+            attributes.get("latest-publication-date", {}).get("StringValue"))
+        for term in json.loads(attributes["search-terms"]["StringValue"]):
+            publication, enqueue = lags.setdefault(term, ([], []))
+            if published_at is not None:
+                publication.append(round(fetched_at - published_at, 3))
+            enqueue.append(round(enqueued_at - fetched_at, 3))
+
+    for term, (publication, enqueue) in lags.items():
+        if publication:
+            emit_metric("PublicationLag", publication, "Seconds",
+                        search_term=term)
+        emit_metric("EnqueueLag", enqueue, "Seconds", search_term=term)
+
+
+def publish_search(info, publisher, api_response, fetched_at=None):
+    """Publishes the results of a search to its reference's publisher,
+    skipping articles it has already been sent. fetched_at is when the
+    results were fetched, by default now."""
+    if not api_response:
+        logger.error("THE API RESPONSE COULD NOT BE PROCESSED")
+
+    queue_reference = info.reference
+
+    if api_response and seen_filter_enabled:
+        api_response = drop_seen(queue_reference, api_response)
+        if not api_response:
+            logger.info("NO NEW ARTICLES TO PUBLISH")
+            return
+
+    message = article_message(api_response or [], [info.search_term],
+                              fetched_at=fetched_at)
+    if publisher.publish([message]):
+        emit_freshness([message])
+
+    print("MESSAGE HAS BEEN PUBLISHED")
+    logger.info("MESSAGE HAS BEEN PUBLISHED")
+
+    with archiving() as archive:
+        if archive:
+            archive.add(api_response or [], info.search_term,
+                        queue_reference, fetched_at)
+
+    if seen_filter_enabled:
+        mark_seen(queue_reference, api_response)
+        save_seen_filter(queue_reference)
+
+
+def split_date_range(start, end, shards):
+    """Splits [start, end] into at most the given number of contiguous,
+    roughly equal date ranges.
+
+    Returns:
+         A list of (from-date, to-date) pairs.
+    """
+    days = (end - start).days + 1
+    shards = max(1, min(shards, days))
+    ranges = []
+    for shard in range(shards):
+        shard_start = start + timedelta(days=days * shard // shards)
+        shard_end = start + timedelta(days=days * (shard + 1) // shards - 1)
+        ranges.append((shard_start, shard_end))
+    return ranges
+
+
+def plan_worker_events(plan, run_id):
+    """Plans the coordinator's work as search terms x date shards and groups
+    the resulting tasks into worker events.
+
+    Searches with a date_from are split into backfill tasks over date
+    shards; searches without one become a single search task. The Guardian
+    rate limit is shared out between the workers so that together they
+    stay within it.
+
+    Returns:
+         A list of worker events.
+    """
+    tasks = []
+    for search in plan.searches:
+        if not search.date_from:
+            tasks.append(search.model_dump())
+            continue
+        end = parse_date(search.date_to) if search.date_to else date.today()
+        for shard_start, shard_end in split_date_range(
+            parse_date(search.date_from), end, plan.shards_per_search
+        ):
+            tasks.append(search.model_copy(update={
+                "mode": "backfill",
+                "date_from": shard_start.isoformat(),
+                "date_to": shard_end.isoformat(),
+            }).model_dump())
+
+    chunks = [
+        tasks[i:i + plan.tasks_per_worker]
+        for i in range(0, len(tasks), plan.tasks_per_worker)
+    ]
+    return [
+        {
+            "mode": "worker",
+            "run_id": run_id,
+            "worker": worker,
+            "tasks": chunk,
+            "requests_per_second": requests_per_second / len(chunks),
+        }
+        for worker, chunk in enumerate(chunks)
+    ]
+
+
+class LambdaInvoker:
+    """Fans worker events out as asynchronous invocations of this lambda
+    function. Workers report back through a completion queue created for
+    the run, which collect() drains.
+    """
+
+    def __init__(self, function_name, run_id):
+        self.function_name = function_name
+        self.lambda_client = get_client("lambda")
+        self.completion_queue = create_sqs_queue(f"{run_id}_completions")
+
+    def dispatch(self, event):
+        event = {**event, "completion_queue": self.completion_queue}
+        try:
+            self.lambda_client.invoke(
+                FunctionName=self.function_name,
+                InvocationType="Event",
+                Payload=json.dumps(event),
+            )
+        except ClientError as e:
+            raise SystemExit(
+                f'"The worker could not be invoked. Please contact AWS:", {e}'
+            )
+
+    def collect(self, expected, deadline, context=None):
+        sqs_client = get_client("sqs")
+        received = 0
+        while (received < expected and time.monotonic() < deadline
+               and not out_of_time(context)):
+            response = sqs_client.receive_message(
+                QueueUrl=self.completion_queue,
+                MaxNumberOfMessages=10,
+                WaitTimeSeconds=5,
+            )
+            for message in response.get("Messages", []):
+                sqs_client.delete_message(
+                    QueueUrl=self.completion_queue,
+                    ReceiptHandle=message["ReceiptHandle"],
+                )
+                received += 1
+                yield json.loads(message["Body"])
+        if received == expected:
+            sqs_client.delete_queue(QueueUrl=self.completion_queue)
+
+
+class ProcessPoolInvoker:
+    """Runs worker events in a local process pool instead of invoking
+    lambda, for testing the coordinator away from AWS."""
+
+    def __init__(self, max_workers=None, handler=None):
+        self.executor = ProcessPoolExecutor(max_workers=max_workers)
+        self.handler = handler or lambda_handler
+        self.futures = {}
+
+    def dispatch(self, event):
+        future = self.executor.submit(self.handler, event)
+        self.futures[future] = event
+
+    def collect(self, expected, deadline, context=None):
+        try:
+            for future in as_completed(
+                self.futures, timeout=max(0, deadline - time.monotonic())
+            ):
+                event = self.futures[future]
+                try:
+                    yield future.result()
+                except BaseException as e:
+                    yield {"run_id": event["run_id"],
+                           "worker": event["worker"],
+                           "result": "error", "message": str(e)}
+        except TimeoutError:
+            return
+        finally:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def run_coordinator(plan, context=None, invoker=None):
+    """Plans the work for a list of searches, dispatches it to workers and
+    aggregates their completion records.
+
+    Workers are asynchronous invocations of this same function unless
+    another invoker is given (or there is no lambda context), in which case
+    a local process pool is used.
+
+    Returns:
+         A summary of the run with every completion record received. The
+         result is "incomplete" if some workers had not reported back by
+         the time the coordinator stopped waiting.
+    """
+    run_id = f"coordinator_{uuid.uuid4().hex[:12]}"
+    events = plan_worker_events(plan, run_id)
+
+    if invoker is None:
+        if context is not None and hasattr(context, "function_name"):
+            invoker = LambdaInvoker(context.function_name, run_id)
+        else:
+            invoker = ProcessPoolInvoker()
+
+    for event in events:
+        invoker.dispatch(event)
+    logger.info(f"COORDINATOR {run_id} DISPATCHED {len(events)} WORKERS")
+
+    deadline = time.monotonic() + plan.wait_seconds
+    records = list(invoker.collect(len(events), deadline, context))
+
+    done = (len(records) == len(events)
+            and all(r["result"] == "complete" for r in records))
+    return {
+        "result": "complete" if done else "incomplete",
+        "run_id": run_id,
+        "workers": len(events),
+        "workers_reported": len(records),
+        "articles": sum(r.get("articles", 0) for r in records),
+        "records": sorted(records, key=lambda r: r["worker"]),
+    }
+
+
+def run_worker(plan, context=None):
+    """Runs the tasks handed to a worker invocation by the coordinator and
+    reports a completion record to the coordinator's queue.
+
+    Returns:
+         The completion record.
+    """
+    # The worker's share of the rate applies to its own api calls only, so
+    # they get their own token bucket, passed down to every call
+    governor = RateGovernor(plan.requests_per_second)
+    api_key = get_api_key()
+
+    articles = 0
+    incomplete = []
+    for task in plan.tasks:
+        if task.mode == "backfill":
+            summary = run_backfill(task, api_key, context, governor)
+            articles += summary["articles"]
+            if summary["result"] != "complete":
+                incomplete.append(task.model_dump())
+        else:
+            run_search(task, api_key, governor)
+
+    record = {
+        "run_id": plan.run_id,
+        "worker": plan.worker,
+        "result": "incomplete" if incomplete else "complete",
+        "tasks": len(plan.tasks),
+        "articles": articles,
+        "incomplete_tasks": incomplete,
+    }
+    if plan.completion_queue:
+        send_sqs_message(json.dumps(record), plan.completion_queue)
+    return record
+
+
+class AhoCorasick:
+    """A word level Aho-Corasick automaton.
+
+    Patterns are tuples of words. search() finds every pattern occurring in
+    a list of words in one pass, however many patterns there are.
+    """
+
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+        for pattern_id, pattern in enumerate(patterns):
+            state = 0
+            for word in pattern:
+                next_state = self.goto[state].get(word)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                    self.goto[state][word] = next_state
+                state = next_state
+            self.out[state].append(pattern_id)
+
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for word, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and word not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(word, 0)
+                self.out[next_state] = (
+                    self.out[next_state] + self.out[self.fail[next_state]])
+
+    def search(self, words):
+        found = set()
+        state = 0
+        for word in words:
+            while state and word not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(word, 0)
+            found.update(self.out[state])
+        return found
+
+
+def tokenise(text):
+    return re.findall(r"\w+", text.lower())
+
+
+def parse_query(query, phrase_ids):
+    """Parses a Guardian style search term into a boolean expression.
+
+    Terms and "quoted phrases" are combined with AND, OR, NOT and
+    parentheses, and neighbouring terms are ANDed. Each phrase is given an
+    id in phrase_ids.
+
+    Returns:
+         A nested tuple of ("or", [...]), ("and", [...]), ("not", expr)
+         and ("phrase", phrase_id).
+    """
+    tokens = re.findall(r'\(|\)|"[^"]*"|[^\s()"]+', query)
+    position = 0
+
+    def peek():
+        return tokens[position] if position < len(tokens) else None
+
+    def take():
+        nonlocal position
+        position += 1
+        return tokens[position - 1]
+
+    def or_expr():
+        terms = [and_expr()]
+        while peek() == "OR":
+            take()
+            terms.append(and_expr())
+        return terms[0] if len(terms) == 1 else ("or", terms)
+
+    def and_expr():
+        terms = [not_expr()]
+        while peek() not in (None, "OR", ")"):
+            if peek() == "AND":
+                take()
+            terms.append(not_expr())
+        return terms[0] if len(terms) == 1 else ("and", terms)
+
+    def not_expr():
+        if peek() == "NOT":
+            take()
+            return ("not", not_expr())
+        if peek() == "(":
+            take()
+            expr = or_expr()
+            if peek() == ")":
+                take()
+            return expr
+        if peek() is None:
+            raise ValueError(f"Incomplete search term: {query}")
+        phrase = tuple(tokenise(take().strip('"')))
+        if not phrase:
+            raise ValueError(f"Search term has no words: {query}")
+        return ("phrase", phrase_ids.setdefault(phrase, len(phrase_ids)))
+
+    expr = or_expr()
+    if peek() is not None:
+        raise ValueError(f"Unbalanced search term: {query}")
+    return expr
+
+
+def evaluate_query(expr, found):
+    kind, value = expr
+    if kind == "phrase":
+        return value in found
+    if kind == "not":
+        return not evaluate_query(value, found)
+    if kind == "and":
+        return all(evaluate_query(term, found) for term in value)
+    return any(evaluate_query(term, found) for term in value)
+
+
+class QueryMatcher:
+    """Matches articles against many saved searches at once.
+
+    Every phrase from every query is compiled into one Aho-Corasick
+    automaton over the article's title and trail text, so an article is
+    scanned once and only the queries containing a phrase it matched are
+    evaluated. Matching is on whole words, case insensitive and without
+    the Guardian's stemming, so it can be slightly stricter than the api.
+    """
+
+    def __init__(self, queries):
+        phrase_ids = {}
+        self.queries = []
+        for query in queries:
+            try:
+                expr = parse_query(query.search_term, phrase_ids)
+            except ValueError as e:
+                logger.error(f"SKIPPING SAVED SEARCH: {e}")
+                continue
+            self.queries.append((query, expr))
+
+        self.automaton = AhoCorasick(list(phrase_ids))
+        self.by_phrase = {}
+        self.always = []
+        for index, (query, expr) in enumerate(self.queries):
+            if evaluate_query(expr, set()):
+                self.always.append(index)
+            for phrase_id in phrase_ids_in(expr):
+                self.by_phrase.setdefault(phrase_id, set()).add(index)
+
+    def match(self, article):
+        """Returns the saved searches matched by a Guardian result."""
+        text = article.get("webTitle", "")
+        trail_text = article.get("fields", {}).get("trailText")
+        if trail_text:
+            text += " " + re.sub(r"<[^>]+>", " ", trail_text)
+        found = self.automaton.search(tokenise(text))
+
+        candidates = set(self.always)
+        for phrase_id in found:
+            candidates.update(self.by_phrase[phrase_id])
+        return [
+            self.queries[index][0] for index in sorted(candidates)
+            if evaluate_query(self.queries[index][1], found)
+        ]
+
+
+def phrase_ids_in(expr):
+    kind, value = expr
+    if kind == "phrase":
+        return {value}
+    if kind == "not":
+        return phrase_ids_in(value)
+    return set().union(*(phrase_ids_in(term) for term in value))
+
+
+def chunked(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def deduplicate_matches(matches):
+    """The batch level dedup stage: collapses (search, article) matches
+    so that each article is formatted once and appears once per reference
+    queue, however many searches matched it. Articles the seen filter
+    says a reference already has are dropped before formatting.
+
+    Returns:
+         A dict of reference to a list of formatted articles, each with
+         the list of search terms that matched it for that reference, a
+         dict of dedup stats, and a dict of reference to the api results
+         the articles were formatted from, in the same order.
+    """
+    formatted = {}
+    sources = {}
+    by_reference = {}
+    raw = 0
+    for search, article in matches:
+        raw += 1
+        if seen_filter_enabled and \
+                article["id"] in get_seen_filter(search.reference):
+            continue
+        if article["id"] not in formatted:
+            formatted[article["id"]] = format_article(article)
+            sources[article["id"]] = article
+        terms = by_reference.setdefault(search.reference, {}).setdefault(
+            article["id"], [])
+        if search.search_term not in terms:
+            terms.append(search.search_term)
+
+    messages = {
+        reference: [
+            {**formatted[article_id], "matched_terms": terms}
+            for article_id, terms in articles.items()
+        ]
+        for reference, articles in by_reference.items()
+    }
+    reference_sources = {
+        reference: [sources[article_id] for article_id in articles]
+        for reference, articles in by_reference.items()
+    }
+    published = sum(len(articles) for articles in messages.values())
+    stats = {
+        "matches": raw,
+        "articles": len(formatted),
+        "published": published,
+        "dedup_ratio": 1 - published / raw if raw else 0.0,
+    }
+    return messages, stats, reference_sources
+
+
+def publish_deduplicated(messages, matches, fetched_at=None, sources=None):
+    """Sends each reference its deduplicated articles, in chunks of up to
+    a page of results per message, then records the matches as seen.
+    fetched_at is when the articles were fetched, by default now, and
+    sources are the api results of each reference's articles, as returned
+    by deduplicate_matches, which key the messages by id and section.
+
+    A reference is a fifo queue if any search sending to it asks for one,
+    and is partitioned if a search sending to it asks for partitions.
+    For fifo queues and other ordered backends the articles are grouped by
+    the first search term they matched, which is used as the message
+    group. Every match is archived when archiving is switched on.
+    """
+    fifo_references = {
+        search.reference for search, _ in matches if search.fifo}
+    partitioned = {search.reference: search for search, _ in matches
+                   if search.partitions}
+    for reference, articles in messages.items():
+        search = partitioned.get(reference)
+        publisher = get_publisher(
+            reference, reference in fifo_references,
+            search.partitions if search else 0,
+            search.partition_key if search else "id")
+        pairs = list(zip(articles,
+                         (sources or {}).get(reference) or articles))
+        if publisher.ordered:
+            groups = {}
+            for pair in pairs:
+                groups.setdefault(pair[0]["matched_terms"][0], []).append(pair)
+        else:
+            groups = {None: pairs}
+        reference_messages = []
+        for term, group in groups.items():
+            for chunk in chunked(group, backfill_page_size):
+                chunk_articles = [article for article, _ in chunk]
+                reference_messages.append(article_message(
+                    chunk_articles,
+                    [term] if term else sorted({
+                        matched_term for article in chunk_articles
+                        for matched_term in article["matched_terms"]}),
+                    body=json.dumps(chunk_articles), fetched_at=fetched_at,
+                    sources=[source for _, source in chunk]))
+        if publisher.publish(reference_messages):
+            emit_freshness(reference_messages)
+
+    with archiving() as archive:
+        if archive:
+            for search, article in matches:
+                archive.add([article], search.search_term,
+                            search.reference, fetched_at)
+
+    if seen_filter_enabled:
+        references = set()
+        for search, article in matches:
+            mark_seen(search.reference, [article])
+            references.add(search.reference)
+        for reference in references:
+            save_seen_filter(reference)
+
+
+def run_batch(plan, api_key):
+    """Runs several searches in one invocation, deduplicates the articles
+    they have in common and publishes each article once per reference
+    queue, annotated with the search terms it matched.
+
+    Returns:
+         A summary with the dedup stats.
+    """
+    def fetch(search):
+        payload = {"api-key": api_key, "q": search.search_term,
+                   "from-date": search.date_from, "to-date": search.date_to}
+        return [(search, article)
+                for article in get_api_response_page(payload).results]
+
+    with ThreadPoolExecutor(max_workers=backfill_workers) as executor:
+        matches = [
+            match for results in executor.map(fetch, plan.searches)
+            for match in results
+        ]
+
+    return publish_batch(matches, time.time())
+
+
+def publish_batch(matches, fetched_at=None):
+    """Deduplicates and publishes the (search, article) matches of a batch,
+    fetched at fetched_at (by default now).
+
+    Returns:
+         A summary with the dedup stats.
+    """
+    messages, stats, sources = deduplicate_matches(matches)
+    publish_deduplicated(messages, matches, fetched_at, sources)
+    emit_metric("DedupRatio", stats["dedup_ratio"], mode="batch")
+    logger.info(f"BATCH PUBLISHED {stats['published']} OF "
+                f"{stats['matches']} MATCHED ARTICLES")
+    return {"result": "complete", **stats}
+
+
+def run_percolator(plan, api_key, context=None):
+    """Reads the newest content from the Guardian api once and matches
+    every saved search against it locally, instead of making one api call
+    per search.
+
+    The first run reads max_pages pages, newest first. Later runs pick up
+    from the newest article seen before (a publication date watermark,
+    kept in CHECKPOINT_BUCKET or checkpoint_dir like backfill
+    checkpoints), reading oldest first from the watermark's day, so the
+    watermark only moves over articles that were read. Articles left when
+    max_pages is reached or time runs out are read on the next run, and
+    the pages left are logged and emitted as a PercolatorBacklog metric.
+    Matched articles are sent to the reference queue of each search they
+    match, deduplicated and annotated with the terms they matched as in a
+    batch run.
+
+    Returns:
+         A summary with the number of articles scanned and matched per
+         reference.
+    """
+    matcher = QueryMatcher(plan.queries)
+    path = os.path.join(checkpoint_dir, "percolator_watermark.json")
+    watermark = (load_stored_checkpoint(path) or {}).get("watermark", "")
+    newest = watermark
+    payload = {
+        "api-key": api_key,
+        "order-by": "newest",
+        "show-fields": "trailText",
+        "page-size": backfill_page_size,
+    }
+    if watermark:
+        payload.update({"order-by": "oldest", "from-date": watermark[:10]})
+
+    matches = []
+    scanned = pages = 0
+    fetched_at = None
+    page, last_page = 1, 1
+    while page <= min(last_page, plan.max_pages) and not out_of_time(context):
+        response = get_api_response_page({**payload, "page": page})
+        last_page = response.pages
+        pages += 1
+        fetched_at = fetched_at or time.time()
+        for article in response.results:
+            if article.webPublicationDate <= watermark:
+                continue
+            newest = max(newest, article.webPublicationDate)
+            scanned += 1
+            matches.extend(
+                (query, article) for query in matcher.match(article))
+        page += 1
+
+    messages, stats, sources = deduplicate_matches(matches)
+    publish_deduplicated(messages, matches, fetched_at, sources)
+    save_stored_checkpoint(path, {"watermark": newest})
+    emit_metric("DedupRatio", stats["dedup_ratio"], mode="percolate")
+    if watermark:
+        backlog = max(last_page - page + 1, 0)
+        if backlog:
+            logger.warning(f"PERCOLATOR STOPPED {backlog} PAGES SHORT OF "
+                           f"THE NEWEST CONTENT")
+        emit_metric("PercolatorBacklog", backlog, "Count",
+                    mode="percolate")
+
+    logger.info(f"PERCOLATOR MATCHED {scanned} ARTICLES AGAINST "
+                f"{len(matcher.queries)} SAVED SEARCHES")
+    return {
+        "result": "complete",
+        "pages": pages,
+        "articles_scanned": scanned,
+        "references": {
+            reference: len(articles)
+            for reference, articles in messages.items()
+        },
+        **stats,
+    }
+
+
+class FileSearchRegistry:
+    """Keeps the saved searches and the scheduler's state in a json file.
+    Changes are written by flush()."""
+
+    def __init__(self, path):
+        self.path = path
+        self.searches = {}
+        self.state = {}
+
+    def load(self):
+        """Returns the saved searches by id and the scheduler's state."""
+        registry = load_checkpoint(self.path) or {}
+        self.searches = registry.get("searches", {})
+        self.state = registry.get("state", {})
+        return {
+            search_id: SavedSearch.model_validate(search)
+            for search_id, search in self.searches.items()
+        }, self.state
+
+    def put(self, search):
+        self.searches[search.search_id] = search.model_dump()
+
+    def delete(self, search_id):
+        self.searches.pop(search_id, None)
+
+    def put_state(self, state):
+        self.state = state
+
+    def flush(self):
+        save_checkpoint(self.path, {"searches": self.searches,
+                                    "state": self.state})
+
+
+class DynamoDBSearchRegistry:
+    """Keeps each saved search as an item of a DynamoDB (or DynamoDB
+    compatible) table with a string partition key "id", and the
+    scheduler's state in the item "#state"."""
+
+    state_id = "#state"
+
+    def __init__(self, table, endpoint_url=None):
+        self.table = table
+        self.dynamodb_client = get_client("dynamodb",
+                                          endpoint_url=endpoint_url)
+
+    def load(self):
+        """Returns the saved searches by id and the scheduler's state."""
+        searches, state = {}, {}
+        paginator = self.dynamodb_client.get_paginator("scan")
+        for page in paginator.paginate(TableName=self.table,
+                                       ConsistentRead=True):
+            for item in page["Items"]:
+                if item["id"]["S"] == self.state_id:
+                    state = json.loads(item["state"]["S"])
+                else:
+                    searches[item["id"]["S"]] = SavedSearch.model_validate(
+                        json.loads(item["search"]["S"]))
+        return searches, state
+
+    def put(self, search):
+        self.dynamodb_client.put_item(
+            TableName=self.table,
+            Item={"id": {"S": search.search_id},
+                  "search": {"S": search.model_dump_json()}},
+        )
+
+    def delete(self, search_id):
+        self.dynamodb_client.delete_item(
+            TableName=self.table, Key={"id": {"S": search_id}})
+
+    def put_state(self, state):
+        self.dynamodb_client.put_item(
+            TableName=self.table,
+            Item={"id": {"S": self.state_id},
+                  "state": {"S": json.dumps(state)}},
+        )
+
+    def flush(self):
+        pass
+
+
+def make_search_registry():
+    """Builds the saved search registry named by REGISTRY_STORE."""
+    if registry_store_type == "dynamodb":
+        return DynamoDBSearchRegistry(registry_table, registry_endpoint_url)
+    return FileSearchRegistry(os.path.join(checkpoint_dir,
+                                           "saved_searches.json"))
+
+
+def refill_quota(state, now):
+    """Returns the scheduler's budget of api calls for this tick: what was
+    left after the last tick plus the share of the daily quota earned
+    since, holding at most an hour's worth."""
+    burst = max(1.0, guardian_daily_quota / 24)
+    tokens = state.get("tokens", burst)
+    elapsed = now - state.get("updated", now)
+    return min(burst, tokens + elapsed * guardian_daily_quota / 86400)
+
+
+def next_poll_interval(search, new_articles, elapsed, saturated):
+    """Works out how often to poll a saved search after a poll that found
+    new_articles in the elapsed seconds since the last one.
+
+    The arrival rate (articles a second) is smoothed across polls. A poll
+    that found nothing doubles the interval, otherwise it is the time for
+    schedule_target_articles to arrive at that rate, divided by the
+    priority. A page full of new articles may mean some were missed, so
+    the interval is then at least halved.
+
+    Returns:
+         The new rate and interval.
+    """
+    if search.last_run is None:
+        return search.rate, schedule_min_interval
+
+    observed = new_articles / max(elapsed, 1)
+    rate = (schedule_rate_smoothing * observed
+            + (1 - schedule_rate_smoothing) * search.rate)
+    if not new_articles:
+        interval = max(search.interval, schedule_min_interval) * 2
+    else:
+        interval = schedule_target_articles / rate / search.priority
+        if saturated:
+            interval = min(interval, search.interval / 2)
+    return rate, min(max(interval, schedule_min_interval),
+                     schedule_max_interval)
+
+
+def quota_stretch(searches):
+    """Returns how much every interval has to be stretched for polling all
+    the saved searches to fit in the daily quota."""
+    calls_per_day = sum(
+        86400 / max(search.interval, schedule_min_interval)
+        for search in searches
+    )
+    return max(1.0, calls_per_day / guardian_daily_quota)
+
+
+def poll_saved_search(search, api_key):
+    """Fetches the results for a saved search published after its
+    watermark and publishes them.
+
+    The first poll of a search reads the newest page of results. Later
+    polls read the results from the watermark's day onwards, oldest
+    first, a page at a time, for up to schedule_max_pages pages. Articles
+    beyond the last page read are newer than every article published, so
+    the next poll picks them up from the new watermark.
+
+    Returns:
+         The new articles, whether there were more than one poll could
+         read (saturated), and the number of api calls made.
+    """
+    payload = {"api-key": api_key, "q": search.search_term,
+               "from-date": search.date_from, "to-date": search.date_to,
+               "order-by": "newest", "page-size": backfill_page_size}
+    if search.watermark:
+        payload.update({
+            "from-date": max(search.date_from or "", search.watermark[:10]),
+            "order-by": "oldest"})
+
+    new_articles = []
+    page, last_page = 1, 1
+    while page <= min(last_page, schedule_max_pages):
+        response = get_api_response_articles(
+            payload={**payload, "page": page})
+        last_page = 1 if not search.watermark else response.pages
+        new_articles.extend(
+            article for article in response.results
+            if article.webPublicationDate > search.watermark)
+        page += 1
+    fetched_at = time.time()
+    if search.watermark:
+        saturated = last_page > schedule_max_pages
+    else:
+        saturated = bool(response.results) and \
+            len(new_articles) == len(response.results)
+
+    if new_articles:
+        publisher = get_publisher(search.reference, search.fifo,
+                                  search.partitions, search.partition_key)
+        publish_search(search, publisher, new_articles, fetched_at)
+    return new_articles, saturated, page - 1
+
+
+def run_scheduler(plan, api_key=None):
+    """Runs a scheduler tick: updates the saved search registry with the
+    plan, then polls the searches that are due.
+
+    Due searches run highest priority (then longest overdue) first, as
+    many as the quota budget allows; the rest stay due for the next tick.
+    Each poll publishes only articles newer than the search's watermark
+    and reschedules the search by its arrival rate (see
+    next_poll_interval), stretched if every search polled that often would
+    use more than the daily quota. A poll that fails is retried after the
+    minimum interval.
+
+    Returns:
+         A summary with the searches polled and deferred.
+    """
+    registry = make_search_registry()
+    searches, state = registry.load()
+
+    for search_id in plan.remove:
+        if searches.pop(search_id, None):
+            registry.delete(search_id)
+    for search in plan.add:
+        existing = searches.get(search.search_id)
+        if existing:
+            search = search.model_copy(update={
+                field: getattr(existing, field) for field in schedule_fields})
+        searches[search.search_id] = search
+        registry.put(search)
+
+    now = time.time()
+    tokens = refill_quota(state, now)
+    due = sorted(
+        (search for search in searches.values() if search.next_run <= now),
+        key=lambda search: (-search.priority, search.next_run))
+    dispatched = due[:int(tokens)]
+    if dispatched:
+        api_key = api_key or get_api_key()
+
+    def poll(search):
+        # One failed poll mustn't stop the tick, or the registry is
+        # never updated
+        try:
+            return poll_saved_search(search, api_key)
+        except (Exception, SystemExit) as e:
+            logger.error(f"Saved search {search.search_id} failed: {e}")
+
+    with ThreadPoolExecutor(max_workers=backfill_workers) as executor:
+        polls = list(executor.map(poll, dispatched))
+
+    new_articles = {}
+    calls = 0
+    for search, result in zip(dispatched, polls):
+        if result is None:
+            calls += 1
+            continue
+        articles, saturated, poll_calls = result
+        calls += poll_calls
+        elapsed = now - search.last_run if search.last_run else None
+        search.rate, search.interval = next_poll_interval(
+            search, len(articles), elapsed, saturated)
+        search.last_run = now
+        if articles:
+            search.watermark = max(
+                article["webPublicationDate"] for article in articles)
+        new_articles[search.search_id] = len(articles)
+
+    stretch = quota_stretch(searches.values())
+    for search in dispatched:
+        if search.search_id in new_articles:
+            search.next_run = now + search.interval * stretch
+        else:
+            search.next_run = now + schedule_min_interval
+        registry.put(search)
+
+    registry.put_state({"tokens": tokens - calls, "updated": now})
+    registry.flush()
+
+    deferred = len(due) - len(dispatched)
+    emit_metric("ScheduledSearches", len(dispatched), "Count",
+                mode="schedule")
+    emit_metric("DeferredSearches", deferred, "Count", mode="schedule")
+    logger.info(f"SCHEDULER POLLED {len(dispatched)} OF {len(due)} "
+                f"DUE SEARCHES")
+    return {
+        "result": "complete",
+        "searches": len(searches),
+        "polled": new_articles,
+        "failed": len(dispatched) - len(new_articles),
+        "deferred": deferred,
+        "quota_stretch": stretch,
+    }
+
+
+class MemoryIdempotencyStore:
+    """Keeps idempotency records in this container's memory.
+
+    Expiry times are also kept in a heap, so that start() can drop the
+    expired records without scanning them all and a long-running process
+    only holds the records still live."""
+
+    def __init__(self):
+        self.records = {}
+        self.expiries = []
+        self.lock = threading.Lock()
+
+    def purge(self, now):
+        while self.expiries and self.expiries[0][0] <= now:
+            _, key = heapq.heappop(self.expiries)
+            record = self.records.get(key)
+            # A key written again since has a later expiry of its own
+            if record and record["expiry"] <= now:
+                del self.records[key]
+
+    def get(self, key):
+        record = self.records.get(key)
+        if record and record["expiry"] > time.time():
+            return record
+
+    def start(self, key, expiry):
+        with self.lock:
+            self.purge(time.time())
+            if self.get(key):
+                return False
+            self.records[key] = {"status": "in_progress", "expiry": expiry}
+            heapq.heappush(self.expiries, (expiry, key))
+            return True
+
+    def complete(self, key, result, expiry):
+        with self.lock:
+            self.records[key] = {"status": "completed", "result": result,
+                                 "expiry": expiry}
+            heapq.heappush(self.expiries, (expiry, key))
+
+    def delete(self, key):
+        self.records.pop(key, None)
+
+
+class FileIdempotencyStore:
+    """Keeps idempotency records as json files in a local directory.
+    Records are replaced whole, and start() checks and takes a key while
+    holding a lock on the directory's lock file, so that threads and
+    processes sharing the directory never both start the same event."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.lock_path = os.path.join(directory, ".lock")
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        record = load_checkpoint(self.path(key))
+        if record and record["expiry"] > time.time():
+            return record
+
+    def write(self, key, record):
+        path = self.path(key)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(record, f)
+        os.replace(tmp_path, path)
+
+    def start(self, key, expiry):
+        with open(self.lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if self.get(key):
+                return False
+            self.write(key, {"status": "in_progress", "expiry": expiry})
+            return True
+
+    def complete(self, key, result, expiry):
+        self.write(key, {
+            "status": "completed", "result": result, "expiry": expiry})
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+
+class DynamoDBIdempotencyStore:
+    """Keeps idempotency records in a DynamoDB (or DynamoDB compatible)
+    table with a string partition key "id". Set the table's time to live
+    attribute to "expiry" to have old records removed."""
+
+    def __init__(self, table, endpoint_url=None):
+        self.table = table
+        self.dynamodb_client = get_client("dynamodb",
+                                          endpoint_url=endpoint_url)
+
+    def get(self, key):
+        item = self.dynamodb_client.get_item(
+            TableName=self.table, Key={"id": {"S": key}},
+            ConsistentRead=True).get("Item")
+        if item and float(item["expiry"]["N"]) > time.time():
+            record = {"status": item["status"]["S"],
+                      "expiry": float(item["expiry"]["N"])}
+            if "result" in item:
+                record["result"] = json.loads(item["result"]["S"])
+            return record
+
+    def start(self, key, expiry):
+        try:
+            self.dynamodb_client.put_item(
+                TableName=self.table,
+                Item={"id": {"S": key}, "status": {"S": "in_progress"},
+                      "expiry": {"N": str(expiry)}},
+                ConditionExpression=(
+                    "attribute_not_exists(id) OR #expiry < :now"),
+                ExpressionAttributeNames={"#expiry": "expiry"},
+                ExpressionAttributeValues={":now": {"N": str(time.time())}},
+            )
+            return True
+        except self.dynamodb_client.exceptions.ConditionalCheckFailedException:
+            return False
+
+    def complete(self, key, result, expiry):
+        self.dynamodb_client.put_item(
+            TableName=self.table,
+            Item={"id": {"S": key}, "status": {"S": "completed"},
+                  "result": {"S": json.dumps(result)},
+                  "expiry": {"N": str(expiry)}},
+        )
+
+    def delete(self, key):
+        self.dynamodb_client.delete_item(
+            TableName=self.table, Key={"id": {"S": key}})
+
+
+def make_idempotency_store():
+    """Builds the idempotency store named by IDEMPOTENCY_STORE."""
+    if idempotency_store_type == "dynamodb":
+        return DynamoDBIdempotencyStore(idempotency_table,
+                                        idempotency_endpoint_url)
+    if idempotency_store_type == "file":
+        return FileIdempotencyStore(os.path.join(checkpoint_dir,
+                                                 "idempotency"))
+    if idempotency_store_type == "memory":
+        return MemoryIdempotencyStore()
+    return None
+
+
+idempotency_store = make_idempotency_store()
+
+
+def idempotency_hash(request, key):
+    """Hashes a validated event together with the caller's key."""
+    content = json.dumps({"event": type(request).__name__,
+                          "fields": request.model_dump(), "key": key},
+                         sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def run_idempotent(request, key, run):
+    """Runs an event at most once per idempotency key.
+
+    The first run records the event as in progress and then stores its
+    result. A repeated event returns the stored result (or an in progress
+    result while the first run is still going) without calling the
+    Guardian api or sqs. A run that fails is forgotten so that a retry can
+    run it again, and so is an incomplete backfill so that it can resume.
+    Events without a key, or with no store configured, always run.
+    """
+    if key is None or idempotency_store is None:
+        return run()
+
+    record_key = idempotency_hash(request, key)
+    if not idempotency_store.start(record_key,
+                                   time.time() + idempotency_lock_seconds):
+        record = idempotency_store.get(record_key)
+        if record and record["status"] == "completed":
+            logger.info(f"RETURNING STORED RESULT FOR {record_key}")
+            return record["result"]
+        return {"result": "in_progress", "idempotency_key": record_key}
+
+    try:
+        result = run()
+    except BaseException:
+        idempotency_store.delete(record_key)
+        raise
+
+    if isinstance(result, dict) and result.get("result") == "incomplete":
+        idempotency_store.delete(record_key)
+    else:
+        idempotency_store.complete(record_key, result,
+                                   time.time() + idempotency_ttl)
+    return result
+
+
+def handle_request(request, context=None, api_key=None):
+    """Runs a validated event in the mode it asks for. The api key is read
+    from secrets manager unless it is given."""
+    if isinstance(request, CoordinatorPlan):
+        return run_coordinator(request, context)
+    if isinstance(request, WorkerPlan):
+        return run_worker(request, context)
+    if isinstance(request, SchedulePlan):
+        return run_scheduler(request, api_key)
+
+    api_key = api_key or get_api_key()
+
+    if isinstance(request, PercolatePlan):
+        return run_percolator(request, api_key, context)
+    if isinstance(request, BatchPlan):
+        return run_batch(request, api_key)
+    if request.mode == "backfill":
+        return run_backfill(request, api_key, context)
+
+    publisher = run_search(request, api_key)
+
+    if not isinstance(publisher, SqsPublisher):
+        return {"result": "complete", "reference": request.reference}
+
+    view_response = view_sqs_message(publisher.queue_url)
+
+    return view_response
+
+
+class SamplingProfiler:
+    """Samples the stack of every other thread from a background thread,
+    so that time spent in worker threads and waiting on the network shows
+    up as well, unlike with cProfile."""
+
+    def __init__(self, interval=None):
+        self.interval = interval or profile_interval
+        self.frames = {}
+        self.samples = {}
+        self.started = self.stopped = None
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def start(self):
+        self.started = time.monotonic()
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+        self.stopped = time.monotonic()
+
+    def sample(self):
+        own = threading.get_ident()
+        names = {}
+        while not self.stopping.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                if ident not in names:
+                    names.update((thread.ident, thread.name)
+                                 for thread in threading.enumerate())
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(self.frames.setdefault(
+                        (code.co_name, code.co_filename, code.co_firstlineno),
+                        len(self.frames)))
+                    frame = frame.f_back
+                self.samples.setdefault(
+                    names.get(ident, str(ident)), []).append(stack[::-1])
+
+    def speedscope(self, name):
+        """Returns the samples in speedscope's file format, with a profile
+        for each thread."""
+        duration = self.stopped - self.started
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": name,
+            "exporter": "stream",
+            "shared": {"frames": [
+                {"name": function, "file": file, "line": line}
+                for function, file, line in self.frames
+            ]},
+            "profiles": [
+                {"type": "sampled", "name": thread, "unit": "seconds",
+                 "startValue": 0, "endValue": duration,
+                 "samples": samples,
+                 "weights": [self.interval] * len(samples)}
+                for thread, samples in self.samples.items()
+            ],
+        }
+
+
+def should_profile(event):
+    """Decides whether an invocation is profiled, at the cost of a dict
+    lookup (and a random draw when sampling) when it isn't."""
+    if isinstance(event, dict) and event.get("profile"):
+        return True
+    return profile_sample_rate > 0 and random.random() < profile_sample_rate
+
+
+def memory_report(snapshot, seconds):
+    """Summarises a tracemalloc snapshot: the peak memory traced, and the
+    lines that allocated most of what was still held at the end."""
+    current, peak = tracemalloc.get_traced_memory()
+    return {
+        "seconds": round(seconds, 6),
+        "peak_bytes": peak,
+        "current_bytes": current,
+        "top_allocations": [
+            {"where": f"{stat.traceback[0].filename}:"
+                      f"{stat.traceback[0].lineno}",
+             "bytes": stat.size, "count": stat.count}
+            for stat in snapshot.statistics("lineno")[:profile_memory_sites]
+        ],
+    }
+
+
+def save_profile(name, profiler, report):
+    """Writes a profile and its memory report to profile_dir, and uploads
+    them to profiles/ in profile_bucket when one is set.
+
+    Returns:
+         The paths of the files written.
+    """
+    os.makedirs(profile_dir, exist_ok=True)
+    stem = os.path.join(profile_dir, name)
+    if isinstance(profiler, SamplingProfiler):
+        profile_path = f"{stem}.speedscope.json"
+        with open(profile_path, "w") as f:
+            json.dump(profiler.speedscope(name), f)
+    else:
+        profile_path = f"{stem}.pstats"
+        profiler.dump_stats(profile_path)
+    report_path = f"{stem}.memory.json"
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+
+    paths = [profile_path, report_path]
+    if profile_bucket:
+        s3_client = get_client("s3")
+        for path in paths:
+            try:
+                s3_client.upload_file(
+                    path, profile_bucket,
+                    f"profiles/{os.path.basename(path)}")
+            except (ClientError, boto3.exceptions.S3UploadFailedError) as e:
+                logger.error(f"The profile could not be uploaded: {e}")
+    return paths
+
+
+def run_profiled(run, event=None, context=None):
+    """Runs run() under a profiler and tracemalloc, then saves the profile
+    and a memory report named after the invocation. The event's "profile"
+    field can name the profiler ("cprofile" or "sampling"); otherwise it
+    is PROFILE_MODE. cProfile only sees the calling thread.
+
+    Returns:
+         What run() returned.
+    """
+    mode = event.get("profile") if isinstance(event, dict) else None
+    if mode not in ("cprofile", "sampling"):
+        mode = profile_mode
+    request_id = getattr(context, "aws_request_id", None) or uuid.uuid4().hex
+    name = f"{time.strftime('%Y%m%dT%H%M%S')}_{request_id}"
+
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    started = time.perf_counter()
+    if mode == "sampling":
+        profiler = SamplingProfiler()
+        profiler.start()
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        return run()
+    finally:
+        if isinstance(profiler, SamplingProfiler):
+            profiler.stop()
+        else:
+            profiler.disable()
+        report = memory_report(tracemalloc.take_snapshot(),
+                               time.perf_counter() - started)
+        if not tracing:
+            tracemalloc.stop()
+        paths = save_profile(name, profiler, report)
+        emit_metric("PeakMemory", report["peak_bytes"], "Bytes",
+                    mode="profile")
+        logger.info(f"PROFILE WRITTEN TO {', '.join(paths)}")
+
+
+def lambda_handler(event: dict, context=None):
+    """
+    The lambda function checks for an api-key environment variable.
+
+    If one is present then:
+
+        1. Url parameters are created with user input
+
+        2. If the parameters object is the correct length then the api
+           is called using requests.get and a response returned
+
+        3. This response is then formatted to a json object
+
+        4. An AWS SQS Queue is then created using a user inputted
+           reference value and returns a url pointing to the queue.
+
+        5. The formatted json object and queue url are then used to
+           send the message to the queue.
+           This functions returns some metadata which can be used
+           to verify of the message was sent successfully.
+
+        6. The user then has the option to view the message on the screen.
+
+    Events with a mode of "backfill" fetch every page of results instead,
+    and "coordinator" and "worker" events fan a list of searches out across
+    several invocations of this function. A "percolate" event matches many
+    saved searches against a single read of the newest content, and a
+    "batch" event runs several searches and deduplicates their results.
+    A "schedule" event is a tick of the saved search scheduler.
+
+    Any event with "profile": true (or "cprofile" or "sampling") is run
+    under a profiler, as are a PROFILE_SAMPLE_RATE share of all events.
+    """
+
+    return dispatch_event(event, context, handle_request)
+
+
+def dispatch_event(event, context, handle):
+    """Validates an event and runs it with handle(request, context) under
+    the idempotency store."""
+    mode = event.get("mode") if isinstance(event, dict) else None
+
+    try:
+        request = event_models.get(mode, GuardianApiInfo).model_validate(event)
+    except ValidationError as e:
+        return {"result": "error", "message": e.errors(include_url=False)}
+
+    # Async retries of an invocation keep its request id, so it is used as
+    # the key when the caller doesn't give one
+    key = event.get("idempotency_key") or getattr(
+        context, "aws_request_id", None)
+
+    def run():
+        return handle(request, context)
+
+    if should_profile(event):
+        return run_idempotent(request, key,
+                              lambda: run_profiled(run, event, context))
+    return run_idempotent(request, key, run)
+
+
+async def fetch_articles_async(session, payload):
+    """Fetches a page of results on the event loop with aiohttp, under the
+    shared rate governor. Without a session (aiohttp isn't installed) the
+    blocking client runs in a thread instead.
+
+    Returns:
+         The SearchPage for the response.
+    """
+    if session is None:
+        return await asyncio.to_thread(get_api_response_articles, payload)
+
+    await rate_governor.acquire_async()
+    params = {key: value for key, value in payload.items()
+              if value is not None}
+    try:
+        async with session.get(base_url, params=params) as response:
+            response.raise_for_status()
+            body = await response.read()
+
+    except aiohttp.ClientResponseError as errh:
+        raise SystemExit(f'"HTTP Error:", {errh}')
+    except aiohttp.ClientConnectionError as errc:
+        raise SystemExit(f'"Connection Error:", {errc}')
+    except asyncio.TimeoutError as errt:
+        raise SystemExit(f'"Timeout Error:",{errt}')
+    except aiohttp.ClientError as err:
+        raise SystemExit(f'"Sorry there seems to be an issue:",{err}')
+
+    return decode_search_response(body)
+
+
+def open_session():
+    """An aiohttp session for the Guardian api, or None without aiohttp."""
+    if aiohttp is None:
+        return None
+    return aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=5))
+
+
+async def close_session(session):
+    if session is not None:
+        await session.close()
+
+
+async def run_search_async(info, api_key, session=None):
+    """run_search on the event loop. The reference's queue is created
+    while the api key (an awaitable shared by every search) is retrieved
+    and the page is fetched.
+
+    Returns:
+         The publisher for the reference.
+    """
+    publisher = asyncio.ensure_future(asyncio.to_thread(
+        get_publisher, info.reference, info.fifo, info.partitions,
+        info.partition_key))
+    payload = {"api-key": await api_key, "q": info.search_term,
+               "from-date": info.date_from, "to-date": info.date_to}
+
+    page = await fetch_articles_async(session, payload)
+    fetched_at = time.time()
+    publisher = await publisher
+
+    await asyncio.to_thread(publish_search, info, publisher, page.results,
+                            fetched_at)
+    return publisher
+
+
+def api_key_future(api_key=None):
+    """A future for the api key, which is fetched from secrets manager in
+    a thread unless it is given."""
+    if api_key is None:
+        return asyncio.ensure_future(asyncio.to_thread(get_api_key))
+    future = asyncio.get_running_loop().create_future()
+    future.set_result(api_key)
+    return future
+
+
+async def run_searches_async(searches, api_key=None):
+    """Runs many searches concurrently on one event loop.
+
+    Returns:
+         The publisher for each search, in order.
+    """
+    session = open_session()
+    try:
+        api_key = api_key_future(api_key)
+        return await asyncio.gather(*(
+            run_search_async(search, api_key, session)
+            for search in searches))
+    finally:
+        await close_session(session)
+
+
+async def run_batch_async(plan, api_key=None):
+    """run_batch with every search's page fetched concurrently on one
+    event loop."""
+    session = open_session()
+    try:
+        api_key = api_key_future(api_key)
+
+        async def fetch(search):
+            payload = {"api-key": await api_key, "q": search.search_term,
+                       "from-date": search.date_from,
+                       "to-date": search.date_to}
+            page = await fetch_articles_async(session, payload)
+            return [(search, article) for article in page.results]
+
+        results = await asyncio.gather(*map(fetch, plan.searches))
+    finally:
+        await close_session(session)
+
+    matches = [match for result in results for match in result]
+    return await asyncio.to_thread(publish_batch, matches, time.time())
+
+
+async def handle_request_async(request, context=None):
+    """handle_request for async_lambda_handler. Searches and batches run
+    on the event loop; other modes run as they do in lambda_handler, in a
+    thread."""
+    if isinstance(request, BatchPlan):
+        return await run_batch_async(request)
+    if not isinstance(request, GuardianApiInfo) or request.mode != "search":
+        return await asyncio.to_thread(handle_request, request, context)
+
+    publisher, = await run_searches_async([request])
+
+    if not isinstance(publisher, SqsPublisher):
+        return {"result": "complete", "reference": request.reference}
+
+    return await asyncio.to_thread(view_sqs_message, publisher.queue_url)
+
+
+def async_lambda_handler(event: dict, context=None):
+    """The same as lambda_handler, with searches and batches run on an
+    asyncio event loop, so that the secret, queue and page requests
+    overlap without a thread each. The Guardian api is called with aiohttp
+    when it is installed; aws calls run in threads.
+
+    The lambda python runtime only calls synchronous handlers, so the
+    event loop is run here with asyncio.run.
+    """
+    return dispatch_event(
+        event, context,
+        lambda request, context: asyncio.run(
+            handle_request_async(request, context)))
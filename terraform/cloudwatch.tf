@@ -19,3 +19,23 @@ resource "aws_cloudwatch_log_metric_filter" "error_metric_filter" {
 
 
 
+
+// Tick the saved search scheduler every minute
+resource "aws_cloudwatch_event_rule" "scheduler_tick" {
+  name                = "${var.stream_lambda}_scheduler_tick"
+  schedule_expression = "rate(1 minute)"
+}
+
+resource "aws_cloudwatch_event_target" "scheduler_tick_target" {
+  rule  = aws_cloudwatch_event_rule.scheduler_tick.name
+  arn   = aws_lambda_function.stream_lambda_function.arn
+  input = jsonencode({ mode = "schedule" })
+}
+
+resource "aws_lambda_permission" "scheduler_tick_permission" {
+  statement_id  = "AllowSchedulerTick"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.stream_lambda_function.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.scheduler_tick.arn
+}
@@ -0,0 +1,30 @@
+# Table of idempotency records, so retried invocations return the stored
+# result instead of publishing again
+resource "aws_dynamodb_table" "idempotency_table" {
+  name         = "${var.stream_lambda}_idempotency"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "id"
+
+  attribute {
+    name = "id"
+    type = "S"
+  }
+
+  ttl {
+    attribute_name = "expiry"
+    enabled        = true
+  }
+}
+
+# Registry of saved searches polled by the scheduler, with the scheduler's
+# quota state in the "#state" item
+resource "aws_dynamodb_table" "registry_table" {
+  name         = "${var.stream_lambda}_registry"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "id"
+
+  attribute {
+    name = "id"
+    type = "S"
+  }
+}
@@ -31,7 +31,12 @@ data "aws_iam_policy_document" "sqs_stream_document" {
      actions  = ["sqs:CreateQueue",
                  "sqs:SendMessage",
                  "sqs:ReceiveMessage",
-                 "sqs:GetQueueAttributes"
+                 "sqs:DeleteMessage",
+                 "sqs:DeleteQueue",
+                 "sqs:GetQueueAttributes",
+                 "sqs:GetQueueUrl",
+                 "sqs:TagQueue",
+                 "sqs:ListQueueTags"
     ]
     resources = [
       "arn:aws:sqs:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:*"
@@ -52,6 +57,162 @@ resource "aws_iam_role_policy_attachment" "sqs_stream_policy_attachment" {
   policy_arn = aws_iam_policy.sqs_policy_stream.arn
 }
 
+# ==========================================
+# Lambda Invoke Policy for Stream Lambda
+# ==========================================
+
+// Lets a coordinator invocation fan work out to worker invocations of itself
+data "aws_iam_policy_document" "lambda_invoke_stream_document" {
+  statement {
+    effect   = "Allow"
+    actions  = ["lambda:InvokeFunction"]
+    resources = [
+      "arn:aws:lambda:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:function:${var.stream_lambda}*"
+    ]
+  }
+}
+
+resource "aws_iam_policy" "lambda_invoke_policy_stream" {
+  name_prefix = "lambda-invoke-policy-${var.stream_lambda}"
+  policy      = data.aws_iam_policy_document.lambda_invoke_stream_document.json
+}
+
+resource "aws_iam_role_policy_attachment" "lambda_invoke_stream_policy_attachment" {
+  role       = aws_iam_role.stream_lambda_role.name
+  policy_arn = aws_iam_policy.lambda_invoke_policy_stream.arn
+}
+
+# ==========================================
+# S3 Policy for Stream Lambda
+# ==========================================
+
+// Read and write seen-article filter snapshots, spilled messages and
+// backfill checkpoints, and upload profiles.
+// ListBucket makes a missing snapshot come back as NoSuchKey rather than
+// AccessDenied
+data "aws_iam_policy_document" "s3_stream_document" {
+  statement {
+    effect    = "Allow"
+    actions   = ["s3:GetObject", "s3:PutObject"]
+    resources = ["${aws_s3_bucket.seen_filter_bucket.arn}/seen/*"]
+  }
+  statement {
+    effect    = "Allow"
+    actions   = ["s3:GetObject", "s3:PutObject", "s3:DeleteObject"]
+    resources = ["${aws_s3_bucket.seen_filter_bucket.arn}/spill/*"]
+  }
+  statement {
+    effect    = "Allow"
+    actions   = ["s3:GetObject", "s3:PutObject", "s3:DeleteObject"]
+    resources = ["${aws_s3_bucket.seen_filter_bucket.arn}/checkpoints/*"]
+  }
+  statement {
+    effect    = "Allow"
+    actions   = ["s3:PutObject"]
+    resources = ["${aws_s3_bucket.seen_filter_bucket.arn}/profiles/*"]
+  }
+  statement {
+    effect    = "Allow"
+    actions   = ["s3:ListBucket"]
+    resources = [aws_s3_bucket.seen_filter_bucket.arn]
+  }
+}
+
+resource "aws_iam_policy" "s3_policy_stream" {
+  name_prefix = "s3-policy-${var.stream_lambda}"
+  policy      = data.aws_iam_policy_document.s3_stream_document.json
+}
+
+resource "aws_iam_role_policy_attachment" "s3_stream_policy_attachment" {
+  role       = aws_iam_role.stream_lambda_role.name
+  policy_arn = aws_iam_policy.s3_policy_stream.arn
+}
+
+# ==========================================
+# DynamoDB Policy for Stream Lambda
+# ==========================================
+
+data "aws_iam_policy_document" "dynamodb_stream_document" {
+  statement {
+    effect    = "Allow"
+    actions   = ["dynamodb:GetItem", "dynamodb:PutItem", "dynamodb:DeleteItem"]
+    resources = [aws_dynamodb_table.idempotency_table.arn]
+  }
+
+  statement {
+    effect    = "Allow"
+    actions   = ["dynamodb:Scan", "dynamodb:PutItem", "dynamodb:DeleteItem"]
+    resources = [aws_dynamodb_table.registry_table.arn]
+  }
+}
+
+resource "aws_iam_policy" "dynamodb_policy_stream" {
+  name_prefix = "dynamodb-policy-${var.stream_lambda}"
+  policy      = data.aws_iam_policy_document.dynamodb_stream_document.json
+}
+
+resource "aws_iam_role_policy_attachment" "dynamodb_stream_policy_attachment" {
+  role       = aws_iam_role.stream_lambda_role.name
+  policy_arn = aws_iam_policy.dynamodb_policy_stream.arn
+}
+
+# ==========================================
+# Kinesis Policy for Stream Lambda
+# ==========================================
+
+// Lets "kinesis:<stream>" references publish to data streams in the account
+data "aws_iam_policy_document" "kinesis_stream_document" {
+  statement {
+    effect    = "Allow"
+    actions   = ["kinesis:PutRecords"]
+    resources = [
+      "arn:aws:kinesis:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:stream/*"
+    ]
+  }
+}
+
+resource "aws_iam_policy" "kinesis_policy_stream" {
+  name_prefix = "kinesis-policy-${var.stream_lambda}"
+  policy      = data.aws_iam_policy_document.kinesis_stream_document.json
+}
+
+resource "aws_iam_role_policy_attachment" "kinesis_stream_policy_attachment" {
+  role       = aws_iam_role.stream_lambda_role.name
+  policy_arn = aws_iam_policy.kinesis_policy_stream.arn
+}
+
+# ==========================================
+# SNS and EventBridge Policy for Stream Lambda
+# ==========================================
+
+// Lets "sns:<topic>" and "events:<bus>" references route messages on
+data "aws_iam_policy_document" "routing_stream_document" {
+  statement {
+    effect    = "Allow"
+    actions   = ["sns:CreateTopic", "sns:Publish"]
+    resources = [
+      "arn:aws:sns:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:*"
+    ]
+  }
+  statement {
+    effect    = "Allow"
+    actions   = ["events:PutEvents"]
+    resources = [
+      "arn:aws:events:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:event-bus/*"
+    ]
+  }
+}
+
+resource "aws_iam_policy" "routing_policy_stream" {
+  name_prefix = "routing-policy-${var.stream_lambda}"
+  policy      = data.aws_iam_policy_document.routing_stream_document.json
+}
+
+resource "aws_iam_role_policy_attachment" "routing_stream_policy_attachment" {
+  role       = aws_iam_role.stream_lambda_role.name
+  policy_arn = aws_iam_policy.routing_policy_stream.arn
+}
+
 # ==========================================
 # CloudWatch Logs Policy for Stream Lambda
 # ==========================================
@@ -52,6 +52,25 @@ resource "aws_lambda_function" "stream_lambda_function" {
   # specify layers for the aws lambda function;  
   layers = [aws_lambda_layer_version.layer.arn]
 
+  # Skip articles already published to a reference, keeping the seen filters in s3,
+  # keep idempotency records for retried invocations and the saved search
+  # registry in dynamodb, and spill messages for backed up queues and upload
+  # profiles to s3
+  environment {
+    variables = {
+      SEEN_FILTER_ENABLED    = "true"
+      LOCAL_BACKENDS_ENABLED = "false"
+      SEEN_FILTER_BUCKET     = aws_s3_bucket.seen_filter_bucket.id
+      IDEMPOTENCY_STORE      = "dynamodb"
+      IDEMPOTENCY_TABLE      = aws_dynamodb_table.idempotency_table.name
+      SPILL_BUCKET           = aws_s3_bucket.seen_filter_bucket.id
+      CHECKPOINT_BUCKET      = aws_s3_bucket.seen_filter_bucket.id
+      REGISTRY_STORE         = "dynamodb"
+      REGISTRY_TABLE         = aws_dynamodb_table.registry_table.name
+      PROFILE_BUCKET         = aws_s3_bucket.seen_filter_bucket.id
+    }
+  }
+
   # Lambda function has a logging configuration defined as follows
   logging_config {
     log_format            = "JSON"
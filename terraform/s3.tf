@@ -0,0 +1,7 @@
+# Bucket holding snapshots of the seen-article filters, so that articles
+# are not republished after the lambda container is recycled, and messages
+# spilled while a queue is backed up (under spill/)
+resource "aws_s3_bucket" "seen_filter_bucket" {
+  bucket_prefix = "${var.stream_lambda}-seen-filter-"
+  force_destroy = true
+}
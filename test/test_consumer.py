@@ -0,0 +1,248 @@
+import pytest
+import base64
+import gzip
+import json
+import os
+import time
+import boto3
+from moto import mock_aws
+from unittest.mock import MagicMock
+from src.consumer import (
+    ConsumedMessage,
+    FreshnessTracker,
+    LagHistogram,
+    QueueConsumer,
+    decode_body,
+    shared_queue_consumers
+)
+from src.stream import (
+    article_message,
+    parse_timestamp,
+    send_sqs_message_batch,
+    utc_timestamp
+)
+
+
+@pytest.fixture
+def aws_credentials():
+    """Mocked AWS Credentials for moto."""
+    os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+    os.environ["AWS_SECURITY_TOKEN"] = "testing"
+    os.environ["AWS_SESSION_TOKEN"] = "testing"
+
+
+@pytest.fixture(scope="function")
+def sqs_queue(aws_credentials):
+    with mock_aws():
+        client = boto3.client("sqs", region_name="eu-west-2")
+        queue_url = client.create_queue(QueueName="guardian_content")[
+            "QueueUrl"]
+        for start in range(0, 25, 5):
+            client.send_message_batch(QueueUrl=queue_url, Entries=[
+                {"Id": str(i), "MessageBody": json.dumps([i])}
+                for i in range(start, start + 5)
+            ])
+        yield client, queue_url
+
+
+def messages_left(client, queue_url):
+    attributes = client.get_queue_attributes(
+        QueueUrl=queue_url,
+        AttributeNames=["ApproximateNumberOfMessages",
+                        "ApproximateNumberOfMessagesNotVisible"],
+    )["Attributes"]
+    return sum(int(value) for value in attributes.values())
+
+
+class TestDecodeBody:
+    @pytest.mark.it("Plain bodies are returned as they are")
+    def test_plain_body(self):
+        assert decode_body({"Body": "[1]"}) == "[1]"
+
+    @pytest.mark.it("Gzip encoded bodies are decompressed")
+    def test_gzip_body(self):
+        body = base64.b64encode(gzip.compress(b"[1]")).decode()
+        message = {"Body": body, "MessageAttributes": {
+            "content-encoding": {"StringValue": "gzip",
+                                 "DataType": "String"}}}
+        assert decode_body(message) == "[1]"
+
+    @pytest.mark.it("Claim check bodies are fetched from S3")
+    @mock_aws
+    def test_claim_check_body(self, aws_credentials):
+        s3_client = boto3.client("s3", region_name="eu-west-2")
+        s3_client.create_bucket(
+            Bucket="claims",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"})
+        s3_client.put_object(Bucket="claims", Key="a", Body=b"[1]")
+        message = {"Body": json.dumps({"bucket": "claims", "key": "a"}),
+                   "MessageAttributes": {"claim-check": {
+                       "StringValue": "s3", "DataType": "String"}}}
+        assert decode_body(message, s3_client) == "[1]"
+
+
+class TestQueueConsumer:
+    @pytest.mark.it("Iterating drains and deletes every message")
+    def test_iterator_drains_queue(self, sqs_queue):
+        client, queue_url = sqs_queue
+        consumer = QueueConsumer(queue_url, workers=3, wait_time=0,
+                                 stop_when_empty=True, sqs_client=client)
+
+        bodies = [message.json()[0] for message in consumer]
+
+        # Delivery is at least once, so a message may be received twice
+        assert sorted(set(bodies)) == list(range(25))
+        assert consumer.deleted == len(bodies)
+        assert messages_left(client, queue_url) == 0
+
+    @pytest.mark.it("The callback api releases messages whose handler fails")
+    def test_run_releases_failures(self, sqs_queue):
+        client, queue_url = sqs_queue
+        consumer = QueueConsumer(queue_url, workers=2, wait_time=0,
+                                 stop_when_empty=True, sqs_client=client)
+
+        def handler(message):
+            if message.json() == [7]:
+                raise ValueError("bad article")
+
+        handled = consumer.run(handler)
+
+        # Delivery is at least once, so a message may be handled twice
+        assert handled >= 24
+        assert messages_left(client, queue_url) == 1
+
+    @pytest.mark.it("Messages that can't be decoded are released and the "
+                    "rest are handled")
+    def test_bad_body(self, sqs_queue):
+        client, queue_url = sqs_queue
+        client.send_message(
+            QueueUrl=queue_url, MessageBody="not gzip",
+            MessageAttributes={"content-encoding": {
+                "DataType": "String", "StringValue": "gzip"}})
+        consumer = QueueConsumer(queue_url, workers=2, wait_time=0,
+                                 retry_delay=60, stop_when_empty=True,
+                                 sqs_client=client)
+
+        handled = consumer.run(lambda message: None)
+
+        # Delivery is at least once, so a message may be handled twice
+        assert handled >= 25
+        assert consumer.in_flight == {}
+        assert messages_left(client, queue_url) == 1
+
+    @pytest.mark.it("Prefetch limits how many messages are buffered")
+    def test_prefetch_depth(self, sqs_queue):
+        client, queue_url = sqs_queue
+        consumer = QueueConsumer(queue_url, workers=1, prefetch=5,
+                                 wait_time=0, stop_when_empty=True,
+                                 sqs_client=client)
+        assert consumer.buffer.maxsize == 5
+        assert len(list(consumer)) == 25
+
+    @pytest.mark.it("Leaving the loop early releases the buffered messages")
+    def test_break_releases_buffer(self, sqs_queue):
+        client, queue_url = sqs_queue
+        consumer = QueueConsumer(queue_url, workers=2, prefetch=5,
+                                 wait_time=0, sqs_client=client)
+
+        for message in consumer:
+            time.sleep(0.2)
+            break
+
+        visible = client.get_queue_attributes(
+            QueueUrl=queue_url, AttributeNames=["ApproximateNumberOfMessages"]
+        )["Attributes"]["ApproximateNumberOfMessages"]
+        assert not any(poller.is_alive() for poller in consumer.pollers)
+        assert int(visible) == 24
+        assert list(consumer.in_flight) == [message.receipt_handle]
+
+    @pytest.mark.it("Heartbeats extend the visibility of messages in flight")
+    def test_extend_visibility(self):
+        sqs_client = MagicMock()
+        consumer = QueueConsumer("url", sqs_client=sqs_client)
+        consumer.in_flight = {str(i): 0 for i in range(12)}
+
+        consumer.extend_visibility(list(consumer.in_flight))
+
+        assert sqs_client.change_message_visibility_batch.call_count == 2
+        assert all(deadline > 0 for deadline in consumer.in_flight.values())
+
+
+class TestSharedQueueConsumer:
+    @pytest.mark.it("Messages are demultiplexed by their reference")
+    @mock_aws
+    def test_run_by_reference(self, aws_credentials):
+        client = boto3.client("sqs", region_name="eu-west-2")
+        queue_url = client.create_queue(QueueName="stream_shared-0")[
+            "QueueUrl"]
+        for reference in ["green", "sport", "green", "other"]:
+            client.send_message(
+                QueueUrl=queue_url, MessageBody="[]",
+                MessageAttributes={"reference": {
+                    "DataType": "String", "StringValue": reference}})
+        received = []
+
+        consumer = shared_queue_consumers(
+            sqs_client=client, count=1, wait_time=0,
+            stop_when_empty=True)[0]
+        handled = consumer.run_by_reference({
+            "green": lambda message: received.append("green"),
+            "sport": lambda message: received.append("sport"),
+        })
+
+        assert handled == 3
+        assert sorted(received) == ["green", "green", "sport"]
+        assert messages_left(client, queue_url) == 1
+
+
+class TestFreshnessTracker:
+    @pytest.mark.it("Lag percentiles are accurate to their bucket")
+    def test_lag_histogram(self):
+        histogram = LagHistogram()
+        for seconds in [0.05] * 90 + [3] * 9 + [40000]:
+            histogram.add(seconds)
+
+        summary = histogram.summary()
+        assert summary["count"] == 100
+        assert (summary["p50"], summary["p90"]) == (0.1, 0.1)
+        assert summary["p99"] == 5
+        assert summary["max"] == 40000
+
+    @pytest.mark.it("Each stage's lag is recorded from the message's times")
+    def test_record_stages(self):
+        tracker = FreshnessTracker()
+        published = parse_timestamp("2024-01-01T00:00:00Z")
+        message = ConsumedMessage("[]", "id", "handle", {
+            "latest-publication-date": "2024-01-01T00:00:00Z",
+            "fetched-at": utc_timestamp(published + 600),
+            "enqueued-at": utc_timestamp(published + 601),
+        })
+
+        tracker.record(message, consumed_at=published + 611)
+
+        summary = tracker.summary()
+        assert summary["publication_to_fetch"]["max"] == 600
+        assert summary["fetch_to_enqueue"]["max"] == 1
+        assert summary["enqueue_to_consume"]["max"] == 10
+        assert summary["publication_to_consume"]["max"] == 611
+
+    @pytest.mark.it("Consumers track the freshness of stream messages")
+    def test_consumer_freshness(self, aws_credentials):
+        with mock_aws():
+            client = boto3.client("sqs", region_name="eu-west-2")
+            queue_url = client.create_queue(QueueName="fresh")["QueueUrl"]
+            articles = [{"id": "a", "webTitle": "t", "webUrl": "u",
+                         "webPublicationDate": utc_timestamp(
+                             time.time() - 60)}]
+            send_sqs_message_batch(
+                [article_message(articles, ["climate"])], queue_url)
+            consumer = QueueConsumer(queue_url, wait_time=0,
+                                     stop_when_empty=True, sqs_client=client)
+
+            traces = [message.trace_id for message in consumer]
+
+        summary = consumer.freshness.summary()
+        assert len(traces) == 1 and traces[0]
+        assert summary["publication_to_consume"]["count"] == 1
+        assert 60 <= summary["publication_to_consume"]["max"] < 70
@@ -0,0 +1,119 @@
+import pytest
+import json
+import time
+from botocore.exceptions import ClientError
+from benchmarks.fake_aws import FakeSqs, fake_aws
+from benchmarks.guardian_standin import GuardianServer, GuardianStandIn
+from src.stream import (
+    RateGovernor,
+    create_sqs_queue,
+    get_api_key,
+    get_client,
+    lambda_handler,
+    register_client,
+    send_sqs_message_batch
+)
+
+
+@pytest.fixture
+def fakes():
+    with fake_aws() as (sqs, secrets):
+        secrets.create_secret(Name="guardian_api_key",
+                              SecretString='{"api_key": "test"}')
+        yield sqs, secrets
+
+
+class TestClientRegistry:
+    @pytest.mark.it("Registered factories replace boto3 until unregistered")
+    def test_register_client(self):
+        sqs = FakeSqs()
+        register_client("sqs", lambda **options: sqs)
+        try:
+            assert get_client("sqs") is sqs
+        finally:
+            register_client("sqs", None)
+
+        assert get_client("sqs") is not sqs
+        assert get_client("sqs").meta.region_name == "eu-west-2"
+
+
+class TestFakeSqs:
+    @pytest.mark.it("Messages are received in order and hidden until "
+                    "deleted or their visibility timeout runs out")
+    def test_visibility(self, fakes):
+        sqs, _ = fakes
+        url = create_sqs_queue("fake")
+        for number in range(3):
+            sqs.send_message(QueueUrl=url, MessageBody=str(number))
+
+        first = sqs.receive_message(QueueUrl=url, MaxNumberOfMessages=2,
+                                    VisibilityTimeout=0.05)["Messages"]
+        assert [message["Body"] for message in first] == ["0", "1"]
+        sqs.delete_message(QueueUrl=url,
+                           ReceiptHandle=first[0]["ReceiptHandle"])
+
+        time.sleep(0.06)
+        again = sqs.receive_message(QueueUrl=url, MaxNumberOfMessages=10)
+        assert [message["Body"] for message in again["Messages"]] == [
+            "1", "2"]
+        assert sqs.receive_message(QueueUrl=url) == {}
+
+    @pytest.mark.it("Batches are limited to 10 entries as in sqs")
+    def test_batch_limit(self, fakes):
+        sqs, _ = fakes
+        url = create_sqs_queue("fake")
+        entries = [{"Id": str(number), "MessageBody": "m"}
+                   for number in range(11)]
+
+        with pytest.raises(ClientError, match="TooManyEntries"):
+            sqs.send_message_batch(QueueUrl=url, Entries=entries)
+        with pytest.raises(sqs.exceptions.QueueDoesNotExist):
+            sqs.get_queue_url(QueueName="missing")
+
+    @pytest.mark.it("Fifo queues drop duplicates and hold back a group "
+                    "while one of its messages is in flight")
+    def test_fifo(self, fakes):
+        sqs, _ = fakes
+        url = create_sqs_queue("fake", fifo=True)
+        send_sqs_message_batch(
+            [{"body": "a1", "group_id": "a"}, {"body": "a1", "group_id": "a"},
+             {"body": "a2", "group_id": "a"}, {"body": "b1", "group_id": "b"}],
+            url)
+
+        first = sqs.receive_message(QueueUrl=url)["Messages"]
+        received = sqs.receive_message(QueueUrl=url, MaxNumberOfMessages=10)
+        assert first[0]["Body"] == "a1"
+        assert [message["Body"] for message in received["Messages"]] == [
+            "b1"]
+        attributes = sqs.get_queue_attributes(
+            QueueUrl=url, AttributeNames=["All"])["Attributes"]
+        assert attributes["ApproximateNumberOfMessages"] == "1"
+
+
+class TestFakeAws:
+    @pytest.mark.it("The api key is read from the fake secrets manager")
+    def test_api_key(self, fakes, caplog):
+        _, secrets = fakes
+        assert get_api_key() == "test"
+
+        secrets.secrets.clear()
+        assert get_api_key() is None
+        assert "could not be found" in caplog.text
+
+    @pytest.mark.it("Batches are published through the fakes")
+    def test_lambda_handler(self, fakes, monkeypatch):
+        sqs, _ = fakes
+        server = GuardianServer(standin=GuardianStandIn(total=5)).start()
+        monkeypatch.setattr("src.stream.base_url", server.url)
+        monkeypatch.setattr("src.stream.rate_governor",
+                            RateGovernor(1000, burst=10))
+        try:
+            lambda_handler({"mode": "batch", "searches": [
+                {"search_term": "climate", "reference": "fakes"}]})
+        finally:
+            server.shutdown()
+
+        url = sqs.get_queue_url(QueueName="fakes")["QueueUrl"]
+        received = sqs.receive_message(QueueUrl=url, MaxNumberOfMessages=10)
+        body = json.loads(received["Messages"][0]["Body"])
+        assert len(body) == 5
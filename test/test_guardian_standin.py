@@ -0,0 +1,159 @@
+import pytest
+import os
+import random
+import boto3
+import requests
+from moto import mock_aws
+from benchmarks.guardian_standin import (
+    GuardianServer,
+    GuardianStandIn,
+    Latency
+)
+from benchmarks.load_test import run_load, percentile
+from src.stream import (
+    GuardianApiInfo,
+    RateGovernor,
+    get_api_response_page,
+    memory_topics,
+    run_backfill
+)
+
+
+@pytest.fixture
+def aws_credentials():
+    """Mocked AWS Credentials for moto."""
+    os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+    os.environ["AWS_SECURITY_TOKEN"] = "testing"
+    os.environ["AWS_SESSION_TOKEN"] = "testing"
+
+
+@pytest.fixture
+def standin(monkeypatch):
+    """Starts a stand in for the Guardian api with the given settings and
+    points the stream at it."""
+    servers = []
+
+    def start(**settings):
+        server = GuardianServer(standin=GuardianStandIn(**settings)).start()
+        servers.append(server)
+        monkeypatch.setattr("src.stream.base_url", server.url)
+        monkeypatch.setattr("src.stream.rate_governor",
+                            RateGovernor(1000, burst=100))
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+
+
+class TestGuardianStandIn:
+    @pytest.mark.it("Searches are paginated like the real api")
+    def test_pagination(self, standin):
+        standin(total=450)
+        payload = {"api-key": "key", "q": "climate", "page-size": 200}
+
+        first = get_api_response_page(payload)
+        last = get_api_response_page({**payload, "page": 3})
+
+        assert (first.total, first.pages) == (450, 3)
+        assert len(first.results) == 200 and len(last.results) == 50
+        dates = [article.webPublicationDate
+                 for article in first.results + last.results]
+        assert dates == sorted(dates, reverse=True)
+        with pytest.raises(SystemExit, match="400 Client Error"):
+            get_api_response_page({**payload, "page": 4})
+
+    @pytest.mark.it("Results are filtered by date and can be oldest first")
+    def test_dates(self, standin):
+        server = standin(total=2000)
+        term = "climate"
+        total, spacing = server.standin.term(term)
+        newest = get_api_response_page(
+            {"api-key": "key", "q": term}).results[0]
+        day = newest.webPublicationDate[:10]
+
+        page = get_api_response_page({"api-key": "key", "q": term,
+                                      "from-date": day, "to-date": day,
+                                      "order-by": "oldest"})
+
+        assert 0 < page.total <= 86400 // spacing + 1
+        assert all(article.webPublicationDate.startswith(day)
+                   for article in page.results)
+        assert page.results[-1].webPublicationDate <= \
+            newest.webPublicationDate
+
+    @pytest.mark.it("A backfill reads every page of every window")
+    def test_backfill(self, standin, monkeypatch, tmp_path):
+        standin(total=300)
+        monkeypatch.setattr("src.stream.checkpoint_dir", str(tmp_path))
+        memory_topics.pop("standin", None)
+        info = GuardianApiInfo(search_term="climate", mode="backfill",
+                               date_from="2000-01-01",
+                               reference="memory:standin")
+
+        summary = run_backfill(info, "key")
+
+        assert summary["result"] == "complete"
+        assert summary["articles"] == 300
+
+    @pytest.mark.it("Injected 429s and 5xx errors fail the request")
+    def test_fault_injection(self, standin):
+        standin(throttle_rate=1.0)
+        with pytest.raises(SystemExit, match="429 Client Error"):
+            get_api_response_page({"api-key": "key", "q": "climate"})
+
+        server = standin(error_rate=1.0)
+        with pytest.raises(SystemExit, match="50[0234] Server Error"):
+            get_api_response_page({"api-key": "key", "q": "climate"})
+        assert server.standin.stats()["requests"] == 1
+
+    @pytest.mark.it("Each api key is rate limited and requests need a key")
+    def test_rate_limit(self, standin):
+        server = standin(requests_per_second=0.5, burst=2)
+        params = {"api-key": "key", "q": "climate"}
+
+        statuses = [requests.get(server.url, params=params).status_code
+                    for _ in range(3)]
+        throttled = requests.get(server.url, params=params)
+        other_key = requests.get(server.url,
+                                 params={**params, "api-key": "other"})
+
+        assert statuses == [200, 200, 429]
+        assert throttled.headers["Retry-After"] == "2"
+        assert other_key.status_code == 200
+        assert requests.get(server.url, params={"q": "x"}).status_code == 401
+
+    @pytest.mark.it("Latency distributions are parsed and sampled")
+    def test_latency(self):
+        rng = random.Random(1)
+        lognormal = Latency.parse("lognormal:0.05:0.5")
+        samples = [lognormal.sample(rng) for _ in range(2001)]
+
+        assert percentile(samples, 0.5) == pytest.approx(0.05, rel=0.1)
+        assert Latency.parse("fixed:0.2").sample(rng) == 0.2
+        assert 0.1 <= Latency.parse("uniform:0.1:0.3").sample(rng) <= 0.3
+        with pytest.raises(ValueError):
+            Latency.parse("normal:1")
+
+
+class TestLoadTest:
+    @pytest.mark.it("Concurrent invocations are timed and errors counted")
+    @mock_aws
+    def test_run_load(self, standin, aws_credentials):
+        boto3.client("secretsmanager", region_name="eu-west-2").create_secret(
+            Name="guardian_api_key", SecretString='{"api_key": "load"}')
+        server = standin(latency=Latency("fixed", 0.02), error_rate=0.2,
+                         seed=3)
+
+        report = run_load(50, 8, queues=2)
+
+        statuses = server.standin.stats()["statuses"]
+        failed = sum(count for status, count in statuses.items()
+                     if status != 200)
+        assert report["error_rate"] == failed / 50 > 0
+        assert all(kind.startswith("HTTP 50") for kind in report["errors"])
+        assert report["p50_ms"] <= report["p95_ms"] <= report["p99_ms"]
+        assert report["p50_ms"] >= 20
+        sqs_client = boto3.client("sqs", region_name="eu-west-2")
+        assert len(sqs_client.list_queues()["QueueUrls"]) == 2
@@ -0,0 +1,128 @@
+import pytest
+import io
+import json
+import multiprocessing
+import time
+from unittest.mock import patch
+from src import stream
+from src.runner import (
+    BulkRunner,
+    SharedRateGovernor,
+    main,
+    read_specs,
+)
+
+
+def record_spec(event):
+    """Appends the spec's search term to the file named by its reference,
+    failing for a term of "fail"."""
+    if event["search_term"] == "fail":
+        raise SystemExit("HTTP Error")
+    with open(event["reference"], "a") as f:
+        f.write(f"{event['search_term']}\n")
+
+
+def archive_spec(event):
+    """Archives an article for the spec's search term to the process's
+    shared archive."""
+    stream.shared_archive.add(
+        [{"id": event["search_term"], "webUrl": "u", "webTitle": "t",
+          "webPublicationDate": "2024-01-01T09:00:00Z"}],
+        "climate", event["reference"])
+
+
+def acquire_tokens(governor, count):
+    for _ in range(count):
+        governor.acquire()
+
+
+class TestReadSpecs:
+    @pytest.mark.it("CSV specs skip empty cells and take defaults")
+    def test_csv(self, tmp_path):
+        path = tmp_path / "specs.csv"
+        path.write_text("search_term,date_from,reference\n"
+                        "climate,2024-01-01,\n"
+                        "net zero,,policy\n")
+
+        specs = list(read_specs(str(path), defaults={"reference": "green"}))
+
+        assert specs == [
+            (2, {"reference": "green", "search_term": "climate",
+                 "date_from": "2024-01-01"}),
+            (3, {"reference": "policy", "search_term": "net zero"}),
+        ]
+
+    @pytest.mark.it("NDJSON specs skip blank lines and flag bad ones")
+    def test_ndjson(self, tmp_path):
+        path = tmp_path / "specs.ndjson"
+        path.write_text('{"search_term": "climate"}\n\nnot json\n')
+
+        assert list(read_specs(str(path))) == [
+            (1, {"search_term": "climate"}), (3, None)]
+
+
+class TestBulkRunner:
+    @pytest.mark.it("Processes share a single rate")
+    def test_shared_rate_governor(self):
+        governor = SharedRateGovernor(20)
+        start = time.monotonic()
+
+        processes = [
+            multiprocessing.Process(target=acquire_tokens,
+                                    args=(governor, 5))
+            for _ in range(2)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        assert time.monotonic() - start >= 0.45
+
+    @pytest.mark.it("Specs run across processes with failures summarised")
+    def test_run(self, tmp_path):
+        output = str(tmp_path / "terms.txt")
+        specs = [(line, {"search_term": term, "reference": output})
+                 for line, term in enumerate(
+                     ["climate", "fail", "net zero", "energy"], start=1)]
+        progress = io.StringIO()
+
+        summary = BulkRunner(processes=2, progress=progress,
+                             handler=record_spec).run(
+            specs + [(5, None)])
+
+        assert summary["completed"] == 3
+        assert summary["failed"] == 2
+        assert summary["failures"] == [
+            {"line": 5, "error": "Spec could not be parsed"},
+            {"line": 2, "error": "HTTP Error"}]
+        with open(output) as f:
+            assert sorted(f.read().split("\n")[:-1]) == [
+                "climate", "energy", "net zero"]
+        assert progress.getvalue().endswith("specs/s\n")
+
+    @pytest.mark.it("Each process archives to one sink, closed on exit")
+    def test_run_archive(self, tmp_path, monkeypatch):
+        pq = pytest.importorskip("pyarrow.parquet")
+        monkeypatch.setattr("src.stream.archive_destination", str(tmp_path))
+        monkeypatch.setenv("ARCHIVE_DESTINATION", str(tmp_path))
+        specs = [(line, {"search_term": str(line), "reference": "green"})
+                 for line in range(1, 21)]
+
+        summary = BulkRunner(processes=2, handler=archive_spec).run(specs)
+
+        assert summary["completed"] == 20
+        files = list(tmp_path.rglob("*.parquet"))
+        assert 1 <= len(files) <= 2
+        assert sum(pq.read_table(path).num_rows for path in files) == 20
+
+    @pytest.mark.it("The command line writes the run summary to a file")
+    @patch("src.stream.get_api_key", return_value="key")
+    def test_main(self, mock_key, tmp_path):
+        specs = tmp_path / "specs.ndjson"
+        specs.write_text("not json\n")
+        summary = tmp_path / "summary.json"
+
+        assert main([str(specs), "--processes", "1",
+                     "--summary", str(summary)]) == 1
+        assert json.loads(summary.read_text())["failed"] == 1
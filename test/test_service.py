@@ -0,0 +1,181 @@
+import pytest
+import json
+import os
+import signal
+import threading
+import time
+import boto3
+from moto import mock_aws
+from unittest.mock import patch
+from src.service import StreamService, JobFailed
+from src.stream import SearchPage, Article, memory_topics, get_publisher
+
+
+@pytest.fixture
+def aws_credentials():
+    """Mocked AWS Credentials for moto."""
+    os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+    os.environ["AWS_SECURITY_TOKEN"] = "testing"
+    os.environ["AWS_SESSION_TOKEN"] = "testing"
+
+
+def fake_articles(payload):
+    """Two articles for any search."""
+    return SearchPage(results=[
+        Article(id=f"{payload['q']}/{i}",
+                webPublicationDate="2024-01-01T09:00:00Z",
+                webTitle=f"{payload['q']} {i}", webUrl=f"url/{i}")
+        for i in range(2)])
+
+
+def write_jobs(path, jobs):
+    path.write_text("".join(f"{json.dumps(job)}\n" for job in jobs))
+    return str(path)
+
+
+@pytest.fixture
+def service():
+    with patch("src.service.get_api_key", return_value="test") as key, \
+            patch("src.service.get_api_response_articles",
+                  side_effect=fake_articles):
+        yield StreamService(workers=4), key
+
+
+class TestStreamService:
+    @pytest.mark.it("Jobs from a file are run with a warm key and publisher")
+    def test_run_file(self, service, tmp_path):
+        stream_service, mock_key = service
+        memory_topics.pop("service", None)
+        path = write_jobs(tmp_path / "jobs.ndjson", [
+            {"search_term": f"term {i}", "reference": "memory:service"}
+            for i in range(10)])
+
+        with patch("src.service.get_publisher",
+                   side_effect=get_publisher) as mock_publisher:
+            summary = stream_service.run_file(path)
+
+        assert summary["completed"] == 10 and summary["failed"] == 0
+        assert len(memory_topics["service"]) == 10
+        assert mock_key.call_count == 1
+        assert mock_publisher.call_count == 1
+
+    @pytest.mark.it("Jobs share one archive, closed when the service stops")
+    def test_run_file_archive(self, service, tmp_path, monkeypatch):
+        pq = pytest.importorskip("pyarrow.parquet")
+        stream_service, _ = service
+        archive = tmp_path / "archive"
+        monkeypatch.setattr("src.stream.archive_destination", str(archive))
+        path = write_jobs(tmp_path / "jobs.ndjson", [
+            {"search_term": "climate", "reference": "memory:archived"}
+            for _ in range(5)])
+
+        assert stream_service.run_file(path)["completed"] == 5
+
+        (file,) = archive.rglob("*.parquet")
+        assert pq.read_table(file).num_rows == 10
+
+    @pytest.mark.it("A failing job doesn't stop the others")
+    def test_failed_job(self, service, tmp_path):
+        stream_service, _ = service
+        path = write_jobs(tmp_path / "jobs.ndjson", [
+            {"search_term": "fine", "reference": "memory:failures"},
+            {"search_term": "fine"},
+            {"search_term": "also fine", "reference": "memory:failures"}])
+
+        summary = stream_service.run_file(path)
+
+        assert summary["completed"] == 2 and summary["failed"] == 1
+
+    @pytest.mark.it("SystemExit from a job becomes JobFailed")
+    def test_job_system_exit(self, service):
+        stream_service, _ = service
+        with patch("src.service.get_api_response_articles",
+                   side_effect=SystemExit("HTTP Error")):
+            with pytest.raises(JobFailed):
+                stream_service.run_job({"search_term": "climate",
+                                        "reference": "memory:exit"})
+
+    @pytest.mark.it("SIGTERM drains the jobs already started")
+    def test_sigterm_drains(self, service, tmp_path):
+        stream_service, _ = service
+        started = threading.Event()
+
+        def slow_articles(payload):
+            if not started.is_set():
+                started.set()
+                os.kill(os.getpid(), signal.SIGTERM)
+            time.sleep(0.05)
+            return fake_articles(payload)
+
+        path = write_jobs(tmp_path / "jobs.ndjson", [
+            {"search_term": f"term {i}", "reference": "memory:drain"}
+            for i in range(200)])
+        handler = signal.getsignal(signal.SIGTERM)
+        with patch("src.service.get_api_response_articles",
+                   side_effect=slow_articles):
+            summary = stream_service.run_file(path)
+
+        assert signal.getsignal(signal.SIGTERM) is handler
+        assert stream_service.stopping.is_set()
+        assert 0 < summary["completed"] < 200
+        assert summary["failed"] == 0
+
+    @pytest.mark.it("Jobs are read from an input queue and deleted")
+    @mock_aws
+    def test_run_queue(self, service, aws_credentials):
+        stream_service, _ = service
+        client = boto3.client("sqs", region_name="eu-west-2")
+        queue_url = client.create_queue(QueueName="jobs")["QueueUrl"]
+        for i in range(5):
+            client.send_message(QueueUrl=queue_url, MessageBody=json.dumps(
+                {"search_term": f"term {i}", "reference": "memory:queued"}))
+        memory_topics.pop("queued", None)
+
+        summary = stream_service.run_queue(queue_url, wait_time=0,
+                                           stop_when_empty=True)
+
+        assert summary["completed"] == 5
+        assert len(memory_topics["queued"]) == 5
+        attributes = client.get_queue_attributes(
+            QueueUrl=queue_url, AttributeNames=["All"])["Attributes"]
+        assert attributes["ApproximateNumberOfMessages"] == "0"
+
+    @pytest.mark.it("Draining a queue releases the jobs not yet started")
+    @mock_aws
+    def test_queue_drain(self, service, aws_credentials):
+        stream_service, _ = service
+        client = boto3.client("sqs", region_name="eu-west-2")
+        queue_url = client.create_queue(QueueName="jobs")["QueueUrl"]
+        for i in range(40):
+            client.send_message(QueueUrl=queue_url, MessageBody=json.dumps(
+                {"search_term": f"term {i}", "reference": "memory:drain"}))
+
+        def stopping_articles(payload):
+            stream_service.stop()
+            return fake_articles(payload)
+
+        with patch("src.service.get_api_response_articles",
+                   side_effect=stopping_articles):
+            summary = stream_service.run_queue(queue_url, wait_time=0)
+
+        attributes = client.get_queue_attributes(
+            QueueUrl=queue_url, AttributeNames=["All"])["Attributes"]
+        assert 0 < summary["completed"] <= stream_service.workers
+        assert int(attributes["ApproximateNumberOfMessages"]) == \
+            40 - summary["completed"]
+
+    @pytest.mark.it("Aws clients are built once and reused between jobs")
+    @mock_aws
+    def test_warm_clients(self, service, aws_credentials, tmp_path):
+        stream_service, _ = service
+        path = write_jobs(tmp_path / "jobs.ndjson", [
+            {"search_term": f"term {i}", "reference": f"out_{i % 2}"}
+            for i in range(6)])
+
+        with patch("src.stream.boto3.client",
+                   side_effect=boto3.client) as build:
+            summary = stream_service.run_file(path)
+
+        assert summary["completed"] == 6
+        assert [call.args[0] for call in build.call_args_list] == ["sqs"]
@@ -3,8 +3,14 @@ import json
 import boto3
 from pydantic_core import ValidationError
 import os
+import time
+import asyncio
 import logging
+import pstats
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from moto import mock_aws
+import src.stream as stream
 from unittest.mock import patch, MagicMock
 import requests
 from requests.exceptions import (
@@ -21,8 +27,79 @@ from src.stream import (
     send_sqs_message,
     view_sqs_message,
     is_valid_date,
-    get_api_key
+    get_api_key,
+    lambda_handler,
+    RateGovernor,
+    plan_backfill_windows,
+    run_backfill,
+    checkpoint_path,
+    save_checkpoint,
+    load_checkpoint,
+    checkpoint_key,
+    CoordinatorPlan,
+    WorkerPlan,
+    LambdaInvoker,
+    ProcessPoolInvoker,
+    split_date_range,
+    plan_worker_events,
+    run_coordinator,
+    run_worker,
+    AhoCorasick,
+    QueryMatcher,
+    PercolatePlan,
+    run_percolator,
+    BatchPlan,
+    deduplicate_matches,
+    run_batch,
+    ScalableBloomFilter,
+    get_seen_filter,
+    save_seen_filter,
+    drop_seen,
+    mark_seen,
+    reference_key,
+    MemoryIdempotencyStore,
+    FileIdempotencyStore,
+    DynamoDBIdempotencyStore,
+    run_idempotent,
+    send_sqs_message_batch,
+    message_group_id,
+    deduplication_id,
+    get_publisher,
+    SqsPublisher,
+    KinesisPublisher,
+    MemoryPublisher,
+    FilePublisher,
+    memory_topics,
+    article_message,
+    EventBridgePublisher,
+    SharedSqsPublisher,
+    shared_queue_name,
+    PartitionedSqsPublisher,
+    jump_hash,
+    coalesce_messages,
+    get_queue_depth,
+    ArchiveSink,
+    S3MultipartUpload,
+    format_articles_columnar,
+    Article,
+    SearchPage,
+    get_api_response_articles,
+    extract_search_page,
+    get_api_response_page,
+    async_lambda_handler,
+    run_searches_async,
+    SavedSearch,
+    SchedulePlan,
+    DynamoDBSearchRegistry,
+    next_poll_interval,
+    run_scheduler,
+    SamplingProfiler,
+    publish_search,
+    utc_timestamp,
+    parse_timestamp
 )
+from datetime import date, datetime, timezone
+from freezegun import freeze_time
 
 
 @pytest.fixture
@@ -82,6 +159,15 @@ class TestBaseClassValidation:
         )
         assert gi.reference == "guardian_content_today"
 
+    @pytest.mark.it("Local backends can't be chosen unless enabled")
+    def test_local_backends_disabled(self, monkeypatch):
+        monkeypatch.setattr("src.stream.local_backends_enabled", False)
+        for reference in ["file:/etc/cron.d/articles", "memory:articles"]:
+            with pytest.raises(ValidationError, match="not enabled"):
+                GuardianApiInfo(search_term="politics", reference=reference)
+        assert GuardianApiInfo(search_term="politics",
+                               reference="kinesis:articles")
+
     @pytest.mark.it("Test that a given search term is returned")
     def test_search_returned(self):
         gi = GuardianApiInfo(
@@ -195,6 +281,17 @@ class TestGetApiCallResponseExceptions:
         with pytest.raises(SystemExit):
             get_api_response_json(payload=test_payload)
 
+    @pytest.mark.it("Every decoder reads the body through one call")
+    @patch("src.stream.requests")
+    def test_decoders_share_errors(self, mock_requests, monkeypatch):
+        monkeypatch.setattr("src.stream.rate_governor",
+                            RateGovernor(1000, burst=10))
+        mock_requests.exceptions = requests.exceptions
+        mock_requests.get.side_effect = Timeout("Timeout Error")
+        for decoder in [get_api_response_page, get_api_response_articles]:
+            with pytest.raises(SystemExit, match="Timeout Error"):
+                decoder({"q": "hello"})
+
 
 class TestGetApiCallResponses:
     @pytest.mark.it("Test for correct api call response with 200 status code")
@@ -343,3 +440,2059 @@ class TestViewingSQSMessage:
 
         test_message = view_sqs_message(test_url)
         assert test_message == "Received message: This is a test"
+
+
+def fake_backfill_page(payload, governor=None):
+    """Stands in for the Guardian api with 100 articles published per day."""
+    start = date.fromisoformat(payload["from-date"])
+    end = date.fromisoformat(payload["to-date"])
+    total = ((end - start).days + 1) * 100
+    page_size = payload["page-size"]
+    first = (payload["page"] - 1) * page_size
+    results = [
+        Article(id=f"{start}/{i}", webPublicationDate=f"{start}T00:00:00Z",
+                webTitle=f"title {i}", webUrl=f"url {i}")
+        for i in range(first, min(first + page_size, total))
+    ]
+    return SearchPage(results=results, total=total,
+                      pages=-(-total // page_size))
+
+
+class TestBackfill:
+    @pytest.mark.it("Backfill mode requires a date_from")
+    def test_backfill_requires_date_from(self):
+        with pytest.raises(ValidationError):
+            GuardianApiInfo(search_term="politics", reference="content",
+                            mode="backfill")
+
+    @pytest.mark.it("Busy date ranges are split into windows under the max")
+    @patch("src.stream.get_api_response_page", side_effect=fake_backfill_page)
+    def test_plan_splits_busy_windows(self, mock_page, monkeypatch):
+        monkeypatch.setattr("src.stream.backfill_window_max", 2000)
+        windows = plan_backfill_windows(
+            "key", "politics", date(2024, 1, 1), date(2024, 3, 31))
+
+        assert all(total <= 2000 for _, _, total in windows)
+        assert windows[0][0] == "2024-01-01"
+        assert windows[-1][1] == "2024-03-31"
+        assert sum(total for _, _, total in windows) == 91 * 100
+
+    @pytest.mark.it("Backfill publishes every article and clears checkpoint")
+    @patch("src.stream.date")
+    @patch("src.stream.get_api_response_page", side_effect=fake_backfill_page)
+    @mock_aws
+    def test_backfill_publishes_everything(self, mock_page, mock_date,
+                                           monkeypatch, tmp_path):
+        mock_date.today.return_value = date(2024, 1, 30)
+        mock_date.fromisoformat = date.fromisoformat
+        monkeypatch.setattr("src.stream.checkpoint_dir", str(tmp_path))
+        info = GuardianApiInfo(search_term="politics", reference="content",
+                               date_from="2024-01-01", mode="backfill")
+
+        summary = run_backfill(info, "key")
+
+        assert summary["result"] == "complete"
+        assert summary["articles"] == 3000
+        assert not os.path.exists(checkpoint_path(info))
+
+    @pytest.mark.it("Backfill resumes from its checkpoint")
+    @patch("src.stream.get_api_response_page", side_effect=fake_backfill_page)
+    @mock_aws
+    def test_backfill_resumes(self, mock_page, monkeypatch, tmp_path):
+        monkeypatch.setattr("src.stream.checkpoint_dir", str(tmp_path))
+        info = GuardianApiInfo(search_term="politics", reference="content",
+                               date_from="2024-01-01", mode="backfill")
+        save_checkpoint(checkpoint_path(info), {
+            "windows": [["2024-01-01", "2024-01-10", 1000],
+                        ["2024-01-11", "2024-01-20", 1000]],
+            "completed": [["2024-01-01", "2024-01-10"]],
+        })
+
+        summary = run_backfill(info, "key")
+
+        assert summary["result"] == "complete"
+        assert summary["articles"] == 1000
+        assert summary["windows_completed"] == 2
+
+    @pytest.mark.it("Backfill stops starting windows when out of time")
+    @patch("src.stream.get_api_response_page", side_effect=fake_backfill_page)
+    @mock_aws
+    def test_backfill_out_of_time(self, mock_page, monkeypatch, tmp_path):
+        monkeypatch.setattr("src.stream.checkpoint_dir", str(tmp_path))
+        context = MagicMock()
+        context.get_remaining_time_in_millis.return_value = 1000
+        info = GuardianApiInfo(search_term="politics", reference="content",
+                               date_from="2024-01-01", mode="backfill")
+        save_checkpoint(checkpoint_path(info), {
+            "windows": [["2024-01-01", "2024-01-10", 1000]],
+            "completed": [],
+        })
+
+        summary = run_backfill(info, "key", context)
+
+        assert summary["result"] == "incomplete"
+        assert os.path.exists(checkpoint_path(info))
+
+    @pytest.mark.it("Planning is checkpointed and resumes when out of time")
+    @patch("src.stream.get_api_response_page", side_effect=fake_backfill_page)
+    @mock_aws
+    def test_backfill_planning_resumes(self, mock_page, monkeypatch,
+                                       tmp_path):
+        monkeypatch.setattr("src.stream.checkpoint_dir", str(tmp_path))
+        monkeypatch.setattr("src.stream.backfill_workers", 2)
+        context = MagicMock()
+        context.get_remaining_time_in_millis.side_effect = [60000, 1000]
+        info = GuardianApiInfo(search_term="politics", reference="content",
+                               date_from="2024-01-01", date_to="2024-03-31",
+                               mode="backfill")
+
+        summary = run_backfill(info, "key", context)
+
+        assert summary["result"] == "incomplete"
+        assert mock_page.call_count == 1
+        checkpoint = load_checkpoint(checkpoint_path(info))
+        assert checkpoint["pending"] == [["2024-02-16", "2024-03-31"],
+                                         ["2024-01-01", "2024-02-15"]]
+
+        summary = run_backfill(info, "key")
+        assert summary["result"] == "complete"
+        assert summary["articles"] == 91 * 100
+
+    @pytest.mark.it("Checkpoints can be kept in S3")
+    @patch("src.stream.get_api_response_page", side_effect=fake_backfill_page)
+    @mock_aws
+    def test_backfill_checkpoint_s3(self, mock_page, monkeypatch, tmp_path,
+                                    aws_credentials):
+        monkeypatch.setattr("src.stream.checkpoint_dir", str(tmp_path))
+        monkeypatch.setattr("src.stream.checkpoint_bucket", "checkpoints")
+        s3_client = boto3.client("s3", region_name="eu-west-2")
+        s3_client.create_bucket(
+            Bucket="checkpoints",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"})
+        context = MagicMock()
+        context.get_remaining_time_in_millis.return_value = 1000
+        info = GuardianApiInfo(search_term="politics", reference="content",
+                               date_from="2024-01-01", date_to="2024-01-10",
+                               mode="backfill")
+        s3_client.put_object(
+            Bucket="checkpoints", Key=checkpoint_key(info),
+            Body=json.dumps({"windows": [["2024-01-01", "2024-01-10", 1000]],
+                             "completed": []}))
+
+        assert run_backfill(info, "key", context)["result"] == "incomplete"
+        assert run_backfill(info, "key")["articles"] == 1000
+        assert "Contents" not in s3_client.list_objects_v2(
+            Bucket="checkpoints")
+        assert list(tmp_path.iterdir()) == []
+
+    @pytest.mark.it("The lambda handler returns an error for a bad backfill")
+    def test_handler_backfill_error(self):
+        response = lambda_handler({"search_term": "politics",
+                                   "reference": "content",
+                                   "mode": "backfill"})
+        assert response["result"] == "error"
+
+
+class TestRateGovernor:
+    @pytest.mark.it("The rate governor spaces out calls beyond the burst")
+    def test_rate_governor_limits_rate(self):
+        governor = RateGovernor(rate=50, burst=1)
+        start = time.monotonic()
+        for _ in range(6):
+            governor.acquire()
+        assert time.monotonic() - start >= 0.09
+
+    @pytest.mark.it("Coroutines wait for the rate governor too")
+    def test_rate_governor_async(self):
+        governor = RateGovernor(rate=50, burst=1)
+
+        async def acquire_all():
+            await asyncio.gather(*(governor.acquire_async()
+                                   for _ in range(6)))
+
+        start = time.monotonic()
+        asyncio.run(acquire_all())
+        assert time.monotonic() - start >= 0.09
+
+
+def fake_worker_handler(event):
+    """Stands in for a worker invocation in the process pool."""
+    return {"run_id": event["run_id"], "worker": event["worker"],
+            "result": "complete", "articles": 10 * len(event["tasks"])}
+
+
+class TestCoordinator:
+    @pytest.mark.it("Date ranges are split into contiguous shards")
+    def test_split_date_range(self):
+        ranges = split_date_range(date(2024, 1, 1), date(2024, 1, 10), 3)
+        assert ranges[0][0] == date(2024, 1, 1)
+        assert ranges[-1][1] == date(2024, 1, 10)
+        for (_, end), (start, _) in zip(ranges, ranges[1:]):
+            assert (start - end).days == 1
+
+    @pytest.mark.it("There are never more shards than days")
+    def test_split_date_range_short(self):
+        assert len(split_date_range(date(2024, 1, 1), date(2024, 1, 2), 5)) \
+            == 2
+
+    @pytest.mark.it("Work is planned as search terms x date shards")
+    def test_plan_worker_events(self):
+        plan = CoordinatorPlan(
+            searches=[
+                {"search_term": "politics", "reference": "content",
+                 "date_from": "2024-01-01", "date_to": "2024-01-30"},
+                {"search_term": "sport", "reference": "content"},
+            ],
+            shards_per_search=3,
+            tasks_per_worker=2,
+        )
+        events = plan_worker_events(plan, "run")
+
+        tasks = [task for event in events for task in event["tasks"]]
+        assert len(events) == 2
+        assert [task["mode"] for task in tasks] == ["backfill"] * 3 + \
+            ["search"]
+        assert all(event["requests_per_second"] == 0.5 for event in events)
+        assert WorkerPlan.model_validate(events[0])
+
+    @pytest.mark.it("The coordinator aggregates completion records")
+    def test_run_coordinator_process_pool(self):
+        plan = CoordinatorPlan(
+            searches=[{"search_term": "politics", "reference": "content",
+                       "date_from": "2024-01-01", "date_to": "2024-01-30"}],
+            shards_per_search=4,
+        )
+        invoker = ProcessPoolInvoker(max_workers=2,
+                                     handler=fake_worker_handler)
+
+        summary = run_coordinator(plan, invoker=invoker)
+
+        assert summary["result"] == "complete"
+        assert summary["workers_reported"] == 4
+        assert summary["articles"] == 40
+
+    @pytest.mark.it("Workers send their completion record to the queue")
+    @patch("src.stream.get_api_key", return_value="key")
+    @patch("src.stream.run_backfill")
+    @mock_aws
+    def test_run_worker_reports(self, mock_backfill, mock_key):
+        mock_backfill.return_value = {"result": "complete", "articles": 5}
+        queue_url = create_sqs_queue("completions")
+        plan = WorkerPlan(
+            run_id="run", worker=0, completion_queue=queue_url,
+            tasks=[{"search_term": "politics", "reference": "content",
+                    "date_from": "2024-01-01", "mode": "backfill"}],
+        )
+
+        record = run_worker(plan)
+
+        assert record["result"] == "complete"
+        assert record["articles"] == 5
+        sqs_client = boto3.client("sqs", region_name="eu-west-2")
+        message = sqs_client.receive_message(QueueUrl=queue_url)["Messages"]
+        assert json.loads(message[0]["Body"]) == record
+
+    @pytest.mark.it("Concurrent workers each use their own rate governor")
+    @patch("src.stream.get_api_key", return_value="key")
+    @patch("src.stream.run_search")
+    def test_concurrent_workers(self, mock_search, mock_key):
+        governor = stream.rate_governor
+        barrier = threading.Barrier(2)
+        rates = {}
+
+        def search(task, api_key, worker_governor):
+            barrier.wait()
+            rates[task.search_term] = worker_governor.rate
+            assert worker_governor is not stream.rate_governor
+
+        mock_search.side_effect = search
+        threads = [
+            threading.Thread(target=run_worker, args=(WorkerPlan(
+                run_id="run", worker=worker, requests_per_second=rate,
+                tasks=[{"search_term": f"term {worker}",
+                        "reference": "content"}]),))
+            for worker, rate in enumerate([0.05, 0.25])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert rates == {"term 0": 0.05, "term 1": 0.25}
+        assert stream.rate_governor is governor
+        assert governor.rate == stream.requests_per_second
+
+    @pytest.mark.it("The lambda invoker collects records from its queue")
+    @mock_aws
+    def test_lambda_invoker_collect(self):
+        invoker = LambdaInvoker("stream", "run")
+        for worker in range(2):
+            send_sqs_message(json.dumps({"worker": worker}),
+                             invoker.completion_queue)
+
+        records = list(invoker.collect(2, time.monotonic() + 30))
+
+        assert sorted(r["worker"] for r in records) == [0, 1]
+
+
+def saved_search(search_term, reference="content"):
+    return GuardianApiInfo(search_term=search_term, reference=reference)
+
+
+class TestPercolator:
+    @pytest.mark.it("Aho-Corasick finds every overlapping pattern")
+    def test_aho_corasick_overlapping(self):
+        automaton = AhoCorasick([("climate",), ("climate", "change"),
+                                 ("change", "policy"), ("net", "zero")])
+        words = "new climate change policy announced".split()
+        assert automaton.search(words) == {0, 1, 2}
+
+    @pytest.mark.it("Phrases only match whole words")
+    def test_matcher_whole_words(self):
+        matcher = QueryMatcher([saved_search("art")])
+        assert not matcher.match({"webTitle": "A party in the park"})
+        assert matcher.match({"webTitle": "Modern art, reviewed"})
+
+    @pytest.mark.it("Boolean queries are supported")
+    def test_matcher_boolean(self):
+        matcher = QueryMatcher([
+            saved_search("climate AND (policy OR protest)"),
+            saved_search('"net zero" NOT sport'),
+            saved_search("election"),
+        ])
+        article = {"webTitle": "Climate protest on net zero",
+                   "fields": {"trailText": "<strong>Sport</strong> cancelled"}}
+        matched = [q.search_term for q in matcher.match(article)]
+        assert matched == ["climate AND (policy OR protest)"]
+
+    @pytest.mark.it("Unparseable saved searches are skipped")
+    def test_matcher_skips_bad_query(self):
+        matcher = QueryMatcher([saved_search("climate AND"),
+                                saved_search("sport")])
+        assert len(matcher.queries) == 1
+
+    @pytest.mark.it("Matches are routed to each search's reference queue")
+    @patch("src.stream.get_api_response_page")
+    @mock_aws
+    def test_run_percolator(self, mock_page, monkeypatch, tmp_path):
+        monkeypatch.setattr("src.stream.checkpoint_dir", str(tmp_path))
+        results = [
+            {"id": "a", "webPublicationDate": "2024-01-03T00:00:00Z",
+             "webTitle": "Climate summit", "webUrl": "a"},
+            {"id": "b", "webPublicationDate": "2024-01-02T00:00:00Z",
+             "webTitle": "Football results", "webUrl": "b"},
+            {"id": "c", "webPublicationDate": "2024-01-01T00:00:00Z",
+             "webTitle": "Climate football", "webUrl": "c"},
+        ]
+        mock_page.return_value = search_page(results)
+        plan = PercolatePlan(queries=[saved_search("climate", "green"),
+                                      saved_search("football", "sport")])
+
+        summary = run_percolator(plan, "key")
+
+        assert summary["articles_scanned"] == 3
+        assert summary["references"] == {"green": 2, "sport": 2}
+
+        mock_page.return_value = search_page([
+            {"id": "d", "webPublicationDate": "2024-01-04T00:00:00Z",
+             "webTitle": "Climate again", "webUrl": "d"}] + results)
+
+        summary = run_percolator(plan, "key")
+
+        assert summary["articles_scanned"] == 1
+        assert summary["references"] == {"green": 1}
+
+    @pytest.mark.it("The watermark only moves over articles that were read")
+    @patch("src.stream.get_api_response_page")
+    @mock_aws
+    def test_percolator_backlog(self, mock_page, monkeypatch, tmp_path,
+                                aws_credentials, capsys):
+        monkeypatch.setattr("src.stream.checkpoint_dir", str(tmp_path))
+        monkeypatch.setattr("src.stream.checkpoint_bucket", "checkpoints")
+        s3_client = boto3.client("s3", region_name="eu-west-2")
+        s3_client.create_bucket(
+            Bucket="checkpoints",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"})
+        s3_client.put_object(
+            Bucket="checkpoints", Key="checkpoints/percolator_watermark.json",
+            Body=json.dumps({"watermark": "2024-01-01T12:00:00Z"}))
+
+        def page_of(*hours):
+            page = search_page([
+                {"id": f"a{hour}", "webTitle": "Climate",
+                 "webPublicationDate": f"2024-01-01T{hour}:00:00Z",
+                 "webUrl": "u"}
+                for hour in hours])
+            page.pages = 3
+            return page
+
+        mock_page.side_effect = [page_of(11, 12, 13), page_of(14, 15)]
+        plan = PercolatePlan(queries=[saved_search("climate", "green")],
+                             max_pages=2)
+
+        summary = run_percolator(plan, "key")
+
+        assert summary["articles_scanned"] == 3
+        payload = mock_page.call_args.args[0]
+        assert payload["order-by"] == "oldest"
+        assert payload["from-date"] == "2024-01-01"
+        assert json.loads(s3_client.get_object(
+            Bucket="checkpoints", Key="checkpoints/percolator_watermark.json"
+        )["Body"].read()) == {"watermark": "2024-01-01T15:00:00Z"}
+        assert '"PercolatorBacklog": 1' in capsys.readouterr().out
+        assert list(tmp_path.iterdir()) == []
+
+
+class TestBatchDeduplication:
+    @pytest.mark.it("Articles are published once per reference with terms")
+    def test_deduplicate_matches(self):
+        article = {"id": "a", "webPublicationDate": "d", "webTitle": "t",
+                   "webUrl": "u", "sectionId": "s"}
+        matches = [
+            (saved_search("climate", "green"), article),
+            (saved_search("climate change", "green"), article),
+            (saved_search("net zero", "policy"), article),
+        ]
+
+        messages, stats, sources = deduplicate_matches(matches)
+
+        assert messages == {
+            "green": [{"webPublicationDate": "d", "webTitle": "t",
+                       "webUrl": "u",
+                       "matched_terms": ["climate", "climate change"]}],
+            "policy": [{"webPublicationDate": "d", "webTitle": "t",
+                        "webUrl": "u", "matched_terms": ["net zero"]}],
+        }
+        assert stats["articles"] == 1
+        assert stats["published"] == 2
+        assert stats["dedup_ratio"] == pytest.approx(1 / 3)
+        assert sources == {"green": [article], "policy": [article]}
+
+    @pytest.mark.it("A batch run reports its dedup ratio as a metric")
+    @patch("src.stream.get_api_response_page")
+    @mock_aws
+    def test_run_batch(self, mock_page, capsys):
+        results = [{"id": str(i), "webPublicationDate": "2024-01-01T00:00:00Z",
+                    "webTitle": "t", "webUrl": "u"} for i in range(4)]
+        mock_page.side_effect = [search_page(results[:3]),
+                                 search_page(results[1:])]
+        plan = BatchPlan(searches=[
+            {"search_term": "climate", "reference": "green"},
+            {"search_term": "net zero", "reference": "green"},
+        ])
+
+        summary = run_batch(plan, "key")
+
+        assert summary["matches"] == 6
+        assert summary["published"] == 4
+        metric = next(json.loads(line)
+                      for line in capsys.readouterr().out.splitlines()
+                      if "DedupRatio" in line)
+        assert metric["DedupRatio"] == pytest.approx(1 / 3)
+        assert metric["_aws"]["CloudWatchMetrics"][0]["Dimensions"] == \
+            [["mode"]]
+
+        sqs_client = boto3.client("sqs", region_name="eu-west-2")
+        queue_url = sqs_client.get_queue_url(QueueName="green")["QueueUrl"]
+        body = json.loads(sqs_client.receive_message(
+            QueueUrl=queue_url)["Messages"][0]["Body"])
+        assert [a["matched_terms"] for a in body] == [
+            ["climate"], ["climate", "net zero"], ["climate", "net zero"],
+            ["net zero"]]
+
+
+@pytest.fixture
+def seen_filter_on(monkeypatch, tmp_path):
+    monkeypatch.setattr("src.stream.seen_filter_enabled", True)
+    monkeypatch.setattr("src.stream.seen_filters", {})
+    monkeypatch.setattr("src.stream.checkpoint_dir", str(tmp_path))
+
+
+class TestSeenFilter:
+    @pytest.mark.it("The filter remembers every id added past its capacity")
+    def test_bloom_filter_scales(self):
+        seen = ScalableBloomFilter(error_rate=0.01, capacity=100)
+        for i in range(1000):
+            seen.add(f"article/{i}")
+        assert len(seen.slices) > 1
+        assert all(f"article/{i}" in seen for i in range(1000))
+
+    @pytest.mark.it("The false positive rate stays near the configured rate")
+    def test_bloom_filter_error_rate(self):
+        seen = ScalableBloomFilter(error_rate=0.01, capacity=100)
+        for i in range(1000):
+            seen.add(f"article/{i}")
+        false_positives = sum(f"other/{i}" in seen for i in range(20000))
+        assert false_positives / 20000 < 0.0125
+
+    @pytest.mark.it("The filter survives a round trip through bytes")
+    def test_bloom_filter_round_trip(self):
+        seen = ScalableBloomFilter(capacity=10)
+        for i in range(50):
+            seen.add(f"article/{i}")
+        loaded = ScalableBloomFilter.from_bytes(seen.to_bytes())
+        assert len(loaded) == 50
+        assert all(f"article/{i}" in loaded for i in range(50))
+
+    @pytest.mark.it("Seen articles are dropped for the same reference only")
+    def test_drop_seen(self, seen_filter_on):
+        articles = [{"id": "a"}, {"id": "b"}]
+        mark_seen("green", articles[:1])
+        assert drop_seen("green", articles) == [{"id": "b"}]
+        assert drop_seen("sport", articles) == articles
+
+    @pytest.mark.it("Nothing is dropped when the filter is switched off")
+    def test_drop_seen_off(self):
+        assert drop_seen("green", [{"id": "a"}]) == [{"id": "a"}]
+
+    @pytest.mark.it("The filter is reloaded from S3 after a recycle")
+    @mock_aws
+    def test_seen_filter_s3(self, seen_filter_on, monkeypatch, tmp_path):
+        s3_client = boto3.client("s3", region_name="eu-west-2")
+        s3_client.create_bucket(
+            Bucket="seen",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"})
+        monkeypatch.setattr("src.stream.seen_filter_bucket", "seen")
+        mark_seen("green", [{"id": "a"}])
+        save_seen_filter("green")
+
+        monkeypatch.setattr("src.stream.seen_filters", {})
+        monkeypatch.setattr("src.stream.checkpoint_dir",
+                            str(tmp_path / "recycled"))
+
+        assert "a" in get_seen_filter("green")
+
+    @pytest.mark.it("Filters merge every id, past either one's capacity")
+    def test_bloom_filter_update(self):
+        first = ScalableBloomFilter(error_rate=0.01, capacity=100)
+        second = ScalableBloomFilter(error_rate=0.01, capacity=100)
+        for i in range(80):
+            first.add(f"first/{i}")
+        for i in range(250):
+            second.add(f"second/{i}")
+
+        first.update(second)
+
+        assert all(f"first/{i}" in first for i in range(80))
+        assert all(f"second/{i}" in first for i in range(250))
+        assert len(first.slices) == len(second.slices)
+        assert len(first) >= 250
+        with pytest.raises(ValueError):
+            first.update(ScalableBloomFilter(error_rate=0.1, capacity=100))
+
+    @pytest.mark.it("Containers saving one reference keep each other's ids")
+    @mock_aws
+    def test_seen_filter_containers(self, seen_filter_on, monkeypatch,
+                                    tmp_path):
+        s3_client = boto3.client("s3", region_name="eu-west-2")
+        s3_client.create_bucket(
+            Bucket="seen",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"})
+        monkeypatch.setattr("src.stream.seen_filter_bucket", "seen")
+        for container in ["a", "b"]:
+            monkeypatch.setattr("src.stream.seen_filters", {})
+            monkeypatch.setattr("src.stream.checkpoint_dir",
+                                str(tmp_path / container))
+            os.makedirs(tmp_path / container)
+            mark_seen("green", [{"id": container}])
+            save_seen_filter("green")
+
+        monkeypatch.setattr("src.stream.seen_filters", {})
+        monkeypatch.setattr("src.stream.checkpoint_dir",
+                            str(tmp_path / "recycled"))
+        seen = get_seen_filter("green")
+        assert "a" in seen and "b" in seen
+
+    @pytest.mark.it("References with a backend are saved under safe names")
+    @mock_aws
+    def test_seen_filter_file_reference(self, seen_filter_on, monkeypatch,
+                                        tmp_path):
+        s3_client = boto3.client("s3", region_name="eu-west-2")
+        s3_client.create_bucket(
+            Bucket="seen",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"})
+        monkeypatch.setattr("src.stream.seen_filter_bucket", "seen")
+        reference = f"file:{tmp_path}/articles.ndjson"
+        mark_seen(reference, [{"id": "a"}])
+        save_seen_filter(reference)
+
+        assert [path.name for path in tmp_path.glob("seen_*")] == [
+            f"seen_{reference_key(reference)}.bin"]
+        assert "/" not in reference_key(reference)
+        keys = s3_client.list_objects_v2(Bucket="seen")["Contents"]
+        assert [key["Key"] for key in keys] == [
+            f"seen/{reference_key(reference)}.bin"]
+        assert reference_key("guardian_content") == "guardian_content"
+        assert reference_key("a:b") != reference_key("a/b")
+
+    @pytest.mark.it("Threads can add to and save one reference at once")
+    def test_concurrent_saves(self, seen_filter_on):
+        errors = []
+
+        def publish(thread):
+            try:
+                for i in range(20):
+                    mark_seen("green", [{"id": f"{thread}/{i}"}])
+                    save_seen_filter("green")
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=publish, args=(thread,))
+                   for thread in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert errors == []
+        seen = get_seen_filter("green")
+        assert len(seen) == 80
+        assert all(f"{thread}/{i}" in seen
+                   for thread in range(4) for i in range(20))
+
+    @pytest.mark.it("A repeated backfill does not republish articles")
+    @patch("src.stream.get_api_response_page", side_effect=fake_backfill_page)
+    @mock_aws
+    def test_backfill_skips_seen(self, mock_page, seen_filter_on):
+        info = GuardianApiInfo(search_term="politics", reference="content",
+                               date_from="2024-01-01", date_to="2024-01-05",
+                               mode="backfill")
+
+        assert run_backfill(info, "key")["articles"] == 500
+        assert run_backfill(info, "key")["articles"] == 0
+
+
+class TestIdempotency:
+    @pytest.mark.it("A repeated event returns the stored result")
+    def test_repeated_event(self, monkeypatch):
+        monkeypatch.setattr("src.stream.idempotency_store",
+                            MemoryIdempotencyStore())
+        info = saved_search("politics")
+        run = MagicMock(return_value={"result": "complete"})
+
+        assert run_idempotent(info, "key", run) == {"result": "complete"}
+        assert run_idempotent(info, "key", run) == {"result": "complete"}
+        assert run.call_count == 1
+
+    @pytest.mark.it("A different key or event runs again")
+    def test_different_key(self, monkeypatch):
+        monkeypatch.setattr("src.stream.idempotency_store",
+                            MemoryIdempotencyStore())
+        run = MagicMock(return_value="done")
+        run_idempotent(saved_search("politics"), "key", run)
+        run_idempotent(saved_search("politics"), "other", run)
+        run_idempotent(saved_search("sport"), "key", run)
+        assert run.call_count == 3
+
+    @pytest.mark.it("Events without a key always run")
+    def test_no_key(self, monkeypatch):
+        monkeypatch.setattr("src.stream.idempotency_store",
+                            MemoryIdempotencyStore())
+        run = MagicMock(return_value="done")
+        run_idempotent(saved_search("politics"), None, run)
+        run_idempotent(saved_search("politics"), None, run)
+        assert run.call_count == 2
+
+    @pytest.mark.it("A failed run is forgotten so a retry runs again")
+    def test_failed_run_retries(self, monkeypatch):
+        monkeypatch.setattr("src.stream.idempotency_store",
+                            MemoryIdempotencyStore())
+        run = MagicMock(side_effect=[SystemExit("boom"), "done"])
+        with pytest.raises(SystemExit):
+            run_idempotent(saved_search("politics"), "key", run)
+        assert run_idempotent(saved_search("politics"), "key", run) == "done"
+
+    @pytest.mark.it("An event already in progress is not run twice")
+    def test_in_progress(self, tmp_path):
+        store = FileIdempotencyStore(str(tmp_path))
+        assert store.start("abc", time.time() + 60)
+        assert not store.start("abc", time.time() + 60)
+        assert store.start("def", time.time() - 1)
+        assert store.start("def", time.time() + 60)
+
+    @pytest.mark.it("The memory store drops expired records")
+    def test_memory_purge(self):
+        store = MemoryIdempotencyStore()
+        with freeze_time("2024-01-01 10:00:00"):
+            now = time.time()
+            for number in range(100):
+                assert store.start(f"event-{number}", now + 60)
+                store.complete(f"event-{number}", "done", now + 60)
+            assert store.start("kept", now + 600)
+        with freeze_time("2024-01-01 10:05:00"):
+            assert store.start("new", now + 900)
+
+        assert set(store.records) == {"kept", "new"}
+        assert len(store.expiries) == 2
+
+    @pytest.mark.it("Only one thread takes an expired event")
+    def test_start_race(self, tmp_path):
+        store = FileIdempotencyStore(str(tmp_path))
+        for attempt in range(20):
+            key = f"event-{attempt}"
+            store.start(key, time.time() - 1)
+            barrier = threading.Barrier(4)
+            started = []
+
+            def start():
+                barrier.wait()
+                started.append(store.start(key, time.time() + 60))
+
+            threads = [threading.Thread(target=start) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert sorted(started) == [False, False, False, True]
+
+    @pytest.mark.it("The handler returns the stored result for a retry")
+    @patch("src.stream.handle_request", return_value={"result": "complete"})
+    def test_handler_idempotent(self, mock_handle, monkeypatch):
+        monkeypatch.setattr("src.stream.idempotency_store",
+                            MemoryIdempotencyStore())
+        context = MagicMock(aws_request_id="request-1")
+        event = {"search_term": "politics", "reference": "content"}
+
+        lambda_handler(event, context)
+        lambda_handler(event, context)
+
+        assert mock_handle.call_count == 1
+
+    @pytest.mark.it("Records round trip through a DynamoDB table")
+    @mock_aws
+    def test_dynamodb_store(self, aws_credentials):
+        client = boto3.client("dynamodb", region_name="eu-west-2")
+        client.create_table(
+            TableName="idempotency",
+            KeySchema=[{"AttributeName": "id", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "id",
+                                   "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST")
+        store = DynamoDBIdempotencyStore("idempotency")
+
+        assert store.start("abc", time.time() + 60)
+        assert not store.start("abc", time.time() + 60)
+        store.complete("abc", {"result": "complete"}, time.time() + 60)
+        assert store.get("abc")["result"] == {"result": "complete"}
+
+
+class TestFifoQueues:
+    @pytest.mark.it("A fifo queue is created with content deduplication")
+    @mock_aws
+    def test_create_fifo_queue(self):
+        queue_url = create_sqs_queue("guardian_content", fifo=True)
+        assert queue_url.endswith("guardian_content.fifo")
+        sqs_client = boto3.client("sqs", region_name="eu-west-2")
+        attributes = sqs_client.get_queue_attributes(
+            QueueUrl=queue_url, AttributeNames=["All"])["Attributes"]
+        assert attributes["FifoQueue"] == "true"
+        assert attributes["ContentBasedDeduplication"] == "true"
+
+    @pytest.mark.it("Message group ids only use allowed characters")
+    def test_message_group_id(self):
+        assert message_group_id("climate change – now") == \
+            "climate_change___now"
+        assert len(message_group_id("x" * 200)) == 128
+
+    @pytest.mark.it("Deduplication ids do not depend on article order")
+    def test_deduplication_id(self):
+        assert deduplication_id(["a", "b"]) == deduplication_id(["b", "a"])
+        assert deduplication_id(["a"]) != deduplication_id(["b"])
+
+    @pytest.mark.it("The batched sender sends every message")
+    @mock_aws
+    def test_send_batch(self):
+        queue_url = create_sqs_queue("guardian_content")
+        sent = send_sqs_message_batch(
+            [{"body": str(i)} for i in range(25)], queue_url)
+        assert sent == 25
+        attributes = boto3.client("sqs", region_name="eu-west-2") \
+            .get_queue_attributes(
+                QueueUrl=queue_url,
+                AttributeNames=["ApproximateNumberOfMessages"])
+        assert attributes["Attributes"]["ApproximateNumberOfMessages"] == \
+            "25"
+
+    @pytest.mark.it("The batched sender splits batches over 256 KiB")
+    @patch("src.stream.boto3")
+    def test_send_batch_size(self, mock_boto3):
+        mock_client = mock_boto3.client.return_value
+        mock_client.send_message_batch.return_value = {}
+        send_sqs_message_batch([{"body": "x" * 100000}] * 5, "url")
+        assert mock_client.send_message_batch.call_count == 3
+
+    @pytest.mark.it("A fifo backfill sends grouped, deduplicated messages")
+    @patch("src.stream.get_api_response_page", side_effect=fake_backfill_page)
+    @mock_aws
+    def test_fifo_backfill(self, mock_page, monkeypatch, tmp_path):
+        monkeypatch.setattr("src.stream.checkpoint_dir", str(tmp_path))
+        info = GuardianApiInfo(search_term="climate change",
+                               reference="content", date_from="2024-01-01",
+                               date_to="2024-01-02", mode="backfill",
+                               fifo=True)
+
+        run_backfill(info, "key")
+        run_backfill(info, "key")
+
+        sqs_client = boto3.client("sqs", region_name="eu-west-2")
+        queue_url = sqs_client.get_queue_url(
+            QueueName="content.fifo")["QueueUrl"]
+        response = sqs_client.receive_message(
+            QueueUrl=queue_url, MaxNumberOfMessages=10,
+            AttributeNames=["MessageGroupId"])
+        assert len(response["Messages"]) == 1
+        assert response["Messages"][0]["Attributes"]["MessageGroupId"] == \
+            "climate_change"
+
+
+class TestPublishers:
+    @pytest.mark.it("The reference selects the backend and destination")
+    def test_get_publisher(self, tmp_path):
+        assert isinstance(get_publisher("memory:articles"), MemoryPublisher)
+        publisher = get_publisher(f"file:{tmp_path}/articles.ndjson")
+        assert isinstance(publisher, FilePublisher)
+        assert publisher.path == f"{tmp_path}/articles.ndjson"
+
+    @pytest.mark.it("A plain reference is an sqs queue")
+    @mock_aws
+    def test_get_publisher_sqs(self):
+        publisher = get_publisher("guardian_content")
+        assert isinstance(publisher, SqsPublisher)
+        assert publisher.queue_url.endswith("/guardian_content")
+        assert get_publisher("sqs:other").queue_url.endswith("/other")
+
+    @pytest.mark.it("An unknown backend is an error")
+    def test_get_publisher_unknown(self):
+        with pytest.raises(SystemExit):
+            get_publisher("pigeon:articles")
+
+    @pytest.mark.it("The file publisher writes one message per line")
+    def test_file_publisher(self, tmp_path):
+        path = tmp_path / "articles.ndjson"
+        publisher = get_publisher(f"file:{path}")
+        publisher.publish([{"body": "[1]"}, {"body": "[2]"}])
+        publisher.publish([{"body": "[3]"}])
+        assert path.read_text().splitlines() == ["[1]", "[2]", "[3]"]
+
+    @pytest.mark.it("The kinesis publisher puts records by partition key")
+    @mock_aws
+    def test_kinesis_publisher(self, aws_credentials):
+        client = boto3.client("kinesis", region_name="eu-west-2")
+        client.create_stream(StreamName="articles", ShardCount=1)
+        publisher = get_publisher("kinesis:articles")
+
+        sent = publisher.publish([
+            {"body": f"[{i}]", "group_id": "climate"} for i in range(3)])
+
+        assert isinstance(publisher, KinesisPublisher)
+        assert sent == 3
+        shard_id = client.list_shards(StreamName="articles")["Shards"][0][
+            "ShardId"]
+        iterator = client.get_shard_iterator(
+            StreamName="articles", ShardId=shard_id,
+            ShardIteratorType="TRIM_HORIZON")["ShardIterator"]
+        records = client.get_records(ShardIterator=iterator)["Records"]
+        assert [r["Data"] for r in records] == [b"[0]", b"[1]", b"[2]"]
+        assert {r["PartitionKey"] for r in records} == {"climate"}
+
+    @pytest.mark.it("The kafka publisher needs kafka-python")
+    @patch("src.stream.KafkaProducer", None)
+    def test_kafka_publisher_missing(self):
+        with pytest.raises(SystemExit):
+            get_publisher("kafka:articles")
+
+    @pytest.mark.it("Kafka records are keyed by group and checked once sent")
+    def test_kafka_publish(self, monkeypatch):
+        producer = MagicMock()
+        monkeypatch.setattr("src.stream.KafkaProducer",
+                            MagicMock(return_value=producer))
+        monkeypatch.setattr("src.stream.kafka_producers", {})
+        messages = article_messages(2)
+
+        assert get_publisher("kafka:articles").publish(messages) == 2
+
+        sends = producer.send.call_args_list
+        assert [send.args[0] for send in sends] == ["articles"] * 2
+        assert sends[0].kwargs["value"] == messages[0]["body"].encode()
+        assert sends[0].kwargs["key"] == messages[0]["group_id"].encode()
+        assert ("trace-id", messages[0]["attributes"]["trace-id"][
+            "StringValue"].encode()) in sends[0].kwargs["headers"]
+        producer.flush.assert_called_once()
+        assert producer.send.return_value.get.call_count == 2
+
+    @pytest.mark.it("Kafka records that fail to send are an error")
+    def test_kafka_publish_failed(self, monkeypatch):
+        producer = MagicMock()
+        producer.send.return_value.get.side_effect = stream.KafkaError(
+            "MessageSizeTooLargeError")
+        monkeypatch.setattr("src.stream.KafkaProducer",
+                            MagicMock(return_value=producer))
+        monkeypatch.setattr("src.stream.kafka_producers", {})
+
+        with pytest.raises(SystemExit, match="2 messages could not be sent"):
+            get_publisher("kafka:articles").publish(article_messages(2))
+
+    @pytest.mark.it("A backfill can publish to the in-memory backend")
+    @patch("src.stream.get_api_response_page", side_effect=fake_backfill_page)
+    def test_backfill_memory(self, mock_page, monkeypatch, tmp_path):
+        monkeypatch.setattr("src.stream.checkpoint_dir", str(tmp_path))
+        memory_topics.clear()
+        info = GuardianApiInfo(search_term="politics",
+                               reference="memory:backfill",
+                               date_from="2024-01-01", date_to="2024-01-04",
+                               mode="backfill")
+
+        run_backfill(info, "key")
+
+        messages = memory_topics["backfill"]
+        assert sum(len(json.loads(m["body"])) for m in messages) == 400
+        assert {m["group_id"] for m in messages} == {"politics"}
+
+
+class TestMessageAttributes:
+    @pytest.mark.it("Messages carry typed attributes describing articles")
+    def test_article_message_attributes(self):
+        articles = [
+            {"id": "a", "webPublicationDate": "2024-01-02T00:00:00Z",
+             "webTitle": "t", "webUrl": "u"},
+            {"id": "b", "webPublicationDate": "2024-01-01T00:00:00Z",
+             "webTitle": "t", "webUrl": "u"},
+        ]
+        attributes = article_message(articles, ["climate"])["attributes"]
+
+        assert attributes["search-terms"] == {
+            "DataType": "String.Array", "StringValue": '["climate"]'}
+        assert attributes["article-count"] == {
+            "DataType": "Number", "StringValue": "2"}
+        assert attributes["earliest-publication-date"]["StringValue"] == \
+            "2024-01-01T00:00:00Z"
+        assert attributes["latest-publication-date"]["StringValue"] == \
+            "2024-01-02T00:00:00Z"
+        assert attributes["schema-version"]["DataType"] == "Number"
+        assert attributes["content-type"]["StringValue"] == \
+            "application/json"
+
+    @pytest.mark.it("Attributes are sent with sqs messages")
+    @patch("src.stream.get_api_response_page", side_effect=fake_backfill_page)
+    @mock_aws
+    def test_sqs_message_attributes(self, mock_page, monkeypatch, tmp_path):
+        monkeypatch.setattr("src.stream.checkpoint_dir", str(tmp_path))
+        info = GuardianApiInfo(search_term="politics", reference="content",
+                               date_from="2024-01-01", date_to="2024-01-01",
+                               mode="backfill")
+        run_backfill(info, "key")
+
+        sqs_client = boto3.client("sqs", region_name="eu-west-2")
+        queue_url = sqs_client.get_queue_url(QueueName="content")["QueueUrl"]
+        message = sqs_client.receive_message(
+            QueueUrl=queue_url,
+            MessageAttributeNames=["All"])["Messages"][0]
+        assert message["MessageAttributes"]["article-count"][
+            "StringValue"] == "100"
+
+    @pytest.mark.it("Sns filter policies route messages by attribute")
+    @mock_aws
+    def test_sns_filter_policy(self, aws_credentials):
+        sns_client = boto3.client("sns", region_name="eu-west-2")
+        sqs_client = boto3.client("sqs", region_name="eu-west-2")
+        publisher = get_publisher("sns:articles")
+        queue_url = create_sqs_queue("climate_only")
+        queue_arn = sqs_client.get_queue_attributes(
+            QueueUrl=queue_url, AttributeNames=["QueueArn"]
+        )["Attributes"]["QueueArn"]
+        sns_client.subscribe(
+            TopicArn=publisher.topic_arn, Protocol="sqs", Endpoint=queue_arn,
+            Attributes={"FilterPolicy": json.dumps(
+                {"search-terms": ["climate"]}), "RawMessageDelivery": "true"})
+        article = {"id": "a", "webPublicationDate": "d", "webTitle": "t",
+                   "webUrl": "u"}
+
+        publisher.publish([article_message([article], ["climate"]),
+                           article_message([article], ["sport"])])
+
+        messages = sqs_client.receive_message(
+            QueueUrl=queue_url, MaxNumberOfMessages=10,
+            MessageAttributeNames=["All"])["Messages"]
+        assert len(messages) == 1
+        assert messages[0]["MessageAttributes"]["search-terms"][
+            "StringValue"] == '["climate"]'
+
+    @pytest.mark.it("EventBridge events carry the attributes as detail")
+    @patch("src.stream.boto3")
+    def test_eventbridge_publisher(self, mock_boto3):
+        events_client = mock_boto3.client.return_value
+        events_client.put_events.return_value = {"FailedEntryCount": 0}
+        article = {"id": "a", "webPublicationDate": "d", "webTitle": "t",
+                   "webUrl": "u"}
+
+        publisher = get_publisher("events:articles")
+        publisher.publish([article_message([article], ["climate"])])
+
+        assert isinstance(publisher, EventBridgePublisher)
+        entry = events_client.put_events.call_args.kwargs["Entries"][0]
+        detail = json.loads(entry["Detail"])
+        assert entry["EventBusName"] == "articles"
+        assert detail["attributes"]["search-terms"] == ["climate"]
+        assert detail["attributes"]["article-count"] == 1
+        assert detail["articles"][0]["webTitle"] == "t"
+
+
+@pytest.fixture
+def shared_queues(monkeypatch):
+    monkeypatch.setattr("src.stream.shared_queue_count", 4)
+    monkeypatch.setattr("src.stream.shared_queue_urls", {})
+
+
+class TestSharedQueues:
+    @pytest.mark.it("References are spread over a fixed set of queues")
+    def test_shared_queue_name(self, shared_queues):
+        names = {shared_queue_name(f"reference_{i}") for i in range(100)}
+        assert names == {f"stream_shared-{shard}" for shard in range(4)}
+        assert shared_queue_name("climate") == shared_queue_name("climate")
+
+    @pytest.mark.it("Plain references publish to their shared queue")
+    @mock_aws
+    def test_shared_publisher(self, shared_queues):
+        publisher = get_publisher("climate")
+        article = {"id": "a", "webPublicationDate": "d", "webTitle": "t",
+                   "webUrl": "u"}
+
+        publisher.publish([article_message([article], ["climate"])])
+
+        assert isinstance(publisher, SharedSqsPublisher)
+        assert publisher.queue_url.endswith(shared_queue_name("climate"))
+        sqs_client = boto3.client("sqs", region_name="eu-west-2")
+        message = sqs_client.receive_message(
+            QueueUrl=publisher.queue_url,
+            MessageAttributeNames=["All"])["Messages"][0]
+        assert message["MessageAttributes"]["reference"]["StringValue"] == \
+            "climate"
+
+    @pytest.mark.it("Shared queues are only created once per container")
+    @mock_aws
+    def test_shared_queue_created_once(self, shared_queues):
+        with patch("src.stream.create_sqs_queue",
+                   side_effect=create_sqs_queue) as mock_create:
+            get_publisher("climate")
+            get_publisher("climate")
+        assert mock_create.call_count == 1
+
+    @pytest.mark.it("Fifo groups and deduplication are per reference")
+    @mock_aws
+    def test_shared_fifo(self, shared_queues):
+        sent = []
+        with patch("src.stream.send_sqs_message_batch",
+                   side_effect=lambda messages, url: sent.extend(messages)):
+            message = {"body": "[]", "group_id": "climate",
+                       "deduplication_id": "abc"}
+            get_publisher("green", fifo=True).publish([message])
+            get_publisher("policy", fifo=True).publish([message])
+        assert sent[0]["group_id"] == "green:climate"
+        assert sent[0]["deduplication_id"] != sent[1]["deduplication_id"]
+
+
+def sectioned_articles(count):
+    return [{"id": f"article/{i}", "sectionId": f"section{i % 5}",
+             "webPublicationDate": "2024-01-01T00:00:00Z",
+             "webTitle": f"title {i}", "webUrl": f"url/{i}"}
+            for i in range(count)]
+
+
+def search_page(articles):
+    return SearchPage(results=[Article(**article) for article in articles],
+                      total=len(articles))
+
+
+def partition_bodies(publisher):
+    sqs_client = boto3.client("sqs", region_name="eu-west-2")
+    bodies = []
+    for queue_url in publisher.queue_urls:
+        messages = sqs_client.receive_message(
+            QueueUrl=queue_url, MaxNumberOfMessages=10).get("Messages", [])
+        bodies.append([article for message in messages
+                       for article in json.loads(message["Body"])])
+    return bodies
+
+
+class TestPartitionedQueues:
+    @pytest.mark.it("Jump hash moves few keys when partitions are added")
+    def test_jump_hash(self):
+        keys = [f"article/{i}" for i in range(2000)]
+        before = [jump_hash(key, 4) for key in keys]
+        after = [jump_hash(key, 5) for key in keys]
+
+        assert set(before) == {0, 1, 2, 3}
+        moved = [(b, a) for b, a in zip(before, after) if b != a]
+        assert all(a == 4 for _, a in moved)
+        assert len(moved) < len(keys) / 4
+
+    @pytest.mark.it("Articles are spread over the partition queues")
+    @mock_aws
+    def test_partitioned_publish(self, aws_credentials):
+        publisher = get_publisher("climate", partitions=4)
+        articles = sectioned_articles(40)
+
+        sent = publisher.publish([article_message(articles, ["climate"])])
+
+        assert isinstance(publisher, PartitionedSqsPublisher)
+        assert [url.rsplit("/", 1)[1] for url in publisher.queue_urls] == [
+            "climate-0", "climate-1", "climate-2", "climate-3"]
+        assert sent == 4
+        bodies = partition_bodies(publisher)
+        assert sum(len(body) for body in bodies) == 40
+        for partition, body in enumerate(bodies):
+            assert all(jump_hash(f"article/{url.split('/')[1]}", 4)
+                       == partition for url in
+                       (article["webUrl"] for article in body))
+
+    @pytest.mark.it("Articles can be partitioned by section")
+    @mock_aws
+    def test_partition_by_section(self, aws_credentials):
+        publisher = get_publisher("climate", partitions=3,
+                                  partition_key="section")
+        publisher.publish([article_message(sectioned_articles(20),
+                                           ["climate"])])
+
+        for partition, body in enumerate(partition_bodies(publisher)):
+            sections = {int(article["webUrl"].split("/")[1]) % 5
+                        for article in body}
+            assert all(jump_hash(f"section{section}", 3) == partition
+                       for section in sections)
+
+    @pytest.mark.it("Batch articles are partitioned by their own section")
+    @patch("src.stream.get_api_response_page")
+    @mock_aws
+    def test_batch_partition_by_section(self, mock_page, aws_credentials):
+        mock_page.return_value = search_page(sectioned_articles(20))
+        run_batch(BatchPlan(searches=[
+            {"search_term": "climate", "reference": "climate",
+             "partitions": 3, "partition_key": "section"}]), "key")
+
+        bodies = partition_bodies(get_publisher("climate", partitions=3))
+        assert sum(len(body) for body in bodies) == 20
+        for partition, body in enumerate(bodies):
+            sections = {int(article["webUrl"].split("/")[1]) % 5
+                        for article in body}
+            assert all(jump_hash(f"section{section}", 3) == partition
+                       for section in sections)
+
+    @pytest.mark.it("Resizing waits until the partitions are drained")
+    @mock_aws
+    def test_resize_waits_for_drain(self, aws_credentials):
+        publisher = get_publisher("climate", partitions=2)
+        publisher.publish([article_message(sectioned_articles(10),
+                                           ["climate"])])
+
+        assert get_publisher("climate", partitions=3).partitions == 2
+
+        sqs_client = boto3.client("sqs", region_name="eu-west-2")
+        for queue_url in publisher.queue_urls:
+            sqs_client.purge_queue(QueueUrl=queue_url)
+        resized = get_publisher("climate", partitions=3)
+        assert resized.partitions == 3
+        assert len(resized.queue_urls) == 3
+        assert get_publisher("climate", partitions=3).partitions == 3
+
+    @pytest.mark.it("The event picks the partitions for a search")
+    @patch("src.stream.get_api_key", return_value="test")
+    @patch("src.stream.view_sqs_message")
+    @patch("src.stream.get_api_response_articles")
+    @mock_aws
+    def test_partitioned_search(self, mock_articles, mock_view, mock_key,
+                                aws_credentials):
+        mock_articles.return_value = search_page(sectioned_articles(12))
+
+        result = lambda_handler({"search_term": "climate",
+                                 "reference": "climate", "partitions": 2})
+
+        assert result == {"result": "complete", "reference": "climate"}
+        sqs_client = boto3.client("sqs", region_name="eu-west-2")
+        assert "climate-1" in sqs_client.get_queue_url(
+            QueueName="climate-1")["QueueUrl"]
+
+
+@pytest.fixture
+def backpressure(monkeypatch, tmp_path):
+    monkeypatch.setattr("src.stream.checkpoint_dir", str(tmp_path))
+    monkeypatch.setattr("src.stream.queue_depths", {})
+    monkeypatch.setattr("src.stream.backpressure_governors", {})
+    monkeypatch.setattr("src.stream.backpressure_slow_depth", 5)
+    monkeypatch.setattr("src.stream.backpressure_coalesce_depth", 10)
+    monkeypatch.setattr("src.stream.backpressure_spill_depth", 20)
+    return monkeypatch
+
+
+def article_messages(count, term="climate"):
+    return [article_message(sectioned_articles(count)[i:i + 1], [term])
+            for i in range(count)]
+
+
+class TestBackpressure:
+    @pytest.mark.it("Queue depth is sampled at most every ttl seconds")
+    @mock_aws
+    def test_queue_depth_cached(self, backpressure, aws_credentials):
+        queue_url = create_sqs_queue("climate")
+        send_sqs_message("[]", queue_url)
+        assert get_queue_depth(queue_url) == 1
+        send_sqs_message("[]", queue_url)
+        assert get_queue_depth(queue_url) == 1
+
+        backpressure.setattr("src.stream.queue_depth_ttl", 0)
+        assert get_queue_depth(queue_url) == 2
+
+    @pytest.mark.it("Coalescing merges a group's articles into one message")
+    def test_coalesce_messages(self):
+        messages = article_messages(4) + article_messages(2, "sport")
+        for message in messages:
+            message["attributes"]["reference"] = {
+                "DataType": "String", "StringValue": "green"}
+
+        coalesced = coalesce_messages(messages)
+
+        assert len(coalesced) == 2
+        assert len(json.loads(coalesced[0]["body"])) == 4
+        attributes = coalesced[0]["attributes"]
+        assert attributes["article-count"]["StringValue"] == "4"
+        assert attributes["reference"]["StringValue"] == "green"
+        assert coalesced[1]["group_id"] == "sport"
+
+    @pytest.mark.it("A shallow queue is sent messages as they are")
+    @mock_aws
+    def test_no_backpressure(self, backpressure, aws_credentials):
+        queue_url = create_sqs_queue("climate")
+        assert send_sqs_message_batch(article_messages(3), queue_url) == 3
+
+    @pytest.mark.it("A backed up queue is sent coalesced messages")
+    @mock_aws
+    def test_coalesce_when_behind(self, backpressure, aws_credentials,
+                                  capsys):
+        queue_url = create_sqs_queue("climate")
+        backpressure.setattr("src.stream.queue_depths",
+                             {queue_url: (time.monotonic(), 12)})
+
+        assert send_sqs_message_batch(article_messages(8), queue_url) == 1
+        lag = json.loads(capsys.readouterr().out.splitlines()[0])
+        assert lag["ConsumerLag"] == 12 and lag["Queue"] == "climate"
+
+    @pytest.mark.it("Fifo messages are paced by both the backpressure and "
+                    "their group's governor")
+    @mock_aws
+    def test_slow_fifo(self, backpressure, aws_credentials):
+        acquired = []
+
+        class Recorder:
+            def __init__(self, name):
+                self.name = name
+
+            def acquire(self):
+                acquired.append(self.name)
+
+        queue_url = create_sqs_queue("climate", fifo=True)
+        backpressure.setattr("src.stream.queue_depths",
+                             {queue_url: (time.monotonic(), 6)})
+        backpressure.setattr("src.stream.backpressure_governors",
+                             {queue_url: Recorder("backpressure")})
+        backpressure.setattr("src.stream.fifo_group_governors",
+                             {"climate": Recorder("fifo")})
+
+        assert send_sqs_message_batch(article_messages(3), queue_url) == 3
+        assert acquired == ["backpressure", "fifo"] * 3
+
+    @pytest.mark.it("A full queue spills messages until it drains")
+    @mock_aws
+    def test_spill_and_replay(self, backpressure, aws_credentials):
+        queue_url = create_sqs_queue("climate")
+        backpressure.setattr("src.stream.queue_depths",
+                             {queue_url: (time.monotonic(), 25)})
+        assert send_sqs_message_batch(article_messages(3), queue_url) == 0
+
+        backpressure.setattr("src.stream.queue_depths",
+                             {queue_url: (time.monotonic(), 0)})
+        assert send_sqs_message_batch(article_messages(1), queue_url) == 4
+        assert send_sqs_message_batch(article_messages(1), queue_url) == 1
+
+    @pytest.mark.it("Spilled messages can be kept in S3")
+    @mock_aws
+    def test_spill_to_s3(self, backpressure, aws_credentials):
+        s3_client = boto3.client("s3", region_name="eu-west-2")
+        s3_client.create_bucket(
+            Bucket="spill",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"})
+        backpressure.setattr("src.stream.spill_bucket", "spill")
+        queue_url = create_sqs_queue("climate")
+        backpressure.setattr("src.stream.queue_depths",
+                             {queue_url: (time.monotonic(), 25)})
+
+        send_sqs_message_batch(article_messages(3), queue_url)
+        assert s3_client.list_objects_v2(Bucket="spill")["KeyCount"] == 1
+
+        backpressure.setattr("src.stream.queue_depths",
+                             {queue_url: (time.monotonic(), 6)})
+        assert send_sqs_message_batch([], queue_url) == 3
+        assert s3_client.list_objects_v2(Bucket="spill")["KeyCount"] == 0
+
+
+def archive_articles(count, day="2024-01-01"):
+    return [{"id": f"article/{day}/{i}", "type": "article",
+             "sectionId": "environment", "webTitle": f"title {i}",
+             "webUrl": f"url/{i}", "webPublicationDate": f"{day}T09:00:00Z"}
+            for i in range(count)]
+
+
+class TestArchive:
+    @pytest.mark.it("Articles are archived as partitioned Parquet files")
+    def test_archive_local(self, tmp_path):
+        pq = pytest.importorskip("pyarrow.parquet")
+        sink = ArchiveSink(str(tmp_path))
+        sink.add(archive_articles(3), "climate change", "green")
+        sink.add(archive_articles(2, "2024-01-02"), "climate change",
+                 "green")
+
+        files = sink.close()
+
+        assert sorted(path.split("/")[-3] for path in files) == [
+            "date=2024-01-01", "date=2024-01-02"]
+        assert all("/term=climate_change/" in path for path in files)
+        table = pq.read_table(
+            [path for path in files if "2024-01-01" in path][0])
+        assert table.num_rows == 3
+        assert table.column("reference").to_pylist() == ["green"] * 3
+        assert str(table.column("webPublicationDate")[0]) == \
+            "2024-01-01 09:00:00+00:00"
+
+    @pytest.mark.it("Articles are archived with the time they were fetched")
+    def test_archive_fetched_at(self, tmp_path):
+        pq = pytest.importorskip("pyarrow.parquet")
+        sink = ArchiveSink(str(tmp_path))
+        fetched_at = datetime(2024, 1, 1, 9, 30, tzinfo=timezone.utc)
+        sink.add(archive_articles(2), "climate", "green",
+                 fetched_at.timestamp())
+
+        (path,) = sink.close()
+
+        assert pq.read_table(path).column("fetched_at").to_pylist() == \
+            [fetched_at] * 2
+
+    @pytest.mark.it("Runs share the archive while it is kept open")
+    def test_shared_archive(self, tmp_path, monkeypatch):
+        pq = pytest.importorskip("pyarrow.parquet")
+        monkeypatch.setattr("src.stream.archive_destination", str(tmp_path))
+        matches = [(saved_search("climate", "memory:green"), article)
+                   for article in archive_articles(3)]
+
+        with stream.keep_archive_open():
+            stream.publish_deduplicated({}, matches[:1])
+            stream.publish_deduplicated({}, matches[1:])
+            assert stream.shared_archive.rows
+
+        (path,) = tmp_path.rglob("*.parquet")
+        assert pq.read_table(path).num_rows == 3
+        assert stream.shared_archive is None
+
+    @pytest.mark.it("Archive files are rolled by size")
+    def test_archive_rolling(self, tmp_path, monkeypatch):
+        pq = pytest.importorskip("pyarrow.parquet")
+        monkeypatch.setattr("src.stream.archive_batch_rows", 10)
+        sink = ArchiveSink(str(tmp_path), file_bytes=1)
+
+        sink.add(archive_articles(25), "climate", "green")
+        files = sink.close()
+
+        assert len(files) == 3
+        assert sum(pq.read_table(path).num_rows for path in files) == 25
+
+    @pytest.mark.it("Large uploads to S3 are sent in parts")
+    @mock_aws
+    def test_multipart_upload(self, aws_credentials):
+        s3_client = boto3.client("s3", region_name="eu-west-2")
+        s3_client.create_bucket(
+            Bucket="archive",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"})
+        data = os.urandom(11 * 1024 * 1024)
+
+        upload = S3MultipartUpload("archive", "big.bin",
+                                   part_bytes=5 * 1024 * 1024)
+        upload.write(data[:4000000])
+        upload.write(data[4000000:])
+        upload.close()
+
+        assert len(upload.parts) == 3
+        assert s3_client.get_object(
+            Bucket="archive", Key="big.bin")["Body"].read() == data
+
+    @pytest.mark.it("Searches are archived to S3 when switched on")
+    @patch("src.stream.get_api_key", return_value="test")
+    @patch("src.stream.view_sqs_message")
+    @patch("src.stream.get_api_response_articles")
+    @mock_aws
+    def test_search_archived(self, mock_articles, mock_view, mock_key,
+                             aws_credentials, monkeypatch):
+        pq = pytest.importorskip("pyarrow.parquet")
+        s3_client = boto3.client("s3", region_name="eu-west-2")
+        s3_client.create_bucket(
+            Bucket="archive",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"})
+        monkeypatch.setattr("src.stream.archive_destination",
+                            "s3://archive/articles")
+        mock_articles.return_value = search_page(archive_articles(4))
+
+        lambda_handler({"search_term": "climate", "reference": "green"})
+
+        keys = [item["Key"] for item in
+                s3_client.list_objects_v2(Bucket="archive")["Contents"]]
+        assert len(keys) == 1
+        assert keys[0].startswith(
+            "articles/date=2024-01-01/term=climate/part-")
+        body = s3_client.get_object(Bucket="archive", Key=keys[0])["Body"]
+        table = pq.read_table(pytest.importorskip("pyarrow").BufferReader(
+            body.read()))
+        assert table.column("search_term").to_pylist() == ["climate"] * 4
+
+
+class TestColumnarFormatting:
+    @pytest.mark.it("Columnar json is the same as the row formatter")
+    def test_columnar_json(self):
+        articles = sectioned_articles(5)
+        articles[1]["webTitle"] = 'Quotes "in", "titles" and \\'
+        articles[2]["webTitle"] = "Caf\u00e9 \u2013 na\u00efve"
+
+        assert format_articles_columnar(articles) == \
+            format_api_response_message(articles)
+        assert format_articles_columnar([]) == "[]"
+
+    @pytest.mark.it("Columnar ndjson has one article per line")
+    def test_columnar_ndjson(self):
+        lines = format_articles_columnar(
+            archive_articles(3), "ndjson").splitlines()
+        assert [json.loads(line)["webUrl"] for line in lines] == [
+            "url/0", "url/1", "url/2"]
+
+    @pytest.mark.it("Articles missing a field leave it out")
+    def test_columnar_missing_field(self):
+        articles = archive_articles(2)
+        del articles[0]["webTitle"]
+        formatted = json.loads(format_articles_columnar(articles))
+        assert "webTitle" not in formatted[0]
+        assert formatted[1]["webTitle"] == "title 1"
+
+    @pytest.mark.it("The Guardian url prefix can be stripped")
+    def test_columnar_strip_url_prefix(self):
+        articles = archive_articles(1)
+        articles[0]["webUrl"] = "https://www.theguardian.com/uk/2024/a"
+        formatted = json.loads(format_articles_columnar(
+            articles, strip_url_prefix=True))
+        assert formatted[0]["webUrl"] == "uk/2024/a"
+
+    @pytest.mark.it("Arrow and Parquet output have typed timestamps")
+    def test_columnar_arrow(self):
+        pa = pytest.importorskip("pyarrow")
+        pq = pytest.importorskip("pyarrow.parquet")
+        articles = archive_articles(4)
+
+        table = pa.ipc.open_stream(
+            format_articles_columnar(articles, "ipc")).read_all()
+        parquet = pq.read_table(pa.BufferReader(
+            format_articles_columnar(articles, "parquet")))
+
+        assert table.num_rows == parquet.num_rows == 4
+        assert table.schema.field("webPublicationDate").type == \
+            pa.timestamp("s", tz="UTC")
+        assert parquet.column("webUrl").to_pylist() == [
+            f"url/{i}" for i in range(4)]
+
+    @pytest.mark.it("An unknown output format is an error")
+    def test_columnar_unknown_output(self):
+        with pytest.raises(ValueError):
+            format_articles_columnar([], "xml")
+
+
+def api_response_bytes(results):
+    return json.dumps({"response": {
+        "status": "ok", "total": len(results), "currentPage": 1,
+        "pages": 1, "results": results}}).encode()
+
+
+class TestArticles:
+    @pytest.mark.it("Api responses are decoded straight into Articles")
+    @patch("src.stream.requests")
+    def test_decode_articles(self, mock_requests):
+        results = [{**article, "isHosted": False, "pillarId": "pillar/news"}
+                   for article in archive_articles(3)]
+        mock_requests.get.return_value.content = api_response_bytes(results)
+
+        page = get_api_response_articles({"q": "climate"})
+
+        assert page.total == 3
+        article = page.results[0]
+        assert isinstance(article, Article)
+        assert article.id == "article/2024-01-01/0"
+        assert not hasattr(article, "__dict__")
+        assert not hasattr(article, "isHosted")
+
+    @pytest.mark.it("A result that doesn't match the schema fails loudly")
+    @patch("src.stream.requests")
+    def test_decode_invalid(self, mock_requests):
+        results = archive_articles(2)
+        del results[1]["webUrl"]
+        mock_requests.get.return_value.content = api_response_bytes(results)
+
+        with pytest.raises(SystemExit, match="webUrl"):
+            get_api_response_articles({"q": "climate"})
+
+    @pytest.mark.it("Publication dates must be timestamps")
+    def test_article_date(self):
+        with pytest.raises(ValidationError):
+            Article(id="a", webPublicationDate="yesterday", webTitle="t",
+                    webUrl="u")
+
+    @pytest.mark.it("Articles can be read like result dicts")
+    def test_article_mapping(self):
+        article = Article(**archive_articles(1)[0])
+
+        assert article["webTitle"] == "title 0"
+        assert "sectionId" in article and "pillarName" not in article
+        assert article.get("pillarName", "none") == "none"
+        with pytest.raises(KeyError):
+            article["apiUrl"]
+        assert format_articles_columnar([article]) == \
+            format_articles_columnar([archive_articles(1)[0]])
+
+
+@pytest.fixture(params=["simdjson", "json"])
+def page_parser(request, monkeypatch):
+    if request.param == "simdjson":
+        pytest.importorskip("simdjson")
+    else:
+        monkeypatch.setattr("src.stream.simdjson", None)
+    return request.param
+
+
+class TestResultExtraction:
+    @pytest.mark.it("Only the kept fields and page counters are read")
+    def test_extract_search_page(self, page_parser):
+        results = [{**article, "isHosted": False,
+                    "fields": {"trailText": "A trail"}, "tags": [1, 2]}
+                   for article in archive_articles(2)]
+
+        page = extract_search_page(api_response_bytes(results))
+
+        assert {key: page[key] for key in ["total", "currentPage",
+                                           "pages"]} == {
+            "total": 2, "currentPage": 1, "pages": 1}
+        assert page["results"][0] == {
+            "id": "article/2024-01-01/0", "type": "article",
+            "sectionId": "environment", "webTitle": "title 0",
+            "webUrl": "url/0", "webPublicationDate": "2024-01-01T09:00:00Z",
+            "fields": {"trailText": "A trail"}}
+        assert "status" not in page
+
+    @pytest.mark.it("The fields to keep can be chosen")
+    def test_extract_chosen_fields(self, page_parser):
+        page = extract_search_page(
+            api_response_bytes(archive_articles(3)), fields=["id"])
+        assert page["results"] == [
+            {"id": f"article/2024-01-01/{i}"} for i in range(3)]
+
+    @pytest.mark.it("Pages from the api are extracted from the raw body")
+    @patch("src.stream.requests")
+    def test_get_api_response_page(self, mock_requests, page_parser):
+        mock_requests.get.return_value.content = api_response_bytes(
+            archive_articles(2))
+
+        page = get_api_response_page({"q": "climate"})
+
+        assert page.pages == 1
+        assert [result.webUrl for result in page.results] == [
+            "url/0", "url/1"]
+        assert page.results[0].sectionId == "environment"
+
+    @pytest.mark.it("Pages that don't match the Article model fail loudly")
+    @patch("src.stream.requests")
+    def test_get_api_response_page_invalid(self, mock_requests, page_parser):
+        results = [{key: value for key, value in article.items()
+                    if key != "webPublicationDate"}
+                   for article in archive_articles(2)]
+        mock_requests.get.return_value.content = api_response_bytes(results)
+
+        with pytest.raises(SystemExit, match="webPublicationDate"):
+            get_api_response_page({"q": "climate"})
+
+
+@pytest.fixture
+def guardian_server(monkeypatch):
+    """A local stand in for the Guardian api, answering every search with
+    three articles after a short delay."""
+    requests_seen = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests_seen.append(self.path)
+            time.sleep(0.05)
+            body = api_response_bytes(archive_articles(3))
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(ThreadingHTTPServer):
+        # Room for every concurrent connection, or some wait for a retry
+        request_queue_size = 128
+
+    server = Server(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr("src.stream.base_url",
+                        f"http://127.0.0.1:{server.server_port}/search")
+    monkeypatch.setattr("src.stream.rate_governor",
+                        RateGovernor(1000, burst=100))
+    yield requests_seen
+    server.shutdown()
+
+
+class TestAsyncPipeline:
+    @pytest.mark.it("The async handler publishes a search like the sync one")
+    @patch("src.stream.get_api_key", return_value="test")
+    def test_async_handler_search(self, mock_key, guardian_server):
+        pytest.importorskip("aiohttp")
+        memory_topics.pop("async", None)
+
+        result = async_lambda_handler(
+            {"search_term": "climate", "reference": "memory:async"})
+
+        assert result == {"result": "complete", "reference": "memory:async"}
+        body = json.loads(memory_topics["async"][0]["body"])
+        assert [article["webUrl"] for article in body] == [
+            "url/0", "url/1", "url/2"]
+        assert "q=climate" in guardian_server[0]
+
+    @pytest.mark.it("Searches run concurrently and share one api key")
+    @patch("src.stream.get_api_key", return_value="test")
+    def test_searches_concurrent(self, mock_key, guardian_server):
+        pytest.importorskip("aiohttp")
+        searches = [GuardianApiInfo(search_term=f"term {i}",
+                                    reference=f"memory:concurrent_{i}")
+                    for i in range(20)]
+
+        start = time.monotonic()
+        publishers = asyncio.run(run_searches_async(searches))
+
+        assert time.monotonic() - start < 20 * 0.05
+        assert len(publishers) == 20
+        assert mock_key.call_count == 1
+        assert all(memory_topics[f"concurrent_{i}"] for i in range(20))
+
+    @pytest.mark.it("Without aiohttp pages are fetched in threads")
+    @patch("src.stream.get_api_key", return_value="test")
+    def test_async_without_aiohttp(self, mock_key, guardian_server,
+                                   monkeypatch):
+        monkeypatch.setattr("src.stream.aiohttp", None)
+        memory_topics.pop("threaded", None)
+
+        async_lambda_handler(
+            {"search_term": "climate", "reference": "memory:threaded"})
+
+        assert len(json.loads(memory_topics["threaded"][0]["body"])) == 3
+
+    @pytest.mark.it("Batches are deduplicated on the event loop")
+    @patch("src.stream.get_api_key", return_value="test")
+    def test_async_batch(self, mock_key, guardian_server):
+        result = async_lambda_handler({
+            "mode": "batch",
+            "searches": [
+                {"search_term": "climate", "reference": "memory:batch"},
+                {"search_term": "climate change",
+                 "reference": "memory:batch"}]})
+
+        assert result["matches"] == 6
+        assert result["published"] == 3
+
+    @pytest.mark.it("Api errors stop the async pipeline")
+    @patch("src.stream.get_api_key", return_value="test")
+    def test_async_http_error(self, mock_key, monkeypatch):
+        pytest.importorskip("aiohttp")
+        monkeypatch.setattr("src.stream.base_url",
+                            "http://127.0.0.1:9/search")
+        with pytest.raises(SystemExit, match="Connection Error"):
+            async_lambda_handler(
+                {"search_term": "climate", "reference": "memory:error"})
+
+
+def published_at(*times):
+    return SearchPage(results=[
+        Article(id=f"a{number}", webPublicationDate=f"2024-01-01T{time}Z",
+                webTitle="t", webUrl="u")
+        for number, time in enumerate(times)
+    ])
+
+
+@pytest.fixture
+def registry(monkeypatch, tmp_path):
+    monkeypatch.setattr("src.stream.checkpoint_dir", str(tmp_path))
+    monkeypatch.setattr("src.stream.registry_store_type", "file")
+    monkeypatch.setattr("src.stream.guardian_daily_quota", 1440)
+    memory_topics.clear()
+
+
+class TestScheduler:
+    @pytest.mark.it("Quiet searches back off and busy ones poll faster")
+    def test_next_poll_interval(self):
+        search = SavedSearch(search_term="climate", reference="green",
+                             interval=600, last_run=0, rate=0.01)
+
+        rate, quiet = next_poll_interval(search, 0, 600, False)
+        assert rate == pytest.approx(0.007)
+        assert quiet == 1200
+
+        rate, busy = next_poll_interval(search, 10, 600, False)
+        assert busy < 600
+        search.priority = 2
+        assert next_poll_interval(search, 10, 600, False)[1] == \
+            pytest.approx(busy / 2)
+
+        _, saturated = next_poll_interval(search, 1, 600, True)
+        assert saturated == 300
+
+        search.interval = 80000
+        assert next_poll_interval(search, 0, 80000, False)[1] == 86400
+
+    @pytest.mark.it("Priority must be at least 1")
+    def test_priority(self):
+        with pytest.raises(ValidationError):
+            SavedSearch(search_term="climate", reference="green",
+                        priority=0)
+
+    @pytest.mark.it("A tick publishes only articles newer than the last")
+    @patch("src.stream.get_api_response_articles")
+    def test_watermark(self, mock_articles, registry):
+        mock_articles.side_effect = [
+            published_at("10:00:00", "09:00:00"),
+            published_at("09:00:00", "10:00:00", "11:00:00"),
+        ]
+        plan = SchedulePlan(add=[
+            {"search_term": "climate", "reference": "memory:green"}])
+
+        with freeze_time("2024-01-01 10:00:00"):
+            first = run_scheduler(plan, "key")
+        assert mock_articles.call_args.kwargs["payload"]["order-by"] == \
+            "newest"
+        with freeze_time("2024-01-01 11:00:00"):
+            second = run_scheduler(SchedulePlan(), "key")
+
+        assert first["polled"] == {"memory:green:climate": 2}
+        assert second["polled"] == {"memory:green:climate": 1}
+        bodies = [json.loads(message["body"])
+                  for message in memory_topics["green"]]
+        assert [len(body) for body in bodies] == [2, 1]
+        payload = mock_articles.call_args.kwargs["payload"]
+        assert payload["order-by"] == "oldest"
+        assert payload["from-date"] == "2024-01-01"
+        assert payload["page-size"] == stream.backfill_page_size
+
+    @pytest.mark.it("Polls page through every article after the watermark")
+    @patch("src.stream.get_api_response_articles")
+    def test_watermark_pages(self, mock_articles, registry, monkeypatch):
+        monkeypatch.setattr("src.stream.schedule_max_pages", 2)
+        first_page = published_at("09:00:00", "10:00:00")
+        second_page = published_at("11:00:00", "12:00:00")
+        for number, page in enumerate([first_page, second_page]):
+            page.pages = 3
+            for article in page.results:
+                article.id = f"{number}{article.id}"
+        mock_articles.side_effect = [
+            published_at("09:00:00"),
+            first_page, second_page,
+            published_at(
+                "09:00:00", "10:00:00", "11:00:00", "12:00:00", "13:00:00"),
+        ]
+        plan = SchedulePlan(add=[
+            {"search_term": "climate", "reference": "memory:green"}])
+
+        with freeze_time("2024-01-01 09:30:00"):
+            run_scheduler(plan, "key")
+        with freeze_time("2024-01-01 13:30:00"):
+            second = run_scheduler(SchedulePlan(), "key")
+        (search,) = stream.make_search_registry().load()[0].values()
+        assert search.watermark == "2024-01-01T12:00:00Z"
+        with freeze_time("2024-01-01 13:40:00"):
+            third = run_scheduler(SchedulePlan(), "key")
+
+        assert second["polled"] == {"memory:green:climate": 3}
+        assert third["polled"] == {"memory:green:climate": 1}
+        pages = [call.kwargs["payload"]["page"]
+                 for call in mock_articles.call_args_list]
+        assert pages == [1, 1, 2, 1]
+
+    @pytest.mark.it("Only due searches are polled, backing off when quiet")
+    @patch("src.stream.get_api_response_articles")
+    def test_due_searches(self, mock_articles, registry):
+        mock_articles.return_value = published_at("09:00:00")
+        plan = SchedulePlan(add=[
+            {"search_term": "climate", "reference": "memory:green"}])
+
+        with freeze_time("2024-01-01 10:00:00"):
+            run_scheduler(plan, "key")
+        with freeze_time("2024-01-01 10:00:30"):
+            assert run_scheduler(SchedulePlan(), "key")["polled"] == {}
+        with freeze_time("2024-01-01 10:01:00"):
+            run_scheduler(SchedulePlan(), "key")
+        with freeze_time("2024-01-01 10:02:00"):
+            assert run_scheduler(SchedulePlan(), "key")["polled"] == {}
+        with freeze_time("2024-01-01 10:03:00"):
+            summary = run_scheduler(SchedulePlan(), "key")
+
+        assert summary["polled"] == {"memory:green:climate": 0}
+        assert mock_articles.call_count == 3
+
+    @pytest.mark.it("Due searches beyond the quota budget are deferred")
+    @patch("src.stream.get_api_response_articles")
+    def test_quota_budget(self, mock_articles, registry, monkeypatch):
+        monkeypatch.setattr("src.stream.guardian_daily_quota", 48)
+        mock_articles.return_value = published_at("09:00:00")
+        plan = SchedulePlan(add=[
+            {"search_term": term, "reference": "memory:green",
+             "priority": priority}
+            for term, priority in [("a", 1), ("b", 3), ("c", 2)]])
+
+        with freeze_time("2024-01-01 10:00:00"):
+            summary = run_scheduler(plan, "key")
+
+        assert list(summary["polled"]) == ["memory:green:b",
+                                           "memory:green:c"]
+        assert summary["deferred"] == 1
+        assert summary["quota_stretch"] == 90
+
+        with freeze_time("2024-01-01 10:10:00"):
+            assert run_scheduler(SchedulePlan(), "key")["polled"] == {}
+        with freeze_time("2024-01-01 10:40:00"):
+            summary = run_scheduler(SchedulePlan(), "key")
+        assert list(summary["polled"]) == ["memory:green:a"]
+
+    @pytest.mark.it("A poll that raises is retried without stopping the "
+                    "tick")
+    @patch("src.stream.get_api_response_articles")
+    def test_poll_error(self, mock_articles, registry):
+        def articles(payload):
+            if payload["q"] == "a":
+                raise FileNotFoundError("seen_green.bin.tmp")
+            return published_at("09:00:00")
+
+        mock_articles.side_effect = articles
+        plan = SchedulePlan(add=[
+            {"search_term": term, "reference": "memory:green"}
+            for term in ["a", "b"]])
+
+        with freeze_time("2024-01-01 10:00:00"):
+            summary = run_scheduler(plan, "key")
+        with freeze_time("2024-01-01 10:01:00"):
+            retried = run_scheduler(SchedulePlan(), "key")
+
+        assert summary["failed"] == 1
+        assert list(summary["polled"]) == ["memory:green:b"]
+        assert retried["failed"] == 1 and retried["polled"] == {}
+
+    @pytest.mark.it("Searches can be unregistered and keep their schedule")
+    @patch("src.stream.get_api_response_articles")
+    def test_register(self, mock_articles, registry):
+        mock_articles.return_value = published_at("09:00:00")
+        search = {"search_term": "climate", "reference": "memory:green"}
+
+        with freeze_time("2024-01-01 10:00:00"):
+            run_scheduler(SchedulePlan(add=[search]), "key")
+            summary = run_scheduler(SchedulePlan(
+                add=[{**search, "priority": 2}]), "key")
+        assert summary["polled"] == {}
+
+        summary = run_scheduler(SchedulePlan(
+            remove=["memory:green:climate"]), "key")
+        assert summary["searches"] == 0
+
+    @pytest.mark.it("The registry can be kept in DynamoDB")
+    @mock_aws
+    def test_dynamodb_registry(self):
+        boto3.client("dynamodb", region_name="eu-west-2").create_table(
+            TableName="registry",
+            KeySchema=[{"AttributeName": "id", "KeyType": "HASH"}],
+            AttributeDefinitions=[
+                {"AttributeName": "id", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        registry = DynamoDBSearchRegistry("registry")
+        search = SavedSearch(search_term="climate", reference="green",
+                             priority=2, rate=0.5)
+
+        registry.put(search)
+        registry.put(SavedSearch(search_term="net zero", reference="green"))
+        registry.delete("green:net zero")
+        registry.put_state({"tokens": 3})
+
+        assert registry.load() == ({"green:climate": search}, {"tokens": 3})
+
+    @pytest.mark.it("A schedule event runs a scheduler tick")
+    @patch("src.stream.get_api_key", return_value="key")
+    def test_lambda_handler(self, mock_key, registry):
+        assert lambda_handler({"mode": "schedule"})["searches"] == 0
+        mock_key.assert_not_called()
+
+
+def slow_articles(payload, governor=None):
+    time.sleep(0.05)
+    return published_at("09:00:00")
+
+
+@pytest.fixture
+def profiling(monkeypatch, tmp_path):
+    monkeypatch.setattr("src.stream.profile_dir", str(tmp_path))
+    monkeypatch.setattr("src.stream.profile_bucket", None)
+    monkeypatch.setattr("src.stream.profile_sample_rate", 0)
+    with patch("src.stream.get_api_key", return_value="key"), \
+            patch("src.stream.get_api_response_articles",
+                  side_effect=slow_articles):
+        yield tmp_path
+
+
+def profile_event(**fields):
+    return {"search_term": "climate", "reference": "memory:profiled",
+            **fields}
+
+
+class TestProfiling:
+    @pytest.mark.it("A profile field writes a pstats file and memory report")
+    def test_cprofile(self, profiling, capsys):
+        context = MagicMock(aws_request_id="abc")
+
+        assert lambda_handler(profile_event(profile=True), context) == {
+            "result": "complete", "reference": "memory:profiled"}
+
+        profile, = profiling.glob("*_abc.pstats")
+        stats = pstats.Stats(str(profile))
+        assert any(function == "run_search"
+                   for _, _, function in stats.stats)
+        report = json.loads(next(profiling.glob("*_abc.memory.json"))
+                            .read_text())
+        assert report["peak_bytes"] > 0 and report["top_allocations"]
+        assert report["seconds"] >= 0.05
+        assert '"PeakMemory"' in capsys.readouterr().out
+
+    @pytest.mark.it("The sampling profiler writes a speedscope file")
+    def test_sampling(self, profiling):
+        lambda_handler(profile_event(profile="sampling"))
+
+        profile = json.loads(
+            next(profiling.glob("*.speedscope.json")).read_text())
+        frames = [frame["name"] for frame in profile["shared"]["frames"]]
+        assert "slow_articles" in frames
+        main, = [p for p in profile["profiles"] if p["name"] == "MainThread"]
+        assert len(main["samples"]) == len(main["weights"]) > 0
+        assert "SamplingProfiler" not in [p["name"]
+                                          for p in profile["profiles"]]
+
+    @pytest.mark.it("Sampled invocations are profiled, others are not")
+    def test_sample_rate(self, profiling, monkeypatch):
+        with patch("src.stream.cProfile.Profile") as mock_profile:
+            lambda_handler(profile_event())
+        mock_profile.assert_not_called()
+
+        monkeypatch.setattr("src.stream.profile_sample_rate", 1)
+        lambda_handler(profile_event())
+        assert len(list(profiling.glob("*.pstats"))) == 1
+
+    @pytest.mark.it("Profiles are uploaded to the profile bucket")
+    @mock_aws
+    def test_upload(self, profiling, monkeypatch):
+        s3_client = boto3.client("s3", region_name="eu-west-2")
+        s3_client.create_bucket(
+            Bucket="profiles",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"})
+        monkeypatch.setattr("src.stream.profile_bucket", "profiles")
+
+        lambda_handler(profile_event(profile=True))
+
+        keys = [item["Key"] for item in s3_client.list_objects_v2(
+            Bucket="profiles")["Contents"]]
+        assert len(keys) == 2
+        assert all(key.startswith("profiles/") for key in keys)
+
+    @pytest.mark.it("Samples every running thread")
+    def test_sampling_profiler(self):
+        profiler = SamplingProfiler(interval=0.001)
+        worker = threading.Thread(target=time.sleep, args=(0.05,),
+                                  name="worker")
+        profiler.start()
+        worker.start()
+        worker.join()
+        profiler.stop()
+
+        assert "worker" in profiler.samples
+        assert "MainThread" in profiler.samples
+
+
+class TestFreshness:
+    @pytest.mark.it("Messages carry a trace id and their fetch and enqueue "
+                    "times")
+    def test_freshness_attributes(self, sqs_client):
+        queue_url = create_sqs_queue("climate")
+        fetched_at = time.time() - 5
+        message = article_message(sectioned_articles(1), ["climate"],
+                                  fetched_at=fetched_at)
+
+        send_sqs_message_batch([message], queue_url)
+
+        attributes = sqs_client.receive_message(
+            QueueUrl=queue_url, MessageAttributeNames=["All"]
+        )["Messages"][0]["MessageAttributes"]
+        assert len(attributes["trace-id"]["StringValue"]) == 32
+        assert attributes["fetched-at"]["StringValue"] == \
+            utc_timestamp(fetched_at)
+        enqueued_at = parse_timestamp(attributes["enqueued-at"]["StringValue"])
+        assert fetched_at < enqueued_at <= time.time()
+
+    @pytest.mark.it("Coalesced messages keep the trace of their first "
+                    "message")
+    def test_coalesced_trace(self):
+        messages = article_messages(3)
+
+        coalesced = coalesce_messages(messages)
+
+        assert len(coalesced) == 1
+        assert coalesced[0]["attributes"]["trace-id"] == \
+            messages[0]["attributes"]["trace-id"]
+        assert coalesced[0]["attributes"]["fetched-at"] == \
+            messages[0]["attributes"]["fetched-at"]
+
+    @pytest.mark.it("Publishing a search emits its term's freshness")
+    def test_freshness_metrics(self, capsys):
+        info = GuardianApiInfo(search_term="climate",
+                               reference="memory:fresh")
+        fetched_at = parse_timestamp("2024-01-01T00:01:00Z")
+
+        publish_search(info, MemoryPublisher("fresh"),
+                       sectioned_articles(2), fetched_at)
+
+        lines = capsys.readouterr().out.splitlines()
+        metrics = {name: metric for metric in map(
+            json.loads, filter(lambda line: line.startswith("{"), lines))
+            for name in ("PublicationLag", "EnqueueLag") if name in metric}
+        assert metrics["PublicationLag"]["PublicationLag"] == [60.0]
+        assert metrics["PublicationLag"]["search_term"] == "climate"
+        assert metrics["EnqueueLag"]["EnqueueLag"][0] > 0
+
+    @pytest.mark.it("Spilled messages emit their freshness once sent")
+    @mock_aws
+    def test_spilled_freshness(self, backpressure, aws_credentials, capsys):
+        info = GuardianApiInfo(search_term="climate", reference="climate")
+        publisher = get_publisher("climate")
+        backpressure.setattr("src.stream.queue_depths",
+                             {publisher.queue_url: (time.monotonic(), 25)})
+
+        publish_search(info, publisher, sectioned_articles(2))
+        assert "EnqueueLag" not in capsys.readouterr().out
+
+        backpressure.setattr("src.stream.queue_depths",
+                             {publisher.queue_url: (time.monotonic(), 0)})
+        assert send_sqs_message_batch([], publisher.queue_url) == 1
+        lags = [json.loads(line) for line in capsys.readouterr().out
+                .splitlines() if "EnqueueLag" in line]
+        assert [lag["search_term"] for lag in lags] == ["climate"]